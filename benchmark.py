@@ -0,0 +1,368 @@
+''' Benchmarks for the database, flagging, graph, web UI and scraping code on synthetic data. No Twitter login needed.
+
+Every dataset is generated in a scratch data directory, so the real database in data/ is never touched:
+    - Follower databases of any size with a fraction of bot-like users (random usernames, brand new accounts,
+      spammy bios, hardly any follows), written straight to the users table
+    - A followings graph for a sample of the users, where the bots follow from a shared pool of accounts
+    - Scraping runs against fake_twitter.FakeTwitter with simulated latency and rate limits
+
+Results are written as JSON (one record per dataset + benchmark), so runs can be compared to catch regressions, ex.
+
+    python benchmark.py --users 1000 10000 100000 --output before.json
+    python benchmark.py --users 1000 10000 100000 --output after.json --compare before.json
+'''
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import build_database
+import config
+import flag_users
+import graph_analysis
+from fake_twitter import FakeTwitter, BOT_DESCRIPTIONS
+from minhash import synthetic_followings
+
+BENCHMARK_DIR = os.path.join(build_database.DATA_DIR, 'benchmarks')
+
+# build_database / graph_analysis paths that get pointed at the scratch data directory
+DATA_PATHS = {
+    build_database: ['DB_PATH', 'DB_TIMESTAMP_FILE', 'EDGES_DIR', 'DB_CSV_PATH', 'DB_FOLLOWINGS_PATH'],
+    graph_analysis: ['GRAPH_CACHE_DIR'],
+}
+
+# fields identifying the same benchmark across results files
+RESULT_KEYS = ['benchmark', 'users', 'bot_fraction', 'graph_users', 'followers', 'sessions']
+
+HUMAN_NAMES = ['bob', 'alice', 'jim', 'maria', 'chen', 'sam', 'priya', 'omar']
+HUMAN_SURNAMES = ['smith', 'garcia', 'lee', 'brown', 'wilson', 'khan', 'martin', 'lopez',
+                  'walker', 'young', 'hill', 'green', 'adams', 'baker', 'nelson', 'carter']
+HUMAN_DESCRIPTIONS = ['', 'Dad, runner, coffee', 'Software engineer', 'Views are my own', 'Photographer based in NY',
+                      'Reporter covering tech', 'Building things on the internet']
+LOCATIONS = ['', 'New York', 'London', 'Berlin', 'Tokyo', 'San Francisco', 'Toronto']
+
+def run_benchmarks(user_counts = (1000, 10000), bot_fraction = 0.1, graph_users = 1000, flag_workers = 1,
+                   scrape_followers = 500, scrape_sessions = (1, 4), latency_sec = 0.02, rate_limit_period_sec = 1, seed = 0):
+    ''' Run every benchmark, returns a list of result dicts
+
+    user_counts {list} -- Sizes of the synthetic follower databases to benchmark
+    bot_fraction {float} -- Fraction of bot-like users in the synthetic data
+    graph_users {int} -- Max number of users in the followings graph
+    flag_workers {int} -- workers argument of get_all_flagged_users()
+    scrape_followers {int} -- Number of followers the fake account has for the scraping benchmarks. 0 to skip them
+    scrape_sessions {list} -- Numbers of scraping sessions to benchmark scrape_all_db_followers() with
+    latency_sec {float} -- Simulated time per fake Twitter request
+    rate_limit_period_sec {float} -- Fake rate limit window, scaled down from Twitter's 15 minutes so runs stay short.
+                                     Every session gets config.SCRAPING_RATE_LIMIT_REQUESTS requests per window
+    '''
+    results = []
+
+    for num_users in user_counts:
+        print(f'---------- {num_users} users ----------')
+        with scratch_data_dir():
+            results += benchmark_database(num_users, bot_fraction, graph_users, flag_workers, seed)
+
+    if scrape_followers:
+        print('---------- scraping ----------')
+        with scratch_data_dir():
+            results += benchmark_scraping(scrape_followers, scrape_sessions, bot_fraction, latency_sec, rate_limit_period_sec, seed)
+
+    return results
+
+#------------------------------------
+# Benchmarks
+#------------------------------------
+
+def benchmark_database(num_users, bot_fraction, graph_users, flag_workers, seed):
+    ''' load_database(), get_all_flagged_users(), graph generation + web UI on a synthetic database of num_users users '''
+    dataset = {'users': num_users, 'bot_fraction': bot_fraction}
+    results = []
+
+    t = time.perf_counter()
+    df = synthetic_users(num_users, bot_fraction, seed)
+    build_database.save_database(df)
+    flag_users.DB_TIMESTAMP = datetime.datetime(2024, 1, 1)
+    results.append(_result('generate_users', dataset, [time.perf_counter() - t]))
+
+    build_database._database_cache.clear()
+    results.append(_result('load_database_cold', dataset, _time(build_database.load_database)))
+    results.append(_result('load_database_cached', dataset, _time(build_database.load_database, repeat = 5)))
+    results.append(_result('load_database_filtered', dataset,
+        _time(lambda: build_database.load_database(columns = ['username'], where = 'friends_count < ?', params = (3,)), repeat = 5)))
+
+    df = build_database.load_database()
+    flagged = []
+    def flag(incremental):
+        flagged[:] = flag_users.get_all_flagged_users(df, workers = flag_workers, incremental = incremental)[0]
+    results.append(_result('flag_full', dataset, _time(lambda: flag(False)), flagged = len(flagged)))
+    results.append(_result('flag_incremental_cold', dataset, _time(lambda: flag(True)), flagged = len(flagged)))
+    results.append(_result('flag_incremental_unchanged', dataset, _time(lambda: flag(True), repeat = 3), flagged = len(flagged)))
+    flag_ids, reasons = flag_users.get_all_flagged_users(df, workers = flag_workers)
+    flag_users.update_database_with_flags(df, flag_ids, reasons)
+
+    num_graph_users = min(num_users, graph_users)
+    usernames = df['username'].iloc[:num_graph_users].tolist()
+    is_bot = (df['friends_count'].iloc[:num_graph_users] < 3).to_numpy() # only bots follow fewer than 3 accounts
+    t = time.perf_counter()
+    for username, followings in graph_followings(usernames, is_bot, seed).items():
+        build_database.save_followings(username, followings)
+    graph_dataset = {**dataset, 'graph_users': num_graph_users}
+    results.append(_result('save_followings', graph_dataset, [time.perf_counter() - t]))
+
+    for name, generate in [('graph_html', graph_analysis.generate_graph_html), ('graph_payload', graph_analysis.generate_graph_data)]:
+        output = []
+        results.append(_result(f'{name}_cold', graph_dataset, _time(lambda: output.append(generate()))))
+        graph_analysis._graph_html_cache.clear()
+        graph_analysis._graph_versions.clear()
+        results.append(_result(f'{name}_disk_cached', graph_dataset, _time(generate)))
+        results.append(_result(f'{name}_memory_cached', graph_dataset, _time(generate, repeat = 5), bytes = len(output[0])))
+
+    clusters = []
+    results.append(_result('clusters_cold', graph_dataset, _time(lambda: clusters.append(graph_analysis.get_user_clusters()))))
+    graph_analysis._clusters_cache.clear()
+    results.append(_result('clusters_disk_cached', graph_dataset, _time(graph_analysis.get_user_clusters),
+                           clusters = int(clusters[0]['cluster_id'].nunique()), clustered_users = len(clusters[0])))
+    results.append(_result('flag_incremental_followings_changed', dataset, _time(lambda: flag(True)), flagged = len(flagged)))
+
+    results += benchmark_web_ui(dataset)
+    return results
+
+def benchmark_web_ui(dataset):
+    ''' Time the / page and the /api/users requests its table makes '''
+    try:
+        from fastapi.testclient import TestClient # needs httpx
+        import server
+    except ImportError as e:
+        print(f'Skipping web UI benchmarks: {e}')
+        return []
+
+    client = TestClient(server.app)
+    requests = [
+        ('render_root', '/'),
+        ('api_users_first_page', '/api/users?limit=100'),
+        ('api_users_flagged', '/api/users?limit=100&flagged_only=true'),
+        ('api_users_sorted', '/api/users?limit=100&sort=followers_count&descending=true'),
+    ]
+
+    results = []
+    for name, url in requests:
+        def get():
+            response = client.get(url)
+            response.raise_for_status()
+        results.append(_result(name, dataset, _time(get, repeat = 5)))
+    return results
+
+def benchmark_scraping(num_followers, session_counts, bot_fraction, latency_sec, rate_limit_period_sec, seed):
+    ''' Throughput of create_database() and scrape_all_db_followers() against FakeTwitter '''
+    dataset = {'followers': num_followers, 'latency_sec': latency_sec,
+               'rate_limit': f'{config.SCRAPING_RATE_LIMIT_REQUESTS}/{rate_limit_period_sec}s'}
+    results = []
+
+    # profiles are fetched page by page without the scheduler, so no rate limit here
+    pages = -(-num_followers // 50)
+    app = FakeTwitter(num_followers = num_followers, latency_sec = latency_sec, rate_limit_requests = pages + 1,
+                      bot_fraction = bot_fraction, seed = seed)
+    seconds = _time(lambda: build_database.create_database('benchmark', pages = pages, authenticated_app = app, fresh = True))
+    results.append(_result('scrape_profiles', dataset, seconds,
+        users_per_sec = round(num_followers / seconds[0], 2), requests_per_sec = round(app.request_count / seconds[0], 2)))
+
+    old_rate_limit = config.SCRAPING_RATE_LIMIT_PERIOD_SEC
+    config.SCRAPING_RATE_LIMIT_PERIOD_SEC = rate_limit_period_sec
+    try:
+        num_users = len(build_database.load_database(columns = ['username'], where = 'protected != 1'))
+        for num_sessions in session_counts:
+            apps = [FakeTwitter(f'session_{i}', latency_sec = latency_sec, rate_limit_requests = config.SCRAPING_RATE_LIMIT_REQUESTS,
+                                rate_limit_period_sec = rate_limit_period_sec, seed = seed) for i in range(num_sessions)]
+            seconds = _time(lambda: build_database.scrape_all_db_followers(apps, pages = 2))
+            requests = sum(app.request_count for app in apps)
+            results.append(_result('scrape_followings', {**dataset, 'sessions': num_sessions, 'users_scraped': num_users}, seconds,
+                users_per_sec = round(num_users / seconds[0], 2), requests_per_sec = round(requests / seconds[0], 2),
+                max_requests_per_sec = round(num_sessions * config.SCRAPING_RATE_LIMIT_REQUESTS / rate_limit_period_sec, 2)))
+    finally:
+        config.SCRAPING_RATE_LIMIT_PERIOD_SEC = old_rate_limit
+
+    return results
+
+#------------------------------------
+# Synthetic data
+#------------------------------------
+
+def synthetic_users(num_users, bot_fraction = 0.1, seed = 0):
+    ''' DataFrame of num_users followers with the same columns as a scraped database. Generated with numpy,
+    so 1M users take seconds. Bots get 12 character random usernames, were created in the month before
+    2024-01-01, follow 0-2 accounts and have spammy descriptions. '''
+    rnd = np.random.default_rng(seed)
+    is_bot = rnd.random(num_users) < bot_fraction
+    num_bots = int(is_bot.sum())
+
+    # name + surname + number, unique per user with at most 4 digits up to 1M users so they don't look randomly generated
+    user_nums = np.arange(num_users)
+    first_names = np.array(HUMAN_NAMES)[user_nums % len(HUMAN_NAMES)]
+    surnames = np.array(HUMAN_SURNAMES)[user_nums // len(HUMAN_NAMES) % len(HUMAN_SURNAMES)]
+    numbers = (user_nums // (len(HUMAN_NAMES) * len(HUMAN_SURNAMES))).astype(str)
+    usernames = np.char.add(np.char.add(first_names, surnames), numbers).astype(object)
+    random_chars = rnd.choice(list('abcdefghijklmnopqrstuvwxyz0123456789'), (num_bots, 12))
+    usernames[is_bot] = [''.join(chars) for chars in random_chars]
+
+    end = np.datetime64('2024-01-01', 'ns')
+    human_age_days = rnd.integers(30, 15 * 365, num_users)
+    bot_age_days = rnd.integers(0, 30, num_users)
+    created_at = end - np.where(is_bot, bot_age_days, human_age_days).astype('timedelta64[D]')
+
+    descriptions = np.where(is_bot, rnd.choice(BOT_DESCRIPTIONS, num_users), rnd.choice(HUMAN_DESCRIPTIONS, num_users))
+    followers_count = np.where(is_bot, rnd.integers(0, 50, num_users), rnd.lognormal(5, 1.5, num_users).astype(np.int64))
+
+    return pd.DataFrame({
+        'username': usernames,
+        'name': np.char.add(np.char.add(np.char.capitalize(first_names), ' '), np.char.capitalize(surnames)).astype(object),
+        'id': (10**9 + np.arange(num_users)).astype(str).astype(object),
+        'created_at': created_at,
+        'description': descriptions.astype(object),
+        'location': pd.Categorical(rnd.choice(LOCATIONS, num_users)),
+        'followed_by': True,
+        'following': rnd.random(num_users) < 0.2,
+        'statuses_count': np.where(is_bot, rnd.integers(0, 10, num_users), rnd.integers(0, 20000, num_users)),
+        'followers_count': followers_count,
+        'friends_count': np.where(is_bot, rnd.integers(0, 3, num_users), rnd.integers(3, 5000, num_users)),
+        'subscriptions_count': 0,
+        'profile_banner_url': np.where(rnd.random(num_users) < 0.5, 'https://pbs.twimg.com/profile_banners/1/1', None),
+        'profile_image_url_https': 'https://pbs.twimg.com/profile_images/1/photo_normal.jpg',
+        'favourites_count': rnd.integers(0, 50000, num_users),
+        'protected': rnd.random(num_users) < 0.05,
+        'verified': ~is_bot & (rnd.random(num_users) < 0.01),
+        'flags': '',
+    })
+
+def graph_followings(usernames, is_bot, seed = 0, bot_pool_size = 120, bot_followings = 100):
+    ''' {username: list of accounts followed}. Humans follow accounts from a few overlapping communities
+    (see minhash.synthetic_followings), bots follow from one shared pool so they end up as a tight cluster. '''
+    rnd = np.random.default_rng(seed)
+    communities = synthetic_followings(len(usernames), seed = seed)
+    bot_pool = rnd.choice(50000, bot_pool_size, replace = False)
+
+    followings = {}
+    for i, (username, bot) in enumerate(zip(usernames, is_bot)):
+        accounts = rnd.choice(bot_pool, bot_followings, replace = False) if bot else communities[f'user{i}']
+        followings[username] = [f'account{a}' for a in accounts]
+    return followings
+
+#------------------------------------
+# Helper functions
+#------------------------------------
+
+@contextlib.contextmanager
+def scratch_data_dir():
+    ''' Point the database + graph cache at an empty temporary directory, restore the real paths after '''
+    scratch_dir = tempfile.mkdtemp(prefix = 'twitter_dashboard_benchmark_')
+    old_paths = {module: {name: getattr(module, name) for name in names} for module, names in DATA_PATHS.items()}
+
+    try:
+        for module, paths in old_paths.items():
+            for name, path in paths.items():
+                setattr(module, name, os.path.join(scratch_dir, os.path.relpath(path, build_database.DATA_DIR)))
+        _clear_caches()
+        yield scratch_dir
+    finally:
+        for module, paths in old_paths.items():
+            for name, path in paths.items():
+                setattr(module, name, path)
+        _clear_caches()
+        shutil.rmtree(scratch_dir, ignore_errors = True)
+
+def _clear_caches():
+    build_database._database_cache.clear()
+    build_database._legacy_csv_checked = False
+    graph_analysis._graph_html_cache.clear()
+    graph_analysis._graph_versions.clear()
+    graph_analysis._clusters_cache.clear()
+
+def _time(func, repeat = 1):
+    ''' Seconds each of repeat calls of func took '''
+    seconds = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - t)
+    return seconds
+
+def _result(name, dataset, seconds, **extra):
+    result = {'benchmark': name, **dataset, 'seconds': round(statistics.median(seconds), 6),
+              'min_seconds': round(min(seconds), 6), 'runs': len(seconds), **extra}
+    print(f"{name}: {result['seconds']:.4f}s {extra if extra else ''}")
+    return result
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def save_results(results, output, args = None):
+    ''' Write results to output as JSON along with the commit + machine they were run on '''
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok = True)
+    with open(output, 'w') as file:
+        json.dump({
+            'created_at': f'{datetime.datetime.now()}',
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': args,
+            'results': results,
+        }, file, indent = 2)
+    print(f'Saved {len(results)} results to {output}')
+
+def compare_results(results, baseline_path, threshold = 1.2):
+    ''' Print the change in time of each benchmark vs a previous results file, flag ones slower by threshold x or more '''
+    with open(baseline_path, 'r') as file:
+        baseline = json.load(file)['results']
+
+    def key(result):
+        return tuple(result.get(k) for k in RESULT_KEYS)
+
+    baseline = {key(result): result for result in baseline}
+    for result in results:
+        old = baseline.get(key(result))
+        if old is None or not old['seconds']:
+            continue
+        ratio = result['seconds'] / old['seconds']
+        dataset = {k: result[k] for k in RESULT_KEYS[1:] if k in result}
+        print(f"{'SLOWER ' if ratio >= threshold else ''}{result['benchmark']} {dataset}: "
+              f"{old['seconds']:.4f}s -> {result['seconds']:.4f}s ({ratio:.2f}x)")
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Benchmark twitter-dashboard on synthetic data, see the top of benchmark.py')
+    parser.add_argument('-u', '--users', type=int, nargs='+', default=[1000, 10000], help='Sizes of the synthetic follower databases')
+    parser.add_argument('-b', '--bot-fraction', type=float, default=0.1, help='Fraction of bot-like users')
+    parser.add_argument('-g', '--graph-users', type=int, default=1000, help='Max number of users in the followings graph')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Flagging worker processes, 0 = every CPU core')
+    parser.add_argument('--scrape-followers', type=int, default=500, help='Followers of the fake account to scrape, 0 to skip scraping')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 4], help='Numbers of fake scraping sessions to benchmark')
+    parser.add_argument('--latency', type=float, default=0.02, help='Simulated seconds per fake Twitter request')
+    parser.add_argument('--rate-limit-period', type=float, default=1, help='Fake rate limit window in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', type=str, default=None,
+        help='Results JSON file. Default data/benchmarks/benchmark_<timestamp>.json')
+    parser.add_argument('--compare', type=str, default=None, help='Previous results JSON file to compare against')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.users, args.bot_fraction, args.graph_users, args.workers, args.scrape_followers,
+                             args.sessions, args.latency, args.rate_limit_period, args.seed)
+
+    output = args.output or os.path.join(BENCHMARK_DIR, f'benchmark_{datetime.datetime.now():%Y%m%d_%H%M%S}.json')
+    save_results(results, output, vars(args))
+    if args.compare:
+        compare_results(results, args.compare)
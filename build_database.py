@@ -1,173 +1,682 @@
 
 from tweety import Twitter #pip install tweety-ns     #https://github.com/mahrtayyab/tweety
 import config
-import emoji
 import pandas as pd
 import os
 from tqdm import tqdm
-import time
+from scrape_scheduler import ScrapingSession, run_scrape_jobs
+from user_columns import UserColumnBuffer
+import metrics
 import datetime
+import sqlite3
+import threading
+import json
+import base64
+import ast
+import numpy as np
+from contextlib import contextmanager, closing
 
 # Database Parameters
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 os.makedirs(DATA_DIR, exist_ok = True)
-DB_CSV_PATH = os.path.join(DATA_DIR, 'db.csv')
-CSV_DELIMITER = ';'    #choose a rare character for people to put on twitter
+DB_PATH = os.path.join(DATA_DIR, 'db.sqlite')
 DB_TIMESTAMP_FILE = os.path.join(DATA_DIR, "db_generated_timestamp.txt")
+USERS_TABLE = 'users'
+FOLLOWINGS_TABLE = 'followings'
+SCRAPE_STATE_TABLE = 'scrape_state'
+DB_META_TABLE = 'db_meta'
+
+# Followings graph: every account gets a small integer id in the accounts table, and each following is an
+# edge (follower account id, followed account id). Edges are exported to .npy files in EDGES_DIR for the graph
+# builder to memory map, re-exported whenever the edges table changed.
+ACCOUNTS_TABLE = 'accounts'
+EDGES_TABLE = 'following_edges'
+EDGES_DIR = os.path.join(DATA_DIR, 'edges')
+
+# Indexed columns for each table, so single user lookups and sorted review table pages don't need a full scan
+TABLE_INDEXES = {
+    USERS_TABLE: ['username', 'id', 'followers_count', 'friends_count', 'statuses_count', 'created_at'],
+    FOLLOWINGS_TABLE: ['followed_by_username'],
+}
+
+# Tweety user attributes saved for every follower
+USER_ATTRIBUTES = [
+    'username', 'name', 'id', 'created_at', 'description', 'location',
+    'followed_by','following',
+    'statuses_count', 'followers_count', 'friends_count','subscriptions_count',
+    'profile_banner_url','profile_image_url_https',
+    'favourites_count', 'protected','verified'
+    ]
+
+# Scraped followers are buffered in memory and written to the database this many at a time
+USER_BATCH_SIZE = 1000
+
+# SQLite stores booleans as 0/1, convert these back to bool on load
+BOOL_COLUMNS = ['followed_by', 'following', 'protected', 'verified']
+
+# Legacy CSV "database" - imported into SQLite automatically the first time the database is loaded
+DB_CSV_PATH = os.path.join(DATA_DIR, 'db.csv')
 DB_FOLLOWINGS_PATH = os.path.join(DATA_DIR, 'followings.csv')
-
-def create_database(username: str, pages = 1, authenticated_app = None):
-    ''' Given a username, scrape user profiles of every account that follows that username. Save to database.'''
+CSV_DELIMITER = ';'
+_legacy_csv_checked = False
+
+# In-memory cache of the users table, see load_database()
+_database_cache = {}
+_database_cache_lock = threading.Lock()
+# count_database() results for the current database version
+_count_cache = {}
+_PANDAS_COPY_ON_WRITE = int(pd.__version__.split('.')[0]) >= 3
+
+def create_database(username: str, pages = 1, authenticated_app = None, fresh = False, progress_callback = None, cancel_event = None,
+                    dropped_callback = None):
+    ''' Given a username, scrape user profiles of every account that follows that username. Save to database.
+
+    Followers are converted into typed column buffers page by page and written to the database every
+    USER_BATCH_SIZE users, so memory use doesn't grow with the number of followers. The pagination cursor is
+    checkpointed after each write, so a crash or rate limit ban only loses the unsaved batch.
+        - If the last scrape of this username didn't finish, resume from its checkpointed cursor.
+        - If it did finish, only fetch new followers: Twitter returns newest followers first,
+          so stop at the first page containing followers we already have.
+
+    pages {int} -- Max number of pages of followers to fetch in this run. About 50-60 users per page
+    fresh {bool} -- Throw away the scraped followers and scrape from page 1, ie. to find lost followers and changed
+                    profiles. Scraped followings are kept. Always happens (followings included) when scraping a
+                    different username than the existing database.
+    progress_callback {function} -- Called as progress_callback(pages_done, pages, message) after each page
+    cancel_event {threading.Event} -- Stop after the current page when it's set, checkpointing what was scraped so far
+    dropped_callback {function} -- Called with no arguments once a fresh scrape dropped the old followers, ie. so a
+                                   restarted job resumes from the checkpoints instead of dropping them again
+    '''
 
     if authenticated_app is None:
-        authenticated_app = Twitter("session")
-        try:
-            authenticated_app.connect() #use previous session
-            print('Logging in using previous session.')
-        except:
-            #login with new session
-            authenticated_app.sign_in(config.SCRAPING_ACCOUNT_USERNAME, config.SCRAPING_ACCOUNT_PASSWORD)
-            print('Logging in using saved username / password.')
-
-    users = authenticated_app.get_user_followers(username, pages = pages)
-    df = list_of_users_to_dataframe(users)
-
-    df.to_csv(DB_CSV_PATH, index = False, sep=CSV_DELIMITER)
+        authenticated_app = login_scraping_account(config.SCRAPING_ACCOUNT_USERNAME, config.SCRAPING_ACCOUNT_PASSWORD)
+
+    state = load_scrape_state()
+    other_account = state is not None and state['username'] != username
+    if other_account:
+        print(f'Existing database is for @{state["username"]}, starting a fresh scrape of @{username}.')
+        fresh = True
+
+    if fresh:
+        # the followings graph of the same followers is still valid, only drop it for a different account
+        drop_database(followings = other_account)
+        state = None
+        if dropped_callback is not None:
+            dropped_callback()
+
+    if state is not None and not state['complete']:
+        mode, cursor = state['mode'], state['cursor']
+        print(f'Resuming {mode} scrape of @{username} followers from checkpoint after {state["pages_done"]} pages.')
+    else:
+        #a previous scrape finished (or a legacy database exists) --> only fetch followers we don't have yet
+        mode = 'delta' if state is not None or database_exists() else 'full'
+        cursor = None
+    pages_done = state['pages_done'] if state is not None and not state['complete'] else 0
+
+    buffer = UserColumnBuffer(USER_ATTRIBUTES, capacity = USER_BATCH_SIZE)
+    buffered_ids = set()
+
+    complete, cancelled, page_count, new_user_count = False, False, 0, 0
+    for followers_obj, users in authenticated_app.iter_user_followers(username, pages = pages, cursor = cursor):
+
+        page_ids = [str(getattr(user, 'id', None)) for user in users]
+        known_ids = get_existing_user_ids(page_ids)
+        new_users = [user for user, id in zip(users, page_ids) if id not in known_ids and id not in buffered_ids]
+        buffered_ids.update(page_ids)
+
+        buffer.extend(new_users)
+        new_user_count += len(new_users)
+        page_count += 1
+        metrics.inc('scrape_pages_total')
+
+        cursor = getattr(followers_obj, 'cursor', None)
+        reached_known_followers = mode == 'delta' and len(known_ids) > 0
+        complete = reached_known_followers or not cursor
+
+        #only checkpoint the cursor once the users before it are saved, so resuming never skips anyone
+        if len(buffer) >= USER_BATCH_SIZE or complete:
+            _flush_user_buffer(buffer, buffered_ids)
+            save_scrape_state(username, mode, cursor, pages_done + page_count, complete)
+            print(f'Saved {page_count} pages: {new_user_count} new followers of @{username}')
+
+        cancelled = cancel_event is not None and cancel_event.is_set()
+        if cancelled:
+            break
+
+        if progress_callback is not None:
+            progress_callback(page_count, pages, f'{new_user_count} new followers of @{username}')
+
+        if reached_known_followers:
+            break
+
+    if len(buffer) > 0:
+        _flush_user_buffer(buffer, buffered_ids)
+        save_scrape_state(username, mode, cursor, pages_done + page_count, complete)
+
+    if page_count < pages and not complete and not cancelled:
+        #tweety stopped before the page limit --> no followers left to fetch
+        complete = True
+        save_scrape_state(username, mode, cursor, pages_done + page_count, complete)
+
+    print(f'Scraped {new_user_count} new followers of @{username}. Scrape {"complete" if complete else "checkpointed, run again to continue"}.')
+
+    if complete:
+        from snapshots import take_snapshot # imported here, snapshots imports this module
+        take_snapshot(username, mode)
 
     with open(DB_TIMESTAMP_FILE, 'w') as file:
         file.write(f'{datetime.datetime.now()}')
 
-def load_database(**kwargs):
+def load_database(columns = None, where = None, params = (), limit = None, usecols = None, nrows = None):
     ''' Load from the database created in create_database() function.
-    Keyword args passed to this function will be passed to Panda's read_csv function.
-    usecols or nrows for example '''
-    df = pd.read_csv(DB_CSV_PATH, sep = CSV_DELIMITER, **kwargs)
-    return df
-
-def scrape_all_db_followers(authenticated_app = None, pages:int = 10, delay_sec_for_rate_limit: int = 45):
+    Row filters are pushed down to SQLite so only the requested data is read.
+    Unfiltered loads are served from an in-memory cache of the users table, reloaded when the database changes.
+    Returned DataFrames are copies (copy on write views with pandas >= 3), changing them doesn't change the cache.
+
+    columns {list} -- Only load these columns. usecols is accepted as an alias (matches the old read_csv interface)
+    where {str} -- SQL filter expression, ex. "flags != 'no_flag'" or "username = ?"
+    params {tuple} -- Values for any ? placeholders in where
+    limit {int} -- Max number of rows to load. nrows is accepted as an alias
+    '''
+    columns = columns if columns is not None else usecols
+    limit = limit if limit is not None else nrows
+
+    if where is None and limit is None:
+        with metrics.timer('db_load_seconds', source = 'cache'):
+            df = _load_cached_users()
+            df = df[list(columns)] if columns else df
+            return df.copy(deep = not _PANDAS_COPY_ON_WRITE)
+
+    select = ', '.join(_quote(c) for c in columns) if columns else '*'
+    sql = f'SELECT {select} FROM {USERS_TABLE}'
+    if where:
+        sql += f' WHERE {where}'
+    sql += ' ORDER BY rowid'
+    if limit is not None:
+        sql += f' LIMIT {int(limit)}'
+
+    with metrics.timer('db_load_seconds', source = 'query'), db_connection() as con:
+        if not _table_exists(con, USERS_TABLE):
+            raise FileNotFoundError(f'No database found at {DB_PATH}. Run create_database() first.')
+        df = pd.read_sql_query(sql, con, params = params)
+
+    return _convert_bool_columns(df)
+
+def load_database_page(where = None, params = (), sort = 'rowid', descending = False, cursor = None, limit = 100, columns = None):
+    ''' Load one page of users, for paginating through large databases. Uses keyset pagination on (sort, rowid),
+    so with sort indexed (TABLE_INDEXES) a page is an index range scan no matter how deep into the results it is.
+    Rows a where filter skips are still read, unless the filter is on the sort column.
+
+    SQLite sorts NULLs first. They are read as a separate range instead of with an OR in the cursor condition,
+    which would stop SQLite from seeking into the index.
+
+    where, params {str, tuple} -- SQL filter, same as load_database()
+    sort {str} -- Column to sort by, ties are broken by insertion order
+    cursor {str} -- next_cursor returned by the previous page, None for the first page
+
+    Returns (df, next_cursor). next_cursor is None on the last page.
+    '''
+    sort_value, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode())) if cursor is not None else (None, None)
+    op, direction = ('<', 'DESC') if descending else ('>', 'ASC')
+
+    if sort == 'rowid':
+        sort_expr = 'rowid'
+        ranges = [(f'rowid {op} ?', [rowid]) if cursor is not None else (None, [])]
+    else:
+        sort_expr = _quote(sort)
+        in_nulls = cursor is not None and sort_value is None
+        null_range = (f'{sort_expr} IS NULL AND rowid {op} ?', [rowid]) if in_nulls else (f'{sort_expr} IS NULL', [])
+        if cursor is not None and not in_nulls:
+            value_range = (f'({sort_expr}, rowid) {op} (?, ?)', [sort_value, rowid])
+        else:
+            value_range = (f'{sort_expr} IS NOT NULL', [])
+
+        #NULLs come before the values ascending and after them descending. Skip the ranges the cursor is past
+        ranges = [value_range, null_range] if descending else [null_range, value_range]
+        if cursor is not None and in_nulls == descending:
+            ranges = ranges[1:]
+
+    select = ', '.join(_quote(c) for c in columns) if columns else '*'
+    frames, remaining = [], int(limit) + 1
+    with db_connection() as con:
+        if not _table_exists(con, USERS_TABLE):
+            raise FileNotFoundError(f'No database found at {DB_PATH}. Run create_database() first.')
+
+        for condition, range_params in ranges:
+            conditions = ([f'({where})'] if where else []) + ([condition] if condition else [])
+            sql = f'SELECT rowid AS _rowid, {sort_expr} AS _sort_value, {select} FROM {USERS_TABLE}'
+            if conditions:
+                sql += ' WHERE ' + ' AND '.join(conditions)
+            sql += f' ORDER BY {sort_expr} {direction}, rowid {direction} LIMIT {remaining}'
+            frames.append(pd.read_sql_query(sql, con, params = list(params) + range_params))
+            remaining -= len(frames[-1])
+            if remaining <= 0:
+                break
+
+    df = pd.concat([frame for frame in frames if len(frame) > 0] or frames[:1], ignore_index = True)
+    next_cursor = None
+    if len(df) > limit:
+        df = df.iloc[:limit]
+        last = df.iloc[-1]
+        next_cursor = base64.urlsafe_b64encode(json.dumps([_to_sql_value(last['_sort_value']), int(last['_rowid'])]).encode()).decode()
+
+    df = df.drop(columns = ['_rowid', '_sort_value'])
+    return _convert_bool_columns(df), next_cursor
+
+def _load_cached_users():
+    ''' The whole users table, cached in memory until the database version changes '''
+    with _database_cache_lock:
+        with db_connection() as con:
+            if not _table_exists(con, USERS_TABLE):
+                raise FileNotFoundError(f'No database found at {DB_PATH}. Run create_database() first.')
+
+            version = (DB_PATH, _get_database_version(con))
+            if _database_cache.get('version') != version:
+                with metrics.timer('db_load_seconds', source = 'full_read'):
+                    df = pd.read_sql_query(f'SELECT * FROM {USERS_TABLE} ORDER BY rowid', con)
+                    _database_cache['df'] = _convert_bool_columns(df)
+                _database_cache['version'] = version
+
+        return _database_cache['df']
+
+def count_database(where = None, params = ()):
+    ''' Number of users matching a SQL filter. Cached until the database changes, the review table asks for it
+    on every first page '''
+    sql = f'SELECT COUNT(*) FROM {USERS_TABLE}' + (f' WHERE {where}' if where else '')
+    key = (sql, tuple(params))
+    with db_connection() as con:
+        version = (DB_PATH, _get_database_version(con))
+        with _database_cache_lock:
+            if _count_cache.get('version') != version:
+                _count_cache.clear()
+                _count_cache['version'] = version
+            if key in _count_cache:
+                return _count_cache[key]
+
+        count = con.execute(sql, params).fetchone()[0]
+        with _database_cache_lock:
+            if _count_cache.get('version') == version:
+                _count_cache[key] = count
+        return count
+
+def save_database(df, table = USERS_TABLE):
+    ''' Replace the contents of a database table with df and rebuild its indexes. '''
+    with metrics.timer('db_write_seconds', op = 'save'), db_connection() as con:
+        df.to_sql(table, con, if_exists = 'replace', index = False)
+        _create_indexes(con, table)
+        _bump_database_version(con)
+    metrics.inc('db_rows_written_total', len(df), op = 'save')
+
+def append_database(df, table = USERS_TABLE):
+    ''' Insert the rows of df into a database table, creating the table if needed. '''
+    if len(df) == 0:
+        return
+
+    with metrics.timer('db_write_seconds', op = 'append'), db_connection() as con:
+        df.to_sql(table, con, if_exists = 'append', index = False)
+        _create_indexes(con, table)
+        _bump_database_version(con)
+    metrics.inc('db_rows_written_total', len(df), op = 'append')
+
+def database_exists():
+    with db_connection() as con:
+        return _table_exists(con, USERS_TABLE)
+
+def drop_database(followings = False):
+    ''' Delete all scraped users and scrape checkpoints. Snapshots are kept.
+
+    followings {bool} -- Also delete the scraped followings, ie. the followings graph and clusters
+    '''
+    tables = [USERS_TABLE, SCRAPE_STATE_TABLE]
+    if followings:
+        tables += [FOLLOWINGS_TABLE, ACCOUNTS_TABLE, EDGES_TABLE]
+
+    with db_connection() as con:
+        for table in tables:
+            con.execute(f'DROP TABLE IF EXISTS {table}')
+        _bump_database_version(con)
+        if followings:
+            _bump_database_version(con, 'edges_version')
+
+def get_existing_user_ids(ids):
+    ''' Return the subset of ids that are already in the users table. Uses the id index, no full scan. '''
+    ids = [_to_sql_value(x) for x in ids]
+    with db_connection() as con:
+        if not ids or not _table_exists(con, USERS_TABLE):
+            return set()
+        placeholders = ', '.join('?' * len(ids))
+        rows = con.execute(f'SELECT id FROM {USERS_TABLE} WHERE id IN ({placeholders})', ids).fetchall()
+
+    # match the type of the ids passed in, SQLite may hand back str vs int
+    found = {str(r[0]) for r in rows}
+    return {x for x in ids if str(x) in found}
+
+def load_scrape_state():
+    ''' Return the checkpoint of the last follower scrape as a dict, or None if there isn't one. '''
+    with db_connection() as con:
+        if not _table_exists(con, SCRAPE_STATE_TABLE):
+            return None
+        con.row_factory = sqlite3.Row
+        row = con.execute(f'SELECT * FROM {SCRAPE_STATE_TABLE} ORDER BY updated_at DESC LIMIT 1').fetchone()
+
+    return dict(row) if row is not None else None
+
+def save_scrape_state(username, mode, cursor, pages_done, complete):
+    with db_connection() as con:
+        con.execute(f'''CREATE TABLE IF NOT EXISTS {SCRAPE_STATE_TABLE} (
+            username TEXT PRIMARY KEY, mode TEXT, cursor TEXT, pages_done INTEGER, complete INTEGER, updated_at TEXT)''')
+        con.execute(f'INSERT OR REPLACE INTO {SCRAPE_STATE_TABLE} VALUES (?, ?, ?, ?, ?, ?)',
+            (username, mode, cursor, pages_done, int(complete), f'{datetime.datetime.now()}'))
+
+def update_database(df, columns, key = 'id'):
+    ''' Write columns of df back to the users table, matching rows on the key column.
+    Only the rows in df are touched, so pass in just the rows that changed.
+    Columns that don't exist in the table yet are added. '''
+    if isinstance(columns, str):
+        columns = [columns]
+    if len(df) == 0:
+        return
+
+    with metrics.timer('db_write_seconds', op = 'update'), db_connection() as con:
+        existing_columns = _table_columns(con, USERS_TABLE)
+        for column in columns:
+            if column not in existing_columns:
+                con.execute(f'ALTER TABLE {USERS_TABLE} ADD COLUMN {_quote(column)}')
+
+        assignments = ', '.join(f'{_quote(c)} = ?' for c in columns)
+        sql = f'UPDATE {USERS_TABLE} SET {assignments} WHERE {_quote(key)} = ?'
+        values = [[_to_sql_value(v) for v in df[c].tolist()] for c in columns + [key]]
+        con.executemany(sql, zip(*values))
+        _bump_database_version(con)
+    metrics.inc('db_rows_written_total', len(df), op = 'update')
+
+@contextmanager
+def db_connection():
+    ''' Open a connection to the SQLite database. Commits on success, rolls back on error, always closes. '''
+    global _legacy_csv_checked
+
+    with closing(sqlite3.connect(DB_PATH, timeout = 30)) as con:
+        with con:
+            if not _legacy_csv_checked:
+                _import_legacy_csv(con)
+                for table in TABLE_INDEXES:
+                    if _table_exists(con, table):
+                        _create_indexes(con, table)
+                _import_followings_column(con)
+                _legacy_csv_checked = True
+            yield con
+
+def scrape_all_db_followers(authenticated_app = None, pages:int = 10, progress_callback = None, cancel_event = None):
     ''' For user in the database from create_database() scrape which accounts they follow. Save results to second database.
 
-    authenticated_app {tweety session} -- Pass in an authenticated Tweety session object here. 
-                                        Default value creates new session object.
+    authenticated_app {tweety session or list} -- Pass in one or more authenticated Tweety session objects here,
+                                        or ScrapingSession objects to keep their rate limit budget across calls.
+                                        Default value logs in every account in config.SCRAPING_ACCOUNT_USERNAME
+                                        and config.EXTRA_SCRAPING_ACCOUNTS.
     pages {int}  -- Number of pages of followers to get for each user. 1 page is approximately 50-60 user acounts
-    delay_for_rate_limit {int} -- Number of seconds between each call to get_user_followings(). 
-                                Per docs, every method has rate limit as low as 50 requests per 15 minutes.
-                                https://github.com/mahrtayyab/tweety/wiki/FAQs#twitter-new-limits
+    progress_callback {function} -- Called as progress_callback(users_done, total_users, message) after each user
+    cancel_event {threading.Event} -- Stop early when it's set, ie. the job was cancelled. Saved followings are kept
+
+    Work is spread across all sessions. Each session gets its own rate limit budget of
+    config.SCRAPING_RATE_LIMIT_REQUESTS requests per config.SCRAPING_RATE_LIMIT_PERIOD_SEC, with backoff on errors.
+    Per docs, every method has rate limit as low as 50 requests per 15 minutes.
+    https://github.com/mahrtayyab/tweety/wiki/FAQs#twitter-new-limits
     '''
-    
-    if authenticated_app is None:
-        authenticated_app = Twitter("session")
-        try:
-            authenticated_app.connect() #use previous session
-            print('Logging in using previous session.')
-        except:
-            #login with new session
-            authenticated_app.sign_in(config.SCRAPING_ACCOUNT_USERNAME, config.SCRAPING_ACCOUNT_PASSWORD)
-            print('Logging in using saved username / password.')
 
-    df = load_database()
+    if authenticated_app is None:
+        authenticated_app = login_all_scraping_accounts()
+    apps = authenticated_app if isinstance(authenticated_app, list) else [authenticated_app]
+    sessions = [app if isinstance(app, ScrapingSession) else ScrapingSession(app, name = f'session_{i}') for i, app in enumerate(apps)]
 
-    if 'followings' not in df.columns:
-        df['followings'] = '[]'
+    df = load_database(columns = ['username', 'protected'])
 
-    df_list = []
+    #can't scrape followers for protected users
+    usernames = [row.username for row in df.itertuples() if row.protected != True]
 
-    error_count, error_limit = 0, 5
+    def fetch(app, username):
+        return app.get_user_followings(username, pages = pages, wait_time = 2)
 
-    with tqdm(total=len(df)) as pbar:
+    failed = 0
+    with tqdm(total=len(usernames)) as pbar:
 
-        for row in df.itertuples():
+        for username, users, error in run_scrape_jobs(sessions, usernames, fetch, requests_per_item = pages,
+                                                           cancel_event = cancel_event):
 
             #update progressbar
-            pbar.update(row.Index)
-            pbar.set_description(f"Scraping follower data for user {row.Index}/{len(df)}: @{row.username}")
-
-            if row.protected == True: #can't scrape followers for protected users
+            pbar.update(1)
+            pbar.set_description(f"Scraped follower data for @{username}")
+            if progress_callback is not None:
+                progress_callback(pbar.n, len(usernames), f'Scraped follower data for @{username}')
+
+            if error is not None:
+                #if we can't fetch data after retrying, move on to the next user
+                print(f'Error fetching user data for @{username} -- continuing to next user. Error: {error}')
+                failed += 1
                 continue
 
-            try:
-                users = authenticated_app.get_user_followings(row.username, pages = pages, wait_time = 2)
-            except Exception as e:
-                #if we can't fetch data, try next user. If we failed too many times, stop fetching and save data.
-                error_count += 1
-                if error_count >= error_limit:
-                    print(f'Error limit exceeded, saving data and exiting. Error fetching user data for @{row.username} Error: {e}')
-                    break
-                else:
-                    print(f'Error fetching user data for @{row.username} -- continuing to next user. Error: {e}')
-                    continue
+            #save this user's followings right away, so progress isn't lost if we crash later
+            save_followings(username, [user.username for user in users])
+
+    print(f'Scraped followings of {pbar.n - failed} / {len(usernames)} users ({failed} failed) with {len(sessions)} sessions')
+
+def save_followings(username, followings):
+    ''' Replace the saved followings of username with the list of usernames they follow '''
+    with db_connection() as con:
+        _create_edges_tables(con)
+        follower_id = _get_account_ids(con, [username])[0]
+        followee_ids = _get_account_ids(con, followings)
 
-            follower_attributes = [
-                'username', 'id', 'description', 'location','statuses_count', 
-                'followers_count', 'friends_count', 'protected','verified']
+        con.execute(f'DELETE FROM {EDGES_TABLE} WHERE follower_id = ?', (follower_id,))
+        con.executemany(f'INSERT OR IGNORE INTO {EDGES_TABLE} VALUES (?, ?)', ((follower_id, i) for i in followee_ids))
+        _bump_database_version(con, 'edges_version')
 
-            df_user = list_of_users_to_dataframe(users, user_attributes = follower_attributes)
-            df_user['followed_by_username'] = row.username
+def load_followings_edges():
+    ''' Load the followings graph as numpy arrays, memory mapped from the .npy files in EDGES_DIR.
 
-            df.loc[row.Index,['followings']] = str(list(df_user['username']))
+    Returns (follower_ids, followee_ids, account_names):
+        follower_ids, followee_ids {int64 arrays} -- One entry per edge, sorted by follower id, then followee id
+        account_names {str array} -- account_names[account_id] is the username of the account
+    '''
+    version_path = os.path.join(EDGES_DIR, 'version.json')
+    with db_connection() as con:
+        version = _get_database_version(con, 'edges_version')
 
-            df_list.append(df_user)
+        exported_version = None
+        if os.path.exists(version_path):
+            with open(version_path, 'r') as file:
+                exported_version = json.load(file)['version']
 
-            time.sleep(delay_sec_for_rate_limit)
+        if exported_version != version:
+            _export_edges(con, version, version_path)
 
+    return tuple(np.load(os.path.join(EDGES_DIR, f'{name}.npy'), mmap_mode = 'r')
+                 for name in ['follower_ids', 'followee_ids', 'account_names'])
 
-    #save follower connections into db
-    df.to_csv(DB_CSV_PATH, index = False, sep=CSV_DELIMITER)
+def get_followings_version():
+    ''' Number that changes every time followings are saved, for caching results computed from them '''
+    with db_connection() as con:
+        return (DB_PATH, _get_database_version(con, 'edges_version'))
 
-    #save all followings to CSV "database" - this is just for reference right now
-    followings_df = pd.concat(df_list, ignore_index = True)
-    followings_df.to_csv(DB_FOLLOWINGS_PATH, index = False, sep=CSV_DELIMITER)
+def get_database_version():
+    ''' Number that changes every time the users table is written, same as get_followings_version() '''
+    with db_connection() as con:
+        return (DB_PATH, _get_database_version(con))
 
 #------------------------------------
 # Helper functions
 #------------------------------------
 
-def list_of_users_to_dataframe(users, user_attributes = None, replace_emojis = False):
-
-    if user_attributes is None:
-        user_attributes = [
-            'username', 'name', 'id', 'created_at', 'description', 'location',
-            'followed_by','following', 
-            'statuses_count', 'followers_count', 'friends_count','subscriptions_count',
-            'profile_banner_url','profile_image_url_https',
-            'favourites_count', 'protected','verified'
-            ]
+def login_scraping_account(username, password, session_name = 'session', client_factory = Twitter, fresh = False):
+    ''' Log in to a scraping account with Tweety, reusing the saved session if there is one
 
-    db_buffer = {attribute:[] for attribute in user_attributes}
+    client_factory {class} -- Called as client_factory(session_name) to make the client, ie. fake_twitter.FakeTwitter
+    fresh {bool} -- Always sign in with username / password, ie. when the saved session expired
+    '''
+    authenticated_app = client_factory(session_name)
+    try:
+        if fresh:
+            raise RuntimeError('Fresh login requested')
+        authenticated_app.connect() #use previous session
+        print(f'Logging in using previous session: {session_name}')
+    except:
+        #login with new session
+        authenticated_app.sign_in(username, password)
+        print(f'Logging in using saved username / password: {session_name}')
+
+    return authenticated_app
+
+def login_all_scraping_accounts():
+    ''' Log in to the main scraping account + config.EXTRA_SCRAPING_ACCOUNTS. Skips accounts that fail to log in. '''
+    apps = [login_scraping_account(config.SCRAPING_ACCOUNT_USERNAME, config.SCRAPING_ACCOUNT_PASSWORD)]
+
+    for username, password in config.EXTRA_SCRAPING_ACCOUNTS:
+        try:
+            apps.append(login_scraping_account(username, password, session_name = f'session_{username}'))
+        except Exception as e:
+            print(f'Failed to log in scraping account @{username}, skipping it. Error: {e}')
+
+    return apps
+
+def _quote(identifier):
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+def _to_sql_value(val):
+    ''' sqlite3 can't bind NaN / numpy scalars, convert them to python values '''
+    if val is None or (isinstance(val, float) and val != val):
+        return None
+    if hasattr(val, 'item'):
+        return val.item()
+    return val
+
+def _get_database_version(con, key = 'version'):
+    con.execute(f'CREATE TABLE IF NOT EXISTS {DB_META_TABLE} (key TEXT PRIMARY KEY, value INTEGER)')
+    row = con.execute(f"SELECT value FROM {DB_META_TABLE} WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else 0
+
+def _bump_database_version(con, key = 'version'):
+    ''' Call in the same transaction as any write to the users table, invalidates cached DataFrames in every process.
+    key 'edges_version' is the same for the followings edges table, invalidates the exported .npy files '''
+    con.execute(f'CREATE TABLE IF NOT EXISTS {DB_META_TABLE} (key TEXT PRIMARY KEY, value INTEGER)')
+    con.execute(f"INSERT INTO {DB_META_TABLE} VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1", (key,))
+
+def _convert_bool_columns(df):
+    ''' SQLite stores booleans as 0/1 '''
+    for column in BOOL_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column] == 1
+    return df
 
-    for user in users:
+def _table_exists(con, table):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+def _table_columns(con, table):
+    return [r[1] for r in con.execute(f'PRAGMA table_info({_quote(table)})')]
+
+def _create_indexes(con, table):
+    columns = _table_columns(con, table)
+    for column in TABLE_INDEXES.get(table, []):
+        if column in columns:
+            con.execute(f'CREATE INDEX IF NOT EXISTS {_quote(f"idx_{table}_{column}")} ON {_quote(table)} ({_quote(column)})')
+
+def _import_legacy_csv(con):
+    ''' One time migration of the old db.csv / followings.csv files into SQLite '''
+    for table, csv_path in [(USERS_TABLE, DB_CSV_PATH), (FOLLOWINGS_TABLE, DB_FOLLOWINGS_PATH)]:
+        if os.path.exists(csv_path) and not _table_exists(con, table):
+            print(f'Importing legacy CSV database {csv_path} into {DB_PATH}')
+            pd.read_csv(csv_path, sep = CSV_DELIMITER).to_sql(table, con, index = False)
+            _create_indexes(con, table)
+            _bump_database_version(con)
+
+def _create_edges_tables(con):
+    con.execute(f'CREATE TABLE IF NOT EXISTS {ACCOUNTS_TABLE} (account_id INTEGER PRIMARY KEY, username TEXT UNIQUE)')
+    con.execute(f'''CREATE TABLE IF NOT EXISTS {EDGES_TABLE} (
+        follower_id INTEGER, followee_id INTEGER, PRIMARY KEY (follower_id, followee_id)) WITHOUT ROWID''')
+
+def _get_account_ids(con, usernames):
+    ''' Integer account id of each username, adding accounts that aren't in the accounts table yet '''
+    usernames = [str(username) for username in usernames]
+    con.executemany(f'INSERT OR IGNORE INTO {ACCOUNTS_TABLE} (username) VALUES (?)', ((u,) for u in usernames))
+
+    ids = {}
+    unique_usernames = list(dict.fromkeys(usernames))
+    for start in range(0, len(unique_usernames), 900): # SQLite limit on number of ? per query
+        chunk = unique_usernames[start:start + 900]
+        placeholders = ', '.join('?' * len(chunk))
+        ids.update(con.execute(f'SELECT username, account_id FROM {ACCOUNTS_TABLE} WHERE username IN ({placeholders})', chunk))
+    return [ids[u] for u in usernames]
+
+def _export_edges(con, version, version_path):
+    ''' Write the edges + account names to .npy files for load_followings_edges() '''
+    _create_edges_tables(con)
+    num_edges = con.execute(f'SELECT COUNT(*) FROM {EDGES_TABLE}').fetchone()[0]
+    edges = np.fromiter(
+        (x for edge in con.execute(f'SELECT follower_id, followee_id FROM {EDGES_TABLE} ORDER BY follower_id, followee_id') for x in edge),
+        dtype = np.int64, count = num_edges * 2).reshape(-1, 2)
+
+    num_accounts = con.execute(f'SELECT COALESCE(MAX(account_id), 0) FROM {ACCOUNTS_TABLE}').fetchone()[0] + 1
+    account_names = [''] * num_accounts
+    for account_id, username in con.execute(f'SELECT account_id, username FROM {ACCOUNTS_TABLE}'):
+        account_names[account_id] = username
+
+    # graphs can be generated in several processes at once, write to temporary files so no one loads a half written file
+    os.makedirs(EDGES_DIR, exist_ok = True)
+    arrays = {'follower_ids': np.ascontiguousarray(edges[:, 0]), 'followee_ids': np.ascontiguousarray(edges[:, 1]),
+              'account_names': np.array(account_names, dtype = str)}
+    for name, array in arrays.items():
+        temp_path = os.path.join(EDGES_DIR, f'{name}.{os.getpid()}.tmp.npy')
+        np.save(temp_path, array)
+        os.replace(temp_path, os.path.join(EDGES_DIR, f'{name}.npy'))
+
+    temp_path = f'{version_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump({'version': version}, file)
+    os.replace(temp_path, version_path)
+
+def _import_followings_column(con):
+    ''' One time migration of the old users.followings column (stringified python lists) into the edges table '''
+    if (not _table_exists(con, USERS_TABLE) or _table_exists(con, EDGES_TABLE)
+            or 'followings' not in _table_columns(con, USERS_TABLE)):
+        return
+
+    print('Moving followings into the followings edges table')
+    _create_edges_tables(con)
+    rows = con.execute(f'SELECT username, followings FROM {USERS_TABLE} WHERE followings IS NOT NULL').fetchall()
+    for username, followings in rows:
         try:
-            for attribute in user_attributes:
-                val = user.__getattribute__(attribute)
-                
-                #remove commas from any strings for CSV - we don't need this if we're using a real database
-                if isinstance(val, str):
-                    val = val.replace(CSV_DELIMITER,' ')
-
-                    if replace_emojis: # emoji ---> emoji short-text
-                        val = emoji.demojize(val)
-                        #val = val.encode('unicode-escape') # emoji ---> \U181237347 (unicode escape)
-                
-                if val is not None and attribute == 'description':
-                    if not isinstance(val, str):
-                        val = str(val)
-                    val = val.replace('\n', ' ').replace('\r', ' ')
-
-                db_buffer[attribute].append(val)
+            followings = ast.literal_eval(followings)
+        except (ValueError, SyntaxError):
+            print(f'Could not read saved followings of @{username}, scrape them again. Value: {followings[:100]}')
+            continue
+        if followings:
+            follower_id = _get_account_ids(con, [username])[0]
+            con.executemany(f'INSERT OR IGNORE INTO {EDGES_TABLE} VALUES (?, ?)',
+                ((follower_id, i) for i in _get_account_ids(con, followings)))
+
+    try:
+        con.execute(f'ALTER TABLE {USERS_TABLE} DROP COLUMN followings')
+    except sqlite3.OperationalError: # SQLite older than 3.35, the column just stays unused
+        pass
+    _bump_database_version(con)
+    _bump_database_version(con, 'edges_version')
+
+def _flush_user_buffer(buffer, buffered_ids):
+    df = buffer.to_dataframe()
+    df['flags'] = ''
+    append_database(df)
+    buffer.clear()
+    buffered_ids.clear()
 
-        except Exception as e:
-            print(str(e))
+def list_of_users_to_dataframe(users, user_attributes = None, replace_emojis = False):
+    ''' Typed DataFrame of a list of Tweety users, one column per attribute. See user_columns.USER_COLUMN_TYPES '''
+    buffer = UserColumnBuffer(user_attributes or USER_ATTRIBUTES, replace_emojis = replace_emojis)
+    buffer.extend(users)
 
-    df = pd.DataFrame(db_buffer)
+    df = buffer.to_dataframe()
     df['flags'] = '' #add empty column "flags"
 
     return df
 
 if __name__ == "__main__":
-    scrape_all_db_followers()
-
-    quit()
-
     import argparse
 
     parser = argparse.ArgumentParser()
@@ -175,9 +684,16 @@ if __name__ == "__main__":
         help='The @username of the account you want to scrape all follower data for. Default config.MAIN_ACCOUNT_USERNAME')
     parser.add_argument('-p','--pages', type=int, default=10,
         help='Number of pages of followers to load. About 50-60 users per page')
+    parser.add_argument('--fresh', action = 'store_true',
+        help='Delete the scraped followers and scrape from page 1 instead of resuming / only fetching new followers. Scraped followings are kept')
+    parser.add_argument('--followings', action = 'store_true',
+        help='Instead of scraping followers, scrape who each follower in the database follows. --pages is pages per follower')
     args = parser.parse_args()
 
-    create_database(args.user, pages = args.pages) #ex. create_database('elonmusk', pages = 5)
+    if args.followings:
+        scrape_all_db_followers(pages = args.pages)
+    else:
+        create_database(args.user, pages = args.pages, fresh = args.fresh) #ex. create_database('elonmusk', pages = 5)
 
     #df = load_database(usecols = ['username', 'name', 'id', 'location'])
     #pd.options.display.width = 0 #So Pandas autodetects the size of your terminal window
@@ -0,0 +1,128 @@
+''' Block / force unfollow many users at once, ie. every flagged follower.
+
+Actions go through the same rate limited scheduler as scraping (scrape_scheduler.run_scrape_jobs) with retries
+and backoff, using the main account's pooled rate limit bucket (session_pool.main_session()) so every job and the
+health checks share 1 budget. Every result is saved in the user_actions table, so users that were already actioned
+are skipped and an interrupted run continues where it stopped when it's started again.
+'''
+import datetime
+
+from build_database import db_connection, load_database
+from scrape_scheduler import is_rate_limit_error, run_scrape_jobs
+
+ACTIONS_TABLE = 'user_actions'
+ACTIONS = ('block', 'force_unfollow')
+
+# twitter requests used by each action
+ACTION_REQUESTS = {'block': 1, 'force_unfollow': 2}
+
+def perform_action(authenticated_app, action, username):
+    ''' Block or force unfollow (block + unblock) a single user '''
+    if action == 'block':
+        authenticated_app.block_user(username)
+    elif action == 'force_unfollow':
+        authenticated_app.block_user(username)
+        authenticated_app.unblock_user(username)
+    else:
+        raise ValueError(f'Unknown action {action}, must be one of {ACTIONS}')
+
+def perform_single_action(session, action, username, timeout = None):
+    ''' perform_action() on 1 user with the session's rate limit bucket and save the result, for the review page buttons.
+    Returns False without doing anything if the rate limit budget doesn't free up within timeout seconds '''
+    if session.bucket.acquire(ACTION_REQUESTS[action], timeout = timeout) is None:
+        return False
+
+    try:
+        perform_action(session.app, action, username)
+    except Exception as e:
+        if is_rate_limit_error(e):
+            session.bucket.pause(getattr(e, 'retry_after', None) or session.bucket.period_sec, drain = True)
+        save_action_result(username, action, 'failed', e)
+        raise
+
+    save_action_result(username, action, 'done')
+    return True
+
+def run_bulk_action(session, action, usernames, progress_callback = None, cancel_event = None):
+    ''' Perform action on every user in usernames, skipping users it was already done for.
+    Force unfollow skips users that were blocked, it would unblock them.
+
+    Arguments:
+    session {scrape_scheduler.ScrapingSession} -- Logged in main account with its rate limit bucket, see session_pool.main_session()
+    action {str} -- 'block' or 'force_unfollow'
+    usernames {list} -- Usernames to perform the action on
+    progress_callback {function} -- Called as progress_callback(users_done, total_users, message) after each user
+    cancel_event {threading.Event} -- Stop early when it's set. Users not done yet stay pending for the next run
+
+    Returns dict with number of users done / skipped / failed, and blocked: users force unfollow skipped for being blocked
+    '''
+    if action not in ACTIONS:
+        raise ValueError(f'Unknown action {action}, must be one of {ACTIONS}')
+
+    usernames = list(dict.fromkeys(usernames))
+    already_done = get_actioned_usernames(action)
+    # force unfollow is block + unblock, it would undo an earlier block
+    blocked_usernames = get_actioned_usernames('block') if action == 'force_unfollow' else set()
+    blocked = [username for username in usernames if username in blocked_usernames and username not in already_done]
+    todo = [username for username in usernames if username not in already_done and username not in blocked_usernames]
+    print(f'{action}: {len(todo)} users to do, skipping {len(usernames) - len(todo) - len(blocked)} already done')
+    if blocked:
+        print(f'WARNING {action}: skipping {len(blocked)} blocked users, force unfollow would unblock them: {", ".join(blocked[:10])}')
+
+    with db_connection() as con:
+        _create_actions_table(con)
+        con.executemany(f'''INSERT OR IGNORE INTO {ACTIONS_TABLE} (username, action, status, attempts, updated_at)
+            VALUES (?, ?, 'pending', 0, ?)''', ((username, action, _now()) for username in todo))
+
+    def act(app, username):
+        perform_action(app, action, username)
+
+    counts = {'done': 0, 'skipped': len(usernames) - len(todo) - len(blocked), 'failed': 0, 'blocked': len(blocked)}
+    for username, _, error in run_scrape_jobs([session], todo, act, requests_per_item = ACTION_REQUESTS[action],
+                                                 cancel_event = cancel_event):
+        status = 'done' if error is None else 'failed'
+        counts[status] += 1
+        save_action_result(username, action, status, error)
+
+        if progress_callback is not None:
+            progress_callback(counts['done'] + counts['failed'], len(todo), f'{action} @{username}: {status}')
+
+    print(f'{action}: {counts["done"]} done, {counts["failed"]} failed, {counts["skipped"]} skipped. {session}')
+    return counts
+
+def save_action_result(username, action, status, error = None):
+    ''' Record the outcome of an action on a user in the action log '''
+    with db_connection() as con:
+        _create_actions_table(con)
+        con.execute(f'''INSERT INTO {ACTIONS_TABLE} (username, action, status, attempts, error, updated_at)
+            VALUES (?, ?, ?, 1, ?, ?)
+            ON CONFLICT (username, action) DO UPDATE SET
+                status = excluded.status, attempts = attempts + 1, error = excluded.error, updated_at = excluded.updated_at''',
+            (username, action, status, None if error is None else f'{type(error).__name__}: {error}', _now()))
+
+def get_actioned_usernames(action):
+    ''' Set of usernames action was already done for '''
+    with db_connection() as con:
+        _create_actions_table(con)
+        rows = con.execute(f"SELECT username FROM {ACTIONS_TABLE} WHERE action = ? AND status = 'done'", (action,))
+        return {username for username, in rows}
+
+def get_flagged_usernames():
+    ''' Usernames of every currently flagged user '''
+    try:
+        df = load_database(columns = ['username'], where = "flags IS NOT NULL AND flags NOT IN ('', 'no_flag')")
+    except FileNotFoundError:
+        return []
+    return df['username'].tolist()
+
+#------------------------------------
+# Helper functions
+#------------------------------------
+
+def _create_actions_table(con):
+    con.execute(f'''CREATE TABLE IF NOT EXISTS {ACTIONS_TABLE} (
+        username TEXT, action TEXT, status TEXT, attempts INTEGER, error TEXT, updated_at TEXT,
+        PRIMARY KEY (username, action))''')
+
+def _now():
+    return f'{datetime.datetime.now()}'
@@ -7,12 +7,79 @@
 SCRAPING_ACCOUNT_USERNAME = 'YOUR_SCRAPING ACCOUNT_USERNAME'
 SCRAPING_ACCOUNT_PASSWORD = 'YOUR_SCRAPING_ACCOUNT_PASSWORD'
 
+# [OPTIONAL] More scraping accounts, as a list of (username, password) tuples.
+# Scraping followings for network graphs is spread across all scraping accounts, each with its own rate limit,
+# so every account added here speeds it up.
+EXTRA_SCRAPING_ACCOUNTS = []
+
 # Main account will only be used to handle the block / unblocking functions and won't be used for scraping data.
 MAIN_ACCOUNT_USERNAME = ''
 MAIN_ACCOUNT_PASSWORD = ''
 
 
 
+#--------------------------------------------------------------------------------
+# PARAMS FOR SCRAPING
+#--------------------------------------------------------------------------------
+
+# Rate limit budget for each scraping account. Per tweety docs, every method has rate limit as low as 50 requests per 15 minutes
+# https://github.com/mahrtayyab/tweety/wiki/FAQs#twitter-new-limits
+SCRAPING_RATE_LIMIT_REQUESTS = 50
+SCRAPING_RATE_LIMIT_PERIOD_SEC = 15 * 60
+
+# Rate limit budget for the main account when blocking / force unfollowing users in bulk.
+# A force unfollow uses 2 requests (block + unblock)
+ACTION_RATE_LIMIT_REQUESTS = 50
+ACTION_RATE_LIMIT_PERIOD_SEC = 15 * 60
+
+# The web server logs in the main account + up to SESSION_POOL_SIZE scraping accounts once on startup and lends the
+# sessions out to scrape jobs, instead of logging in for every scrape. Idle sessions are checked every
+# SESSION_HEALTH_CHECK_INTERVAL_SEC (1 request each) and logged in again when they've expired.
+SESSION_POOL_SIZE = 5
+SESSION_HEALTH_CHECK_INTERVAL_SEC = 30 * 60
+
+# Log in with fake_twitter.FakeTwitter instead of Tweety: synthetic followers, no network or Twitter account needed.
+# For trying out the dashboard / testing only
+USE_FAKE_TWITTER = False
+
+
+
+#--------------------------------------------------------------------------------
+# PARAMS FOR THE WEB UI
+#--------------------------------------------------------------------------------
+
+# Number of scrape / flag jobs that can run at the same time in the background
+JOB_WORKERS = 2
+
+# On shutdown running jobs are stopped (they're restarted from their checkpoints on the next startup).
+# Wait at most JOB_SHUTDOWN_TIMEOUT_SEC for them to stop
+JOB_SHUTDOWN_TIMEOUT_SEC = 10
+
+# Slow requests (network graph, snapshot diffs) run outside the web server's event loop so other pages stay responsive.
+# Graphs are generated in a pool of HEAVY_REQUEST_PROCESSES processes. At most HEAVY_REQUEST_CONCURRENCY slow requests run
+# at once, and they give up after HEAVY_REQUEST_TIMEOUT_SEC - a graph keeps generating and is cached for the next request
+HEAVY_REQUEST_PROCESSES = 2
+HEAVY_REQUEST_CONCURRENCY = 2
+HEAVY_REQUEST_TIMEOUT_SEC = 120
+
+# Timings + counters for scraping, flagging, graphs and the database are always served at localhost:8000/metrics.
+# Set PROFILING_ENABLED = True to also save a cProfile of every background job and of requests made with ?profile=1
+# (ie. localhost:8000/api/graph?profile=1) to data/profiles
+PROFILING_ENABLED = False
+
+# Profile / banner images in the review table are fetched once through the server, shrunk to thumbnails
+# and cached in data/image_cache. Set IMAGE_PROXY_ENABLED = False to load them straight from Twitter instead
+IMAGE_PROXY_ENABLED = True
+IMAGE_CACHE_MAX_MB = 500 # least recently used thumbnails are deleted past this size
+IMAGE_THUMBNAIL_SIZES = {'avatar': (300, 300), 'banner': (450, 150)} # max width, height. Banners are shown at 450x150
+IMAGE_PROXY_ALLOWED_HOSTS = ['pbs.twimg.com', 'abs.twimg.com'] # only images from these hosts are proxied
+
+# Download thumbnails of every user in the background after each follower scrape, this many at a time
+IMAGE_PREFETCH_AFTER_SCRAPE = True
+IMAGE_PREFETCH_WORKERS = 8
+
+
+
 #--------------------------------------------------------------------------------
 # PARAMS FOR FLAGGING USERS
 #--------------------------------------------------------------------------------
@@ -40,6 +107,46 @@ NGRAM_CHECK_ENABLED = True
 
 
 
+#--------------------------------------------------------------------------------
+# PARAMS FOR GRAPH ANALYSIS
+#--------------------------------------------------------------------------------
+
+# How to compute follower similarity for the network graph
+# 'exact' -- exact Jaccard index, fine up to ~10k users
+# 'minhash' -- approximate MinHash + LSH, for tens of thousands of users. See minhash.py for the error bound
+GRAPH_SIMILARITY_METHOD = 'exact'
+
+# MinHash signature size, larger = more accurate but slower. Estimate std deviation is at most 0.5 / sqrt(MINHASH_NUM_PERM)
+MINHASH_NUM_PERM = 128
+
+# Users whose followings have a Jaccard index above this get an edge in the network graph.
+# MinHash LSH is only faster than exact from about 0.2 up (0.125 is the lowest it can do with MINHASH_NUM_PERM = 128,
+# see minhash.py), so 'minhash' uses MINHASH_WEIGHT_THRESH. Lower thresholds fall back to the exact method.
+GRAPH_WEIGHT_THRESH = 0.025
+MINHASH_WEIGHT_THRESH = 0.2
+
+# How to draw the network graph
+# 'webgl' -- WebGL, data is fetched separately from /api/graph. Labels show up when zoomed in. Handles tens of thousands of users
+# 'svg' -- the original plotly SVG plot with every label, gets laggy with a lot of users
+GRAPH_RENDER_MODE = 'webgl'
+
+# WebGL mode: with more than GRAPH_PRUNE_MIN_EDGES edges, only draw the GRAPH_MAX_EDGES_PER_NODE strongest edges of each user.
+# Set GRAPH_MAX_EDGES_PER_NODE to None to always draw every edge
+GRAPH_MAX_EDGES_PER_NODE = 10
+GRAPH_PRUNE_MIN_EDGES = 20000
+
+# Bot clusters: groups of users that follow nearly the same accounts. Users with a follower similarity above
+# CLUSTER_MIN_SIMILARITY are linked, and every group of at least CLUSTER_MIN_SIZE linked users is a cluster.
+# Clusters are colored in the network graph. To also flag members of clusters with at least CLUSTER_FLAG_MIN_SIZE users and
+# a mean similarity of at least CLUSTER_FLAG_MIN_MEAN_SIMILARITY, set CLUSTER_FLAG_MIN_SIZE (ie. 10). Off by default: flag runs
+# after the followings changed have to find the clusters again, which compares the followings of every pair of users
+CLUSTER_MIN_SIMILARITY = 0.5
+CLUSTER_MIN_SIZE = 3
+CLUSTER_FLAG_MIN_SIZE = None
+CLUSTER_FLAG_MIN_MEAN_SIMILARITY = 0.6
+
+
+
 #--------------------------------------------------------------------------------
 # DON'T CHANGE STUFF BELOW HERE - this is just to clean up user input
 #--------------------------------------------------------------------------------
@@ -0,0 +1,179 @@
+''' Local stand-in for the Tweety Twitter client. No network / login needed.
+
+Generates deterministic synthetic users and follow relationships, and simulates
+request latency and Twitter's per-account rate limits. Use it to try out or benchmark
+the scraping code without a live account, ex.
+
+    from fake_twitter import FakeTwitter
+    create_database('me', pages = 5, authenticated_app = FakeTwitter(num_followers = 500))
+'''
+import datetime
+import random
+import threading
+import time
+import zlib
+
+class RateLimitReached(Exception):
+    ''' Same name + retry_after attribute as tweety.exceptions.RateLimitReached '''
+    def __init__(self, retry_after):
+        super().__init__(f'You have exceeded the Twitter Rate Limit, retry after {retry_after:.1f} sec')
+        self.retry_after = retry_after
+
+class SessionExpired(Exception):
+    ''' Raised for every request after expire_session(), until sign_in() '''
+
+BOT_DESCRIPTIONS = ['dm me on whatsapp', '100% returns guaranteed', 'crypto signals', '']
+
+class FakeUser:
+    ''' Has the same attributes as a tweety User that list_of_users_to_dataframe() reads.
+    A bot_fraction of users look like bots: random usernames, brand new accounts, spammy bios, hardly any follows. '''
+    def __init__(self, user_num, seed = 0, bot_fraction = 0.0):
+        rnd = random.Random(f'{seed}-{user_num}')
+        self.id = str(10**9 + user_num)
+        self.username = rnd.choice(['bob', 'alice', 'news', 'crypto', 'dev', 'jim']) + str(user_num)
+        self.name = rnd.choice(['Bob', 'Alice', 'News Daily', 'Crypto King', 'Dev', 'Jim'])
+        self.created_at = datetime.datetime(2024, 1, 1) - datetime.timedelta(days = rnd.randint(0, 5000))
+        self.description = rnd.choice(['', 'hello world', 'he/him', 'dm me on whatsapp', 'software dev'])
+        self.location = rnd.choice(['', 'New York', 'London', 'Berlin', None])
+        self.followed_by = rnd.random() < 0.3
+        self.following = rnd.random() < 0.3
+        self.statuses_count = rnd.randint(0, 20000)
+        self.followers_count = rnd.randint(0, 5000)
+        self.friends_count = rnd.randint(0, 2000)
+        self.subscriptions_count = 0
+        self.profile_banner_url = None
+        self.profile_image_url_https = f'https://pbs.twimg.com/profile_images/{user_num}/img_normal.jpg'
+        self.favourites_count = rnd.randint(0, 10000)
+        self.protected = rnd.random() < 0.05
+        self.verified = rnd.random() < 0.01
+
+        if rnd.random() < bot_fraction:
+            self.username = ''.join(rnd.choices('abcdefghijklmnopqrstuvwxyz0123456789', k = 12))
+            self.created_at = datetime.datetime(2024, 1, 1) - datetime.timedelta(days = rnd.randint(0, 30))
+            self.description = rnd.choice(BOT_DESCRIPTIONS)
+            self.followers_count = rnd.randint(0, 50)
+            self.friends_count = rnd.randint(0, 2)
+            self.statuses_count = rnd.randint(0, 10)
+            self.verified = False
+
+class FakeResultPage:
+    ''' Stands in for tweety's UserFollowers / UserFollowings objects, only the cursor is used '''
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+class FakeTwitter:
+    def __init__(self, session_name = 'session', num_followers = 1000, num_accounts = 20000,
+                 followings_per_user = 100, users_per_page = 50, latency_sec = 0.0,
+                 rate_limit_requests = 50, rate_limit_period_sec = 15 * 60, error_rate = 0.0, bot_fraction = 0.0, seed = 0):
+        '''
+        num_followers {int} -- Number of followers every account has
+        num_accounts {int} -- Size of the pool of accounts that followings are drawn from
+        latency_sec {float} -- Simulated time per page request
+        rate_limit_requests, rate_limit_period_sec -- Raise RateLimitReached past this many page requests per period
+        error_rate {float} -- Fraction of requests that fail with a generic error
+        bot_fraction {float} -- Fraction of generated users that look like bots
+        '''
+        self.session_name = session_name
+        self.num_followers = num_followers
+        self.num_accounts = num_accounts
+        self.followings_per_user = followings_per_user
+        self.users_per_page = users_per_page
+        self.latency_sec = latency_sec
+        self.rate_limit_requests = rate_limit_requests
+        self.rate_limit_period_sec = rate_limit_period_sec
+        self.error_rate = error_rate
+        self.bot_fraction = bot_fraction
+        self.seed = seed
+
+        self.user = None
+        self.session_expired = False
+        self.request_count = 0
+        self.blocked = set()
+        self._request_times = []
+        self._lock = threading.Lock()
+        self._rnd = random.Random(seed)
+
+    #-----------------------
+    # Login
+    #-----------------------
+    def connect(self):
+        self.user = FakeUser(0, self.seed)
+        return self.user
+
+    def sign_in(self, username, password):
+        self.user = FakeUser(0, self.seed)
+        self.session_expired = False
+        return self.user
+
+    def expire_session(self):
+        ''' Simulate the login expiring: requests fail until sign_in() is called again '''
+        self.session_expired = True
+
+    #-----------------------
+    # Scraping
+    #-----------------------
+    def get_user_followers(self, username, pages = 1, wait_time = 2, cursor = None):
+        return [user for _, users in self.iter_user_followers(username, pages, wait_time, cursor) for user in users]
+
+    def iter_user_followers(self, username, pages = 1, wait_time = 2, cursor = None):
+        return self._iter_pages(range(self.num_followers), pages, cursor)
+
+    def get_user_followings(self, username, pages = 1, wait_time = 2, cursor = None):
+        return [user for _, users in self.iter_user_followings(username, pages, wait_time, cursor) for user in users]
+
+    def iter_user_followings(self, username, pages = 1, wait_time = 2, cursor = None):
+        rnd = random.Random(f'{self.seed}-followings-{username}')
+        user_nums = rnd.sample(range(self.num_accounts), min(self.followings_per_user, self.num_accounts))
+        return self._iter_pages(user_nums, pages, cursor)
+
+    def get_user_info(self, username):
+        self._request()
+        return FakeUser(zlib.crc32(str(username).encode()) % self.num_accounts, self.seed, self.bot_fraction)
+
+    #-----------------------
+    # Follower management
+    #-----------------------
+    def block_user(self, username):
+        self._request()
+        self.blocked.add(username)
+        return True
+
+    def unblock_user(self, username):
+        self._request()
+        self.blocked.discard(username)
+        return True
+
+    #-----------------------
+    # Simulation helpers
+    #-----------------------
+    def _iter_pages(self, user_nums, pages, cursor):
+        start = int(cursor) if cursor else 0
+        for _ in range(pages):
+            self._request()
+            page = user_nums[start:start + self.users_per_page]
+            if len(page) == 0:
+                return
+            start += len(page)
+            next_cursor = str(start) if start < len(user_nums) else None
+            yield FakeResultPage(next_cursor), [FakeUser(n, self.seed, self.bot_fraction) for n in page]
+            if next_cursor is None:
+                return
+
+    def _request(self):
+        ''' Count one API request: enforce the rate limit, sleep for latency, maybe fail '''
+        if self.session_expired:
+            raise SessionExpired('Session expired, sign in again')
+
+        with self._lock:
+            now = time.monotonic()
+            self._request_times = [t for t in self._request_times if now - t < self.rate_limit_period_sec]
+            if len(self._request_times) >= self.rate_limit_requests:
+                raise RateLimitReached(self.rate_limit_period_sec - (now - self._request_times[0]))
+            self._request_times.append(now)
+            self.request_count += 1
+            fail = self._rnd.random() < self.error_rate
+
+        if self.latency_sec:
+            time.sleep(self.latency_sec)
+        if fail:
+            raise ConnectionError('Simulated request failure')
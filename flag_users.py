@@ -1,13 +1,36 @@
 
 import pandas as pd
+import numpy as np
 import datetime
-import re
-
-import emoji                 #for handling emoji text
+import os
+import hashlib
+import inspect
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import nostril
 from nostril import nonsense #pip install git+https://github.com/casics/nostril.git
 
-from build_database import load_database, DB_CSV_PATH, CSV_DELIMITER, DB_TIMESTAMP_FILE
+import build_database
+from build_database import load_database, update_database, db_connection, get_followings_version, DB_TIMESTAMP_FILE
 import config
+import metrics
+from text_matcher import get_text_matcher
+
+# Cache of nostril nonsense() results per username, saved in the database.
+# Bump NGRAM_DETECTOR_VERSION when changing how the n-gram check works to throw away the cached results.
+NGRAM_DETECTOR_VERSION = '1'
+NONSENSE_CACHE_TABLE = 'nonsense_cache'
+nonsense_cache_stats = {'hits': 0, 'misses': 0}
+
+# Flag results per (user, flag function), with a hash of the user's fields the function reads and a version of
+# the function + the config it reads. Incremental flag runs only evaluate the pairs where either changed.
+FLAG_RESULTS_TABLE = 'flag_results'
+flag_run_stats = {}
+
+# Bot clusters found once by the parent process, set in flag worker processes. See _flag_process_pool()
+_worker_bot_clusters = None
 
 try:
     with open(DB_TIMESTAMP_FILE, 'r') as file:
@@ -15,139 +38,421 @@ try:
 except:
     DB_TIMESTAMP = datetime.datetime.now()
 
-def get_all_flagged_users(df):
-    flag_ids = []
-    flag_reasons = []
+def get_all_flagged_users(df, workers = 1, incremental = True):
+    ''' Run every flag function in FLAGGING_FUNCTIONS on df. Returns the index labels of flagged users and their flag reasons.
+
+    workers {int} -- Number of processes to split the flagging across. 1 runs in this process, 0 uses every CPU core.
+                     Helps with flag functions that can't be vectorized (n-gram check, custom row flag functions).
+    incremental {bool} -- Reuse the saved result of each flag function for users whose fields it reads didn't change,
+                          as long as the function and the config it reads didn't change either. See flag_inputs()
+    '''
+    # GREEN FLAGS
+    df = df[df['verified'] != True]
+
+    # RED FLAGS
+    if workers == 0:
+        workers = os.cpu_count()
+    with metrics.timer('flag_run_seconds', mode = 'incremental' if incremental else 'full'):
+        if incremental:
+            reasons = get_flag_reasons_incremental(df, workers)
+        elif workers > 1 and len(df) > 1:
+            reasons = get_flag_reasons_parallel(df, workers)
+        else:
+            reasons = get_flag_reasons(df)
+
+    flagged = reasons[reasons != '']
+    return list(flagged.index), list(flagged)
+
+def get_flag_reasons(df):
+    ''' Run every flag function on df, return a Series of ', ' joined reasons aligned to df.index '''
+    reasons = pd.Series('', index = df.index, dtype = object)
+
+    for flag_func in FLAGGING_FUNCTIONS:
+        with metrics.timer('flag_rule_seconds', rule = flag_func.__name__):
+            rule_reasons = run_flag(flag_func, df)
+        _count_flag_metrics(flag_func.__name__, len(df), rule_reasons)
+        reasons = join_reasons(reasons, rule_reasons)
+
+    return reasons
+
+def get_flag_reasons_incremental(df, workers = 1):
+    ''' Same as get_flag_reasons(), but each flag function only runs on the users whose inputs changed since the saved
+    result. Users are matched on the id column. Assumes a flag function's result for a user only depends on that user's row. '''
+    flag_run_stats.clear()
+    saved = _load_flag_results()
+    reasons = pd.Series('', index = df.index, dtype = object)
+    executor = None
+
+    try:
+        for flag_func in FLAGGING_FUNCTIONS:
+            rule = flag_func.__name__
+            input_hashes = _input_hashes(df, flag_func)
+            version = _rule_version(flag_func)
+
+            rule_saved = saved[saved['rule'] == rule].drop_duplicates('user_id').set_index('user_id')
+            rule_saved = rule_saved.astype({'input_hash': 'Int64'}).reindex(df['id'].astype(str))
+            hash_changed = (rule_saved['input_hash'] != input_hashes.to_numpy()).fillna(True).to_numpy(dtype = bool)
+            is_stale = hash_changed | (rule_saved['rule_version'].to_numpy() != version)
+
+            rule_reasons = pd.Series(rule_saved['reason'].fillna('').to_numpy(), index = df.index, dtype = object)
+            if is_stale.any():
+                stale_df = df[is_stale]
+                with metrics.timer('flag_rule_seconds', rule = rule):
+                    if workers > 1 and len(stale_df) > 1:
+                        if executor is None:
+                            executor = _flag_process_pool(workers)
+                        new_reasons = _run_flag_parallel(executor, flag_func, stale_df, workers)
+                    else:
+                        new_reasons = run_flag(flag_func, stale_df)
+
+                new_reasons = new_reasons.reindex(stale_df.index, fill_value = '').fillna('')
+                rule_reasons[is_stale] = new_reasons.to_numpy()
+                _save_flag_results(rule, stale_df['id'].astype(str), input_hashes[is_stale], version, new_reasons)
+
+            flag_run_stats[rule] = {'evaluated': int(is_stale.sum()), 'reused': int((~is_stale).sum())}
+            _count_flag_metrics(rule, int(is_stale.sum()), rule_reasons)
+            reasons = join_reasons(reasons, rule_reasons)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return reasons
+
+def get_flag_run_stats():
+    ''' Number of users each flag function was evaluated on / reused the saved result for in the last incremental run '''
+    return dict(flag_run_stats)
+
+def run_flag(flag_func, df):
+    ''' Run a column or row flag function on df, return a Series of reasons aligned to df.index '''
+    if getattr(flag_func, 'is_column_flag', False):
+        return flag_func(df)
+    return apply_row_flag(flag_func, df)
+
+def get_flag_reasons_parallel(df, workers):
+    ''' get_flag_reasons() on chunks of df in a process pool. Chunks are merged back in index order,
+    and the per rule metrics + nonsense() cache stats of each chunk are added to this process' ones. '''
+    num_chunks = min(len(df), workers * 4) # a few chunks per worker to even out the load
+    chunks = [df.iloc[positions] for positions in np.array_split(np.arange(len(df)), num_chunks)]
+
+    with _flag_process_pool(workers) as executor:
+        results = list(executor.map(_call_in_worker, [get_flag_reasons] * num_chunks, chunks))
+
+    return pd.concat(_merge_worker_stats(results)).reindex(df.index)
+
+def _count_flag_metrics(rule, num_evaluated, rule_reasons):
+    metrics.inc('flag_rule_evaluated_total', num_evaluated, rule = rule)
+    metrics.inc('flag_rule_flagged_total', int((rule_reasons != '').sum()), rule = rule)
+
+def _flag_process_pool(workers):
+    config_values = {name: getattr(config, name) for name in dir(config) if name.isupper()}
+    # find the bot clusters once here instead of in every chunk
+    bot_clusters = _load_bot_clusters() if flag_bot_cluster in FLAGGING_FUNCTIONS else None
+    # spawn, not fork: flag runs start from server job threads, forking them can copy locks another thread holds
+    return ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('spawn'),
+                               initializer = _init_flag_worker, initargs = (config_values, build_database.DB_PATH, DB_TIMESTAMP, bot_clusters))
+
+def _run_flag_parallel(executor, flag_func, df, workers):
+    ''' run_flag() on chunks of df in the process pool. Flag functions are sent by name, so they must be in FLAGGING_FUNCTIONS '''
+    num_chunks = min(len(df), workers * 4)
+    chunks = [df.iloc[positions] for positions in np.array_split(np.arange(len(df)), num_chunks)]
+    results = list(executor.map(_call_in_worker, [_run_flag_by_name] * num_chunks, [flag_func.__name__] * num_chunks, chunks))
+    return pd.concat(_merge_worker_stats(results)).reindex(df.index)
+
+def _run_flag_by_name(name, df):
+    flag_func = next(f for f in FLAGGING_FUNCTIONS if f.__name__ == name)
+    return run_flag(flag_func, df)
+
+def _call_in_worker(func, *args):
+    ''' Run func(*args) in a flag worker process. Returns (result, metrics, nonsense() cache stats) of just this call,
+    see _merge_worker_stats() '''
+    nonsense_cache_stats.update(hits = 0, misses = 0)
+    result, worker_metrics = metrics.call_with_metrics(func, *args)
+    return result, worker_metrics, dict(nonsense_cache_stats)
+
+def _merge_worker_stats(results):
+    ''' Add the metrics + nonsense() cache stats of _call_in_worker() results to this process, returns the results '''
+    for _, worker_metrics, worker_nonsense_stats in results:
+        metrics.merge(worker_metrics)
+        for key, value in worker_nonsense_stats.items():
+            nonsense_cache_stats[key] += value
+    return [result for result, _, _ in results]
+
+def _init_flag_worker(config_values, db_path, db_timestamp, bot_clusters):
+    ''' Runs once in each worker process: copy over the parent's config, database path (the nonsense() cache is in it)
+    and bot clusters, and build the text matcher '''
+    global DB_TIMESTAMP, _worker_bot_clusters
+
+    for name, value in config_values.items():
+        setattr(config, name, value)
+    build_database.DB_PATH = db_path
+    DB_TIMESTAMP = db_timestamp
+    _worker_bot_clusters = bot_clusters
+
+    get_text_matcher(tuple(config.TEXT_TO_FLAG), tuple(config.EMOJI_TO_FLAG))
 
-    # ADD WHICH FUNCTIONS TO USE AS FLAGS HERE
-    # Flag functions must return flag (boolean), reason (string or list of string) 
-    FLAGGING_FUNCTIONS = [
-        flag_too_few_followers,
-        flag_text_or_emoji,
-        flag_randomly_generated_username,
-        flag_got_followers_too_fast,
-    ]
+def update_database_with_flags(df, flag_ids, reasons):
+    old_flags = df['flags'].copy()
 
-    for row in df.itertuples():
-        is_flagged, reasons = False, []
+    df.loc[:,['flags']] = 'no_flag'
+    df.loc[flag_ids, ['flags']] = reasons
 
-        # GREEN FLAGS
-        if row.verified == True:
-            continue
+    # only write back the users whose flags changed
+    changed = df['flags'] != old_flags
+    update_database(df.loc[changed], ['flags'])
 
-        # RED FLAGS
-        for flag_func in FLAGGING_FUNCTIONS:
-            flagged, flag_reason = flag_func(row)
+#-----------------------
+# Flag engine helpers
+#-----------------------
+def column_flag(flag_func):
+    ''' Decorator marking a flag function that works on the whole DataFrame at once '''
+    flag_func.is_column_flag = True
+    return flag_func
+
+def flag_inputs(columns, config_names = (), version = None):
+    ''' Decorator declaring what a flag function reads, so incremental flag runs can skip users whose inputs didn't change.
+    Flag functions without it are re-run whenever any column of a user or any config value changes.
+
+    columns {list} -- DataFrame columns the function reads
+    config_names {list} -- config.py settings the function reads
+    version {function} -- Returns anything else the results depend on, ie. the n-gram detector version
+    '''
+    def decorate(flag_func):
+        flag_func.input_columns = list(columns)
+        flag_func.config_names = list(config_names)
+        flag_func.version = version
+        return flag_func
+    return decorate
+
+def _input_hashes(df, flag_func):
+    ''' Hash of the columns flag_func reads, per user, as int64 so it fits in SQLite '''
+    columns = getattr(flag_func, 'input_columns', None) or [c for c in df.columns if c != 'flags']
+    columns = [c for c in columns if c in df.columns]
+    # hash the text form so the same values loaded with a different dtype give the same hash
+    hashes = pd.util.hash_pandas_object(df[columns].astype(str), index = False)
+    return pd.Series(hashes.to_numpy().view(np.int64), index = df.index)
+
+def _rule_version(flag_func):
+    ''' Changes when the flag function's code, the config it reads or its version() changes '''
+    config_names = getattr(flag_func, 'config_names', None)
+    if config_names is None:
+        config_names = [name for name in dir(config) if name.isupper()]
+    version = getattr(flag_func, 'version', None)
+
+    try:
+        source = inspect.getsource(flag_func)
+    except (OSError, TypeError):
+        source = flag_func.__name__
+
+    parts = [source, [repr(getattr(config, name, None)) for name in config_names], repr(version() if version else None)]
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()[:16]
+
+def _load_flag_results():
+    with db_connection() as con:
+        _create_flag_results_table(con)
+        return pd.read_sql(f'SELECT user_id, rule, input_hash, rule_version, reason FROM {FLAG_RESULTS_TABLE}', con)
+
+def _save_flag_results(rule, user_ids, input_hashes, version, reasons):
+    with db_connection() as con:
+        _create_flag_results_table(con)
+        con.executemany(f'INSERT OR REPLACE INTO {FLAG_RESULTS_TABLE} VALUES (?, ?, ?, ?, ?)',
+            zip(user_ids.tolist(), [rule] * len(user_ids), input_hashes.tolist(), [version] * len(user_ids), reasons.tolist()))
+
+def _create_flag_results_table(con):
+    con.execute(f'''CREATE TABLE IF NOT EXISTS {FLAG_RESULTS_TABLE} (
+        user_id TEXT, rule TEXT, input_hash INTEGER, rule_version TEXT, reason TEXT, PRIMARY KEY (user_id, rule))''')
+
+def apply_row_flag(flag_func, df):
+    ''' Run a row flag function on every row, return reasons as a Series like a column flag function '''
+    reasons = pd.Series('', index = df.index, dtype = object)
 
-            if flagged:
-                is_flagged = True
-                if isinstance(flag_reason, str):
-                    reasons.append(flag_reason)
-                elif isinstance(flag_reason, list):
-                    reasons.extend(flag_reason)
+    for row in df.itertuples():
+        flagged, flag_reason = flag_func(row)
 
-        if is_flagged:
-            flag_ids.append(row.Index)
-            flag_reasons.append(', '.join(reasons))
+        if flagged:
+            if isinstance(flag_reason, list):
+                flag_reason = ', '.join(flag_reason)
+            reasons[row.Index] = flag_reason
 
-    return flag_ids, flag_reasons
+    return reasons
 
-def update_database_with_flags(df, flag_ids, reasons):
-    df.loc[:,['flags']] = 'no_flag'
-    df.loc[flag_ids, ['flags']] = reasons
+def join_reasons(reasons, new_reasons):
+    ''' Element-wise join of 2 Series of reason strings with ', ' skipping empty strings '''
+    new_reasons = new_reasons.reindex(reasons.index, fill_value = '').fillna('')
+    has_old, has_new = reasons != '', new_reasons != ''
+    joined = np.where(has_old & has_new, reasons + ', ' + new_reasons, np.where(has_new, new_reasons, reasons))
+    return pd.Series(joined, index = reasons.index, dtype = object)
 
-    df.to_csv(DB_CSV_PATH, sep = CSV_DELIMITER, index = False)
+def _text_column(df, column):
+    return df[column].fillna('').astype(str)
 
 #-----------------------
 # Flagging functions
 #-----------------------
-def flag_too_few_followers(row):
-    flagged, reason = False, ''
-
-    if row.friends_count < config.LOW_FOLLOWER_THRESH:
-        return True, "low_follower_count"
-    else:
-        return False, ''
-
-def flag_text_or_emoji(row):
-    flagged, reasons = False, []
-
-    # clean up input, make sure it's in str format
-    name, description = row.name, row.description
-    if not isinstance(name, str):
-        name = str(name)
-    if not isinstance(description, str):
-        description = str(description)
-
-    total_text = name+description
-
-    # check for text to flag
-    total_text_lower = total_text.lower()
-    for text in config.TEXT_TO_FLAG:
-        if text in total_text_lower:
-            flagged = True
-            reasons.append(f'flagged_text --- {text}')
-
-    # check for emojis to flag
-    # would be a bit faster to use emoji.analyze(total_text)
-    # a bit more complicated code though because of emoji with duplicate code (ie. :airplane::airplane:)
-    total_text_demojized = emoji.demojize(total_text)
-    for emo in config.EMOJI_TO_FLAG:
-        if emo in total_text_demojized:
-            flagged = True
-            reasons.append(f'flagged_emoji --- {emo}')
-
-    return flagged, reasons
-
-def flag_randomly_generated_username(row):
-    flagged, reason = False, ''
+@column_flag
+@flag_inputs(['friends_count'], ['LOW_FOLLOWER_THRESH'])
+def flag_too_few_followers(df):
+    flagged = df['friends_count'] < config.LOW_FOLLOWER_THRESH
+    return pd.Series(np.where(flagged, 'low_follower_count', ''), index = df.index, dtype = object)
+
+@column_flag
+@flag_inputs(['name', 'description'], ['TEXT_TO_FLAG', 'EMOJI_TO_FLAG'])
+def flag_text_or_emoji(df):
+    # one pass per user over name + description finds every text / emoji to flag, see text_matcher.py
+    matcher = get_text_matcher(tuple(config.TEXT_TO_FLAG), tuple(config.EMOJI_TO_FLAG))
+
+    total_text = _text_column(df, 'name') + _text_column(df, 'description')
+    return total_text.map(lambda text: ', '.join(matcher.find_reasons(text))).astype(object)
+
+@column_flag
+@flag_inputs(['username'], ['ALPHANUMERIC_CHECK_ENABLED', 'NGRAM_CHECK_ENABLED'], version = lambda: _ngram_detector_version())
+def flag_randomly_generated_username(df):
+    reasons = pd.Series('', index = df.index, dtype = object)
+    username = _text_column(df, 'username')
+    flagged = pd.Series(False, index = df.index)
 
     if config.ALPHANUMERIC_CHECK_ENABLED:
         # my paltry attempt at randomly generated alphanumeric string detection
-        all_numbers = re.findall(r'\d+', row.username)
-        num_digits = sum(len(x) for x in all_numbers)
-        if len(all_numbers) >= 3 or num_digits > 6 or (num_digits >= 0.6 * len(row.username) and num_digits > 4):
-            flagged = True
-            reason = 'randomly_generated_@username_detected - alphanumeric method'
-            return flagged, reason
+        num_number_groups = username.str.count(r'\d+')
+        num_digits = username.str.count(r'\d')
+        flagged = (num_number_groups >= 3) | (num_digits > 6) | ((num_digits >= 0.6 * username.str.len()) & (num_digits > 4))
+        reasons[flagged] = 'randomly_generated_@username_detected - alphanumeric method'
 
     if config.NGRAM_CHECK_ENABLED:
-        try:
-            if nonsense(row.username):
-                flagged = True
-                reason = 'randomly_generated_@username_detected - ngram method'
-        except:
-            pass
-
-        return flagged, reason
-
-def flag_got_followers_too_fast(row):
-    flagged, reason = False, ''
+        # n-gram check can't be vectorized, only run it on usernames the alphanumeric check didn't already flag
+        is_nonsense = cached_nonsense(username[~flagged])
+        reasons[is_nonsense[is_nonsense].index] = 'randomly_generated_@username_detected - ngram method'
+
+    return reasons
+
+def _is_nonsense(username):
+    try:
+        return bool(nonsense(username))
+    except:
+        return False
+
+def cached_nonsense(usernames):
+    ''' nostril nonsense() for a Series of usernames. Results are cached in the database per username + detector version,
+    since usernames rarely change between flag runs. Returns a bool Series aligned to usernames. '''
+    version = _ngram_detector_version()
+    unique_usernames = list(usernames.unique())
+    results = {}
+
+    with db_connection() as con:
+        con.execute(f'''CREATE TABLE IF NOT EXISTS {NONSENSE_CACHE_TABLE} (
+            username TEXT, detector_version TEXT, is_nonsense INTEGER, PRIMARY KEY (username, detector_version))''')
+
+        chunk_size = 500 # stay under SQLite's max number of ? parameters
+        for i in range(0, len(unique_usernames), chunk_size):
+            chunk = unique_usernames[i:i + chunk_size]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = con.execute(f'''SELECT username, is_nonsense FROM {NONSENSE_CACHE_TABLE}
+                WHERE detector_version = ? AND username IN ({placeholders})''', [version] + chunk)
+            results.update((username, bool(is_nonsense)) for username, is_nonsense in rows)
+
+    missing = [username for username in unique_usernames if username not in results]
+    for username in missing:
+        results[username] = _is_nonsense(username)
+
+    if missing:
+        with db_connection() as con:
+            con.execute(f'DELETE FROM {NONSENSE_CACHE_TABLE} WHERE detector_version != ?', (version,))
+            con.executemany(f'INSERT OR REPLACE INTO {NONSENSE_CACHE_TABLE} VALUES (?, ?, ?)',
+                ((username, version, int(results[username])) for username in missing))
+
+    nonsense_cache_stats['hits'] += len(unique_usernames) - len(missing)
+    nonsense_cache_stats['misses'] += len(missing)
+
+    return usernames.map(results).astype(bool)
+
+def get_nonsense_cache_stats():
+    ''' Hit / miss counts of the nonsense() cache since the process started '''
+    total = nonsense_cache_stats['hits'] + nonsense_cache_stats['misses']
+    hit_rate = nonsense_cache_stats['hits'] / total if total else 0.0
+    return {**nonsense_cache_stats, 'hit_rate': round(hit_rate, 3)}
+
+def _ngram_detector_version():
+    return f"nostril-{getattr(nostril, '__version__', 'unknown')}-{NGRAM_DETECTOR_VERSION}"
+
+@column_flag
+@flag_inputs(['created_at', 'followers_count'], ['FOLLOWERS_PER_DAY_THRESH'], version = lambda: DB_TIMESTAMP)
+def flag_got_followers_too_fast(df):
+    reasons = pd.Series('', index = df.index, dtype = object)
+
+    created_datetime = df['created_at']
+    if not pd.api.types.is_datetime64_any_dtype(created_datetime):
+        created_datetime = pd.to_datetime(created_datetime.astype(str).str[:19], format = '%Y-%m-%d %H:%M:%S')
+    elif created_datetime.dt.tz is not None: # freshly scraped users are UTC (see user_columns.py), DB_TIMESTAMP is naive
+        created_datetime = created_datetime.dt.tz_convert(None)
+    delta_days = (DB_TIMESTAMP - created_datetime).dt.days + 1E-3
+    days_str = np.trunc(delta_days).astype(int).astype(str)
+
+    followers_count = df['followers_count']
+    followers_per_day = followers_count / delta_days
+
+    too_fast = (followers_per_day >= config.FOLLOWERS_PER_DAY_THRESH) & (10 <= followers_count) & (followers_count < 5000)
+    reasons[too_fast] = 'gained_followers_too_fast: ' + followers_count[too_fast].astype(str) + ' followers in ' + days_str[too_fast] + ' days'
+
+    recently_created = ~too_fast & (delta_days < 3) #TODO: check for following you right after created
+    reasons[recently_created] = 'recently_created: Created ' + days_str[recently_created] + ' days ago.'
+
+    return reasons
+
+@column_flag
+@flag_inputs(['username'], ['CLUSTER_MIN_SIMILARITY', 'CLUSTER_MIN_SIZE', 'CLUSTER_FLAG_MIN_SIZE', 'CLUSTER_FLAG_MIN_MEAN_SIMILARITY',
+                            'GRAPH_SIMILARITY_METHOD', 'MINHASH_NUM_PERM'], version = lambda: get_followings_version())
+def flag_bot_cluster(df):
+    ''' Members of big groups of users that follow nearly the same accounts. Needs followings scraped, see graph_analysis.find_clusters() '''
+    reasons = pd.Series('', index = df.index, dtype = object)
+    if config.CLUSTER_FLAG_MIN_SIZE is None:
+        return reasons
+
+    clusters = _worker_bot_clusters if _worker_bot_clusters is not None else _load_bot_clusters()
+    clusters = clusters[(clusters['cluster_size'] >= config.CLUSTER_FLAG_MIN_SIZE) &
+                        (clusters['mean_similarity'] >= config.CLUSTER_FLAG_MIN_MEAN_SIMILARITY)]
+
+    member = clusters.set_index('username').reindex(_text_column(df, 'username'))
+    flagged = member['cluster_id'].notna().to_numpy()
+    reasons[flagged] = ('bot_cluster: member of a ' + member['cluster_size'][flagged].astype(int).astype(str) + '-account cluster with '
+                        + member['mean_similarity'][flagged].map('{:.2f}'.format) + ' mean similarity').to_numpy()
+    return reasons
+
+def _load_bot_clusters():
+    ''' graph_analysis.get_user_clusters(), None if flagging bot clusters is turned off '''
+    if config.CLUSTER_FLAG_MIN_SIZE is None:
+        return None
+    from graph_analysis import get_user_clusters # imported here, graph_analysis loads the plotting libraries
+    return get_user_clusters()
+
+# ADD WHICH FUNCTIONS TO USE AS FLAGS HERE
+# Column flag functions (decorated with @column_flag) take the whole DataFrame and return a Series of
+# reason strings aligned to df.index, with '' for users that aren't flagged. This is the fast way.
+# Row flag functions take a single row and must return flag (boolean), reason (string or list of string)
+FLAGGING_FUNCTIONS = [
+    flag_too_few_followers,
+    flag_text_or_emoji,
+    flag_randomly_generated_username,
+    flag_got_followers_too_fast,
+    flag_bot_cluster,
+]
 
-    created_datetime = datetime.datetime.strptime(row.created_at[:19],'%Y-%m-%d %H:%M:%S')
-    delta = DB_TIMESTAMP- created_datetime
-    delta_days = delta.days + 1E-3
-
-    followers_per_day = row.followers_count / delta_days
-
-    if followers_per_day >= config.FOLLOWERS_PER_DAY_THRESH and 10 <= row.followers_count < 5000:
-        flagged = True
-        reason = f'gained_followers_too_fast: {row.followers_count} followers in {int(delta_days)} days'
-        return flagged, reason
-
-    if delta_days < 3: #TODO: check for following you right after created
-        flagged = True
-        reason = f'recently_created: Created {int(delta_days)} days ago.'
+if __name__ == '__main__':
+    import argparse
 
-    return flagged, reason
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help='Number of processes to run the flag functions in. 0 uses every CPU core. Default 1')
+    parser.add_argument('--full', action = 'store_true',
+        help='Run every flag function on every user instead of only the users / flags whose inputs changed')
+    args = parser.parse_args()
 
-if __name__ == '__main__':
     pd.options.display.width = 0 #So Pandas autodetects the size of your terminal window
     df = load_database()
 
-    flag_ids, reasons = get_all_flagged_users(df)
+    flag_ids, reasons = get_all_flagged_users(df, workers = args.workers, incremental = not args.full)
     
     for flag_id, reason in zip(flag_ids, reasons):
         print(flag_id, reason)
 
     update_database_with_flags(df, flag_ids, reasons)
+    print('nonsense() cache:', get_nonsense_cache_stats())
+    print('Flag functions evaluated / reused:', get_flag_run_stats())
@@ -1,52 +1,444 @@
-from build_database import load_database
+from build_database import load_database, load_followings_edges, get_followings_version, get_database_version, DATA_DIR
+from minhash import lsh_bands, minhash_edges, followings_hash
+import config
+import metrics
 import json
+import os
+import hashlib
+import base64
+from collections import OrderedDict
 from pprint import pprint
 import networkx as nx
 import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
 import matplotlib.pyplot as plt
 import plotly.graph_objects as go
 
+# Cache of generated graphs. Repeat views with unchanged followings + params are served from memory / disk,
+# and when only a few users changed the layout is warm-started from the cached positions.
+GRAPH_CACHE_DIR = os.path.join(DATA_DIR, 'graph_cache')
+GRAPH_MEMORY_CACHE_SIZE = 4
+LAYOUT_PARAMS = {'seed': 5, 'iterations': 200}
+WARM_START_ITERATIONS = 50
+WARM_START_MAX_CHANGED_FRACTION = 0.2 # recompute the whole layout if more users than this changed
+
+_graph_html_cache = OrderedDict()
+_graph_versions = {} # (params_key, ext): [database versions, fingerprint], see load_graph_version()
+_clusters_cache = {}
+
 def load_followings_data():
-    ''' Load data dict of user followings for graph analysis '''
-    df = load_database(usecols = ['username', 'followings','protected'])
+    ''' Load data dict of user followings for graph analysis: {username: numpy array of followed account ids}.
+    The arrays are slices of the memory mapped edge store, so nothing gets parsed. '''
+    follower_ids, followee_ids, account_names = load_followings_edges()
+    df = load_database(columns = ['username', 'protected'])
+    public_users = set(df.loc[df['protected'] == False, 'username'])
+
+    # edges are sorted by follower, so each user's followings are one contiguous slice
+    followers, starts = np.unique(follower_ids, return_index = True)
+    ends = np.append(starts[1:], len(follower_ids))
 
     followings = {}
+    for account_id, start, end in zip(followers.tolist(), starts.tolist(), ends.tolist()):
+        username = str(account_names[account_id])
+        if username in public_users:
+            followings[username] = followee_ids[start:end]
 
-    for row in df.itertuples():
-        if row.protected == False:
-            data = set(json.loads(row.followings.replace("'", '"')))
+    return followings
 
-            if len(data) > 0:
-                followings[row.username] = data
+def generate_graph_html(weight_thresh = None, method = None):
+    ''' weight_thresh {float} -- Min Jaccard index for an edge. Default config.GRAPH_WEIGHT_THRESH, or
+                                 config.MINHASH_WEIGHT_THRESH for minhash
+    method {str} -- 'exact' or 'minhash' (approximate, for very large graphs). Default config.GRAPH_SIMILARITY_METHOD.
+                    minhash falls back to exact when weight_thresh is too low for it, see minhash.lsh_bands()
 
-    return followings
+    Results are cached by a fingerprint of the followings data + graph params, see GRAPH_CACHE_DIR. While the database
+    doesn't change the fingerprint itself is cached too, see load_graph_version() '''
+    return _generate_graph(weight_thresh, method, 'html')
+
+def generate_graph_data(weight_thresh = None, method = None):
+    ''' Same graph as generate_graph_html() as a JSON payload for the WebGL renderer in templates/graph_analysis.html.
+    See get_graph_payload(), its method is the similarity method actually used. Cached the same way. '''
+    return _generate_graph(weight_thresh, method, 'payload.json')
+
+def _generate_graph(weight_thresh, method, output):
+    method = method or config.GRAPH_SIMILARITY_METHOD
+    if weight_thresh is None:
+        weight_thresh = config.MINHASH_WEIGHT_THRESH if method == 'minhash' else config.GRAPH_WEIGHT_THRESH
+    if method == 'minhash' and lsh_bands(config.MINHASH_NUM_PERM, weight_thresh) is None:
+        print(f'weight_thresh {weight_thresh} is too low for MinHash LSH with num_perm={config.MINHASH_NUM_PERM}, '
+              'generating the graph with exact Jaccard')
+        metrics.inc('graph_minhash_fallbacks_total')
+        method = 'exact'
+
+    params = {'weight_thresh': weight_thresh, 'method': method, 'layout': LAYOUT_PARAMS}
+    if method == 'minhash':
+        params['num_perm'] = config.MINHASH_NUM_PERM
+    params_key = hashlib.sha1(json.dumps(params, sort_keys = True).encode()).hexdigest()[:16]
+    render_params = [output, config.GRAPH_MAX_EDGES_PER_NODE if output != 'html' else None]
+    if output != 'html':
+        render_params.append(_cluster_params())
+
+    # read before loading the data, if it changes in between the next request just fingerprints again
+    version = json.loads(json.dumps([get_followings_version(), get_database_version(), render_params]))
+    fingerprint = load_graph_version(params_key, output, version)
+    cached = load_cached_graph_html(params_key, fingerprint, output) if fingerprint is not None else None
+    if cached is not None:
+        metrics.inc('graph_requests_total', result = 'cached', output = output)
+        return cached
 
-def generate_graph_html(weight_thresh = 0.025):
-    followings = load_followings_data()
-    users = list(followings.keys())
-    num_users = len(followings)
+    with metrics.timer('graph_stage_seconds', stage = 'load'):
+        followings = load_followings_data()
+        users = list(followings.keys())
+
+    with metrics.timer('graph_stage_seconds', stage = 'fingerprint'):
+        user_hashes = {user: followings_hash(followings[user]) for user in users}
+        fingerprint = hashlib.sha1(json.dumps([params_key, render_params, sorted(user_hashes.items())]).encode()).hexdigest()[:16]
+
+    cached = load_cached_graph_html(params_key, fingerprint, output)
+    if cached is not None:
+        save_graph_version(params_key, output, version, fingerprint)
+        metrics.inc('graph_requests_total', result = 'cached', output = output)
+        return cached
+    metrics.inc('graph_requests_total', result = 'generated', output = output)
 
     #build weighted graph
     G = nx.Graph()
-    similarities = []
+    G.add_nodes_from(users)
 
-    for user in users:
-        G.add_node(user)
+    with metrics.timer('graph_stage_seconds', stage = 'similarity'):
+        if method == 'minhash':
+            rows, cols, weights = minhash_edges(followings, users, weight_thresh)
+        else:
+            rows, cols, weights = jaccard_edges(followings, users, weight_thresh)
+        G.add_weighted_edges_from(zip([users[r] for r in rows], [users[c] for c in cols], weights.tolist()))
+    metrics.inc('graph_edges_kept_total', len(rows), method = method)
 
-    for r in range(num_users):
-        for c in range(r + 1, num_users): # c > r
-            similarity = jaccard(followings[users[r]], followings[users[c]])
-            similarities.append(similarity)
+    # generate / plot NetworkX graph
+    with metrics.timer('graph_stage_seconds', stage = 'layout'):
+        pos = get_graph_layout(G, params_key, user_hashes)
+    with metrics.timer('graph_stage_seconds', stage = 'render'):
+        if output == 'html':
+            result = get_plotly_plot_html(G, pos)
+        else:
+            with metrics.timer('graph_stage_seconds', stage = 'clusters'):
+                clusters = find_clusters(len(users), rows, cols, weights)
+            result = get_graph_payload(users, pos, rows, cols, weights, clusters, method)
 
-            if similarity > weight_thresh:
-                G.add_edge(users[r], users[c], weight = similarity)
+    save_cached_graph_html(params_key, fingerprint, result, output)
+    save_graph_version(params_key, output, version, fingerprint)
+    return result
 
-    # generate / plot NetworkX graph
-    pos = nx.spring_layout(G, seed = 5, iterations = 200) # positions for all nodes - seed for reproducibility
-    #pos = nx.kamada_kawai_layout(G)
-    html = get_plotly_plot_html(G, pos)
+def get_graph_layout(G, params_key, user_hashes):
+    ''' spring_layout positions for G. If only a few users' followings changed since the cached layout with the same
+    params, keep the unchanged users fixed and only lay out the changed ones, starting next to their neighbors. '''
+    layout_path = os.path.join(GRAPH_CACHE_DIR, f'{params_key}_layout.json')
+    cached = None
+    if os.path.exists(layout_path):
+        with open(layout_path, 'r') as file:
+            cached = json.load(file)
+
+    pos = None
+    if cached is not None and len(G) > 0:
+        unchanged = [user for user in G if user in cached['pos'] and cached['user_hashes'].get(user) == user_hashes[user]]
+        changed_fraction = 1 - len(unchanged) / len(G)
+
+        if changed_fraction == 0:
+            pos = {user: np.array(cached['pos'][user]) for user in G}
+
+        elif changed_fraction <= WARM_START_MAX_CHANGED_FRACTION:
+            init_pos = {user: np.array(cached['pos'][user]) for user in unchanged}
+            for user in G:
+                if user not in init_pos:
+                    neighbor_pos = [init_pos[n] for n in G.neighbors(user) if n in init_pos]
+                    init_pos[user] = np.mean(neighbor_pos, axis = 0) if neighbor_pos else np.random.uniform(-1, 1, 2)
+
+            pos = nx.spring_layout(G, pos = init_pos, fixed = unchanged, seed = LAYOUT_PARAMS['seed'],
+                                   iterations = WARM_START_ITERATIONS)
+
+    if pos is None:
+        pos = nx.spring_layout(G, **LAYOUT_PARAMS) # positions for all nodes - seed for reproducibility
+        #pos = nx.kamada_kawai_layout(G)
+
+    # write to a temporary file first, so another process never reads a half written layout
+    os.makedirs(GRAPH_CACHE_DIR, exist_ok = True)
+    with open(f'{layout_path}.{os.getpid()}.tmp', 'w') as file:
+        json.dump({'user_hashes': user_hashes, 'pos': {user: [float(x), float(y)] for user, (x, y) in pos.items()}}, file)
+    os.replace(f'{layout_path}.{os.getpid()}.tmp', layout_path)
+
+    return pos
+
+def load_cached_graph_html(params_key, fingerprint, ext = 'html'):
+    ''' Cached graph html (or ext = 'payload.json' WebGL payload) from memory, then disk. None if this graph hasn't been generated yet. '''
+    if (fingerprint, ext) in _graph_html_cache:
+        _graph_html_cache.move_to_end((fingerprint, ext))
+        return _graph_html_cache[(fingerprint, ext)]
+
+    html_path = os.path.join(GRAPH_CACHE_DIR, f'{params_key}_{fingerprint}.{ext}')
+    if not os.path.exists(html_path):
+        return None
+
+    with open(html_path, 'r', encoding = 'utf-8') as file:
+        html = file.read()
+    _remember_graph_html((fingerprint, ext), html)
     return html
 
+def save_cached_graph_html(params_key, fingerprint, html, ext = 'html'):
+    ''' Save to memory + disk. Only the latest graph for each set of params is kept on disk. '''
+    _remember_graph_html((fingerprint, ext), html)
+
+    os.makedirs(GRAPH_CACHE_DIR, exist_ok = True)
+    for filename in os.listdir(GRAPH_CACHE_DIR):
+        if filename.startswith(f'{params_key}_') and filename.endswith(f'.{ext}'):
+            try:
+                os.remove(os.path.join(GRAPH_CACHE_DIR, filename))
+            except FileNotFoundError: # another server process got to it first
+                pass
+
+    # write to a temporary file first, so another process never reads a half written graph
+    html_path = os.path.join(GRAPH_CACHE_DIR, f'{params_key}_{fingerprint}.{ext}')
+    with open(f'{html_path}.{os.getpid()}.tmp', 'w', encoding = 'utf-8') as file:
+        file.write(html)
+    os.replace(f'{html_path}.{os.getpid()}.tmp', html_path)
+
+def load_graph_version(params_key, ext, version):
+    ''' Fingerprint of the graph last generated from the database at version, so unchanged data doesn't need to be
+    loaded + hashed to find the cached graph. None if the database changed since. '''
+    if _graph_versions.get((params_key, ext), [None])[0] == version:
+        return _graph_versions[(params_key, ext)][1]
+
+    version_path = os.path.join(GRAPH_CACHE_DIR, f'{params_key}.{ext}.version.json')
+    if not os.path.exists(version_path):
+        return None
+    with open(version_path, 'r') as file:
+        cached_version, fingerprint = json.load(file)
+    return fingerprint if cached_version == version else None
+
+def save_graph_version(params_key, ext, version, fingerprint):
+    _graph_versions[(params_key, ext)] = [version, fingerprint]
+
+    version_path = os.path.join(GRAPH_CACHE_DIR, f'{params_key}.{ext}.version.json')
+    os.makedirs(GRAPH_CACHE_DIR, exist_ok = True)
+    with open(f'{version_path}.{os.getpid()}.tmp', 'w') as file:
+        json.dump([version, fingerprint], file)
+    os.replace(f'{version_path}.{os.getpid()}.tmp', version_path)
+
+def _remember_graph_html(key, html):
+    _graph_html_cache[key] = html
+    _graph_html_cache.move_to_end(key)
+    while len(_graph_html_cache) > GRAPH_MEMORY_CACHE_SIZE:
+        _graph_html_cache.popitem(last = False)
+
+#------------------------------------
+# WebGL renderer payload
+#------------------------------------
+
+def get_graph_payload(users, pos, rows, cols, weights, clusters = None, method = None):
+    ''' JSON payload for the WebGL (Scattergl) renderer. Numbers are sent as base64 little endian typed arrays:
+        nodes: labels, x / y (float32), degree (uint32) -- degree counts all edges, before pruning
+               cluster (int32) -- bot cluster id of each node, -1 if it's not in one. See find_clusters()
+        edges: source / target (uint32 indexes into nodes), weight (float32)
+        clusters: size + mean_similarity of each cluster id
+        method: similarity method the edges were computed with, 'exact' or 'minhash'
+    Big graphs only keep the config.GRAPH_MAX_EDGES_PER_NODE heaviest edges of each node, see prune_edges() '''
+    if clusters is None:
+        clusters = find_clusters(len(users), rows, cols, weights)
+    labels, sizes, mean_similarity = clusters
+    cluster_info = _cluster_info(labels, sizes, mean_similarity)
+
+    xy = np.array([pos[user] for user in users], dtype = np.float32).reshape(-1, 2)
+    degree = np.bincount(np.concatenate([rows, cols]).astype(np.int64), minlength = len(users))
+
+    num_edges = len(weights)
+    if config.GRAPH_MAX_EDGES_PER_NODE and num_edges > config.GRAPH_PRUNE_MIN_EDGES:
+        rows, cols, weights = prune_edges(rows, cols, weights, config.GRAPH_MAX_EDGES_PER_NODE)
+
+    return json.dumps({
+        'nodes': {
+            'labels': users,
+            'x': _b64(xy[:, 0], np.float32), 'y': _b64(xy[:, 1], np.float32), 'degree': _b64(degree, np.uint32),
+            'cluster': _b64(labels, np.int32),
+        },
+        'edges': {
+            'source': _b64(rows, np.uint32), 'target': _b64(cols, np.uint32), 'weight': _b64(weights, np.float32),
+        },
+        'clusters': [{'size': size, 'mean_similarity': round(similarity, 3)} for size, similarity in cluster_info],
+        'num_edges_total': num_edges,
+        'method': method or config.GRAPH_SIMILARITY_METHOD,
+    })
+
+def prune_edges(rows, cols, weights, top_k):
+    ''' Keep the top_k heaviest edges of each node. An edge stays if it's in the top_k of either of its nodes. '''
+    edge_ids = np.tile(np.arange(len(weights)), 2)
+    ends = np.concatenate([rows, cols])
+
+    order = np.lexsort((-np.tile(weights, 2), ends)) # by node, heaviest first
+    sorted_ends = ends[order]
+    group_starts = np.flatnonzero(np.concatenate([[True], sorted_ends[1:] != sorted_ends[:-1]]))
+    group_sizes = np.diff(np.concatenate([group_starts, [len(order)]]))
+    rank = np.arange(len(order)) - np.repeat(group_starts, group_sizes)
+
+    keep = np.zeros(len(weights), dtype = bool)
+    keep[edge_ids[order[rank < top_k]]] = True
+    return rows[keep], cols[keep], weights[keep]
+
+#------------------------------------
+# Bot clusters
+#------------------------------------
+
+def find_clusters(num_users, rows, cols, weights, min_similarity = None, min_size = None):
+    ''' Group users that follow nearly the same accounts: connected components of the graph of edges with
+    weight > min_similarity. Runs on a sparse matrix in scipy, so it handles tens of thousands of users in well under a second.
+
+    rows, cols, weights -- Similarity edges between user indexes, ie. from jaccard_edges()
+    min_similarity {float} -- Default config.CLUSTER_MIN_SIMILARITY
+    min_size {int} -- Smaller groups aren't clusters. Default config.CLUSTER_MIN_SIZE
+
+    Returns (labels, sizes, mean_similarity) numpy arrays with one entry per user:
+        labels -- Cluster id, biggest cluster first. -1 for users that aren't in a cluster
+        sizes -- Number of users in the user's cluster, 0 if not in one
+        mean_similarity -- Mean weight of the edges inside the user's cluster, 0 if not in one
+    '''
+    min_similarity = config.CLUSTER_MIN_SIMILARITY if min_similarity is None else min_similarity
+    min_size = config.CLUSTER_MIN_SIZE if min_size is None else min_size
+
+    keep = weights > min_similarity
+    rows, cols, weights = np.asarray(rows)[keep], np.asarray(cols)[keep], np.asarray(weights)[keep]
+    adjacency = sp.coo_matrix((np.ones(len(rows), dtype = np.int8), (rows, cols)), shape = (num_users, num_users))
+    num_components, components = connected_components(adjacency, directed = False)
+
+    component_sizes = np.bincount(components, minlength = num_components)
+    edge_counts = np.bincount(components[rows], minlength = num_components)
+    edge_sums = np.bincount(components[rows], weights = weights, minlength = num_components)
+    component_similarity = np.divide(edge_sums, edge_counts, out = np.zeros(num_components), where = edge_counts > 0)
+
+    # renumber the components big enough to be clusters by size, biggest = 0
+    clusters = np.flatnonzero(component_sizes >= max(min_size, 2))
+    clusters = clusters[np.argsort(-component_sizes[clusters], kind = 'stable')]
+    cluster_ids = np.full(num_components, -1)
+    cluster_ids[clusters] = np.arange(len(clusters))
+
+    labels = cluster_ids[components]
+    in_cluster = labels >= 0
+    sizes = np.where(in_cluster, component_sizes[components], 0)
+    mean_similarity = np.where(in_cluster, component_similarity[components], 0.0)
+    return labels, sizes, mean_similarity
+
+def get_user_clusters(method = None):
+    ''' Bot clusters of the users with scraped followings, see find_clusters(). Cached until followings change.
+
+    method {str} -- Similarity method, 'exact' or 'minhash'. Default config.GRAPH_SIMILARITY_METHOD
+
+    Returns DataFrame with columns username, cluster_id, cluster_size, mean_similarity -- one row per user in a cluster
+    '''
+    method = method or config.GRAPH_SIMILARITY_METHOD
+    key = json.loads(json.dumps([get_followings_version(), method, _cluster_params(),
+                                 config.MINHASH_NUM_PERM if method == 'minhash' else None]))
+    if _clusters_cache.get('key') == key:
+        return _clusters_cache['df'].copy()
+
+    clusters_path = os.path.join(GRAPH_CACHE_DIR, 'clusters.json')
+    cached = None
+    if os.path.exists(clusters_path):
+        with open(clusters_path, 'r') as file:
+            cached = json.load(file)
+
+    if cached is not None and cached['key'] == key:
+        df = pd.DataFrame(cached['clusters'])
+    else:
+        with metrics.timer('graph_stage_seconds', stage = 'clusters'):
+            followings = load_followings_data()
+            users = list(followings.keys())
+            if method == 'minhash':
+                rows, cols, weights = minhash_edges(followings, users, config.CLUSTER_MIN_SIMILARITY)
+            else:
+                rows, cols, weights = jaccard_edges(followings, users, config.CLUSTER_MIN_SIMILARITY)
+            labels, sizes, mean_similarity = find_clusters(len(users), rows, cols, weights)
+
+        in_cluster = labels >= 0
+        df = pd.DataFrame({
+            'username': np.array(users, dtype = object)[in_cluster], 'cluster_id': labels[in_cluster],
+            'cluster_size': sizes[in_cluster], 'mean_similarity': mean_similarity[in_cluster].round(3),
+        }).sort_values(['cluster_id', 'username'], ignore_index = True)
+
+        # write to a temporary file first, so another process never reads a half written file
+        os.makedirs(GRAPH_CACHE_DIR, exist_ok = True)
+        with open(f'{clusters_path}.{os.getpid()}.tmp', 'w') as file:
+            json.dump({'key': key, 'clusters': df.to_dict(orient = 'list')}, file)
+        os.replace(f'{clusters_path}.{os.getpid()}.tmp', clusters_path)
+
+    df = df.astype({'username': object, 'cluster_id': int, 'cluster_size': int, 'mean_similarity': float})
+    _clusters_cache.update(key = key, df = df)
+    return df.copy()
+
+def get_cluster_summary():
+    ''' Every bot cluster, biggest first, as a list of dicts with cluster_id, size, mean_similarity and usernames '''
+    df = get_user_clusters()
+    return [{'cluster_id': int(cluster_id), 'size': int(group['cluster_size'].iloc[0]),
+             'mean_similarity': float(group['mean_similarity'].iloc[0]), 'usernames': group['username'].tolist()}
+            for cluster_id, group in df.groupby('cluster_id', sort = True)]
+
+def _cluster_params():
+    return [config.CLUSTER_MIN_SIMILARITY, config.CLUSTER_MIN_SIZE]
+
+def _cluster_info(labels, sizes, mean_similarity):
+    ''' (size, mean similarity) of each cluster id '''
+    in_cluster = np.flatnonzero(labels >= 0)
+    _, first_member = np.unique(labels[in_cluster], return_index = True) # unique ids come out sorted
+    return [(int(sizes[i]), float(mean_similarity[i])) for i in in_cluster[first_member]]
+
+def _b64(values, dtype):
+    return base64.b64encode(np.ascontiguousarray(values, dtype = np.dtype(dtype).newbyteorder('<')).tobytes()).decode()
+
+def followings_matrix(followings, users):
+    ''' Sparse CSR incidence matrix: one row per user, one column per followed account, 1 = user follows account '''
+    if users and isinstance(followings[users[0]], np.ndarray):
+        # account ids from the edge store are already column numbers
+        indices = np.concatenate([followings[user] for user in users])
+        indptr = np.concatenate([[0], np.cumsum([len(followings[user]) for user in users])])
+        data = np.ones(len(indices), dtype = np.float32)
+        num_accounts = int(indices.max()) + 1 if len(indices) else 0
+        return sp.csr_matrix((data, indices, indptr), shape = (len(users), num_accounts))
+
+    account_ids = {}
+    indptr, indices = [0], []
+    for user in users:
+        indices.extend(account_ids.setdefault(account, len(account_ids)) for account in followings[user])
+        indptr.append(len(indices))
+
+    data = np.ones(len(indices), dtype = np.float32)
+    return sp.csr_matrix((data, indices, indptr), shape = (len(users), len(account_ids)))
+
+def jaccard_edges(followings, users, weight_thresh, block_size = 2000):
+    ''' Jaccard index of every pair of users from a sparse matrix product, keeping pairs above weight_thresh.
+    Intersections come from A @ A.T and unions from row sums, computed in blocks of rows so the full
+    similarity matrix is never built. Pairs that share no followings are never evaluated (Jaccard 0).
+
+    Returns (rows, cols, weights) numpy arrays, indexes into users with row < col
+    '''
+    A = followings_matrix(followings, users)
+    sizes = np.asarray(A.sum(axis = 1)).ravel()
+    A_T = A.T.tocsr()
+
+    rows, cols, weights = [], [], []
+    for start in range(0, A.shape[0], block_size):
+        intersections = (A[start:start + block_size] @ A_T).tocoo()
+        r, c = intersections.row + start, intersections.col
+
+        upper = c > r # each pair once, no self pairs
+        r, c, inter = r[upper], c[upper], intersections.data[upper]
+        metrics.inc('graph_pairs_evaluated_total', len(r), method = 'exact')
+
+        similarity = inter / (sizes[r] + sizes[c] - inter)
+        keep = similarity > weight_thresh
+        rows.append(r[keep])
+        cols.append(c[keep])
+        weights.append(similarity[keep])
+
+    if not rows:
+        return np.array([], dtype = int), np.array([], dtype = int), np.array([])
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
 
 def jaccard(s1: set, s2: set):
     ''' Computes Jaccard index of 2 sets. Intersection / union '''
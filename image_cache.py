@@ -0,0 +1,236 @@
+''' Local thumbnail cache + proxy for the profile and banner images shown in the review table.
+
+Images are downloaded from Twitter once, shrunk to config.IMAGE_THUMBNAIL_SIZES and saved in IMAGE_CACHE_DIR, named
+by a hash of their url + thumbnail kind + size. Twitter image urls never change content (a new avatar gets a new url), so
+cached thumbnails never need refreshing. Once the cache is bigger than config.IMAGE_CACHE_MAX_MB, the least recently
+used thumbnails are deleted. File modification times are the LRU clock, they're bumped when a thumbnail is served.
+
+Run `python image_cache.py` to download the thumbnails of every user in the database ahead of time.
+'''
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse
+
+import httpx
+from PIL import Image
+
+from build_database import load_database, DATA_DIR
+import config
+
+IMAGE_CACHE_DIR = os.path.join(DATA_DIR, 'image_cache')
+THUMBNAIL_MEDIA_TYPE = 'image/jpeg'
+THUMBNAIL_QUALITY = 85
+FETCH_TIMEOUT_SEC = 10
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+# database column holding the image url of each thumbnail kind
+IMAGE_COLUMNS = {'avatar': 'profile_image_url_https', 'banner': 'profile_banner_url'}
+
+# only bump a thumbnail's LRU time when it's older than this, so cache hits don't all turn into disk writes
+TOUCH_INTERVAL_SEC = 60 * 60
+
+_client = None
+_cache_size = None # bytes, computed on first use
+_lock = threading.Lock()
+_fetch_locks = {}
+
+class ImageFetchError(Exception):
+    pass
+
+def get_thumbnail(url, kind = 'avatar'):
+    ''' Path of the cached thumbnail of the image at url, downloading + shrinking it first if it's not cached.
+
+    url {str} -- The image url as saved in the database (profile_image_url_https or profile_banner_url)
+    kind {str} -- 'avatar' or 'banner', see config.IMAGE_THUMBNAIL_SIZES
+
+    Raises ValueError for urls that aren't allowed to be proxied, ImageFetchError if the image can't be downloaded
+    '''
+    _check_url(url, kind)
+    path = thumbnail_path(url, kind)
+
+    if _touch(path):
+        return path
+
+    # only one download per image, even when the browser + prefetch ask for it at the same time
+    with _lock:
+        fetch_lock = _fetch_locks.setdefault(path, threading.Lock())
+    try:
+        with fetch_lock:
+            if not os.path.exists(path):
+                _save_thumbnail(_fetch(source_url(url, kind)), kind, path)
+    finally:
+        with _lock:
+            _fetch_locks.pop(path, None)
+
+    return path
+
+def thumbnail_path(url, kind):
+    # the size is part of the key, so changing config.IMAGE_THUMBNAIL_SIZES makes new thumbnails
+    width, height = config.IMAGE_THUMBNAIL_SIZES[kind]
+    key = hashlib.sha1(f'{kind}:{width}x{height}:{url}'.encode()).hexdigest()
+    return os.path.join(IMAGE_CACHE_DIR, key[:2], f'{key}.jpg')
+
+def thumbnail_etag(path):
+    ''' Thumbnails never change, so the cache key works as the ETag '''
+    return f'"{os.path.splitext(os.path.basename(path))[0]}"'
+
+def source_url(url, kind):
+    ''' Url of the smallest size Twitter serves that's still at least as big as the thumbnail '''
+    if kind == 'banner':
+        return url + '/600x200'
+    return url.replace('_normal', '_400x400')
+
+def prefetch_thumbnails(progress_callback = None, workers = None, cancel_event = None):
+    ''' Download the thumbnails of every user in the database that aren't cached yet
+
+    progress_callback {function} -- Called as progress_callback(images_done, total_images, message) after each image
+    workers {int} -- Number of downloads at the same time. Default config.IMAGE_PREFETCH_WORKERS
+    cancel_event {threading.Event} -- Stop when it's set. Downloads already started finish in the background
+
+    Returns dict with number of images already cached / fetched / failed
+    '''
+    df = load_database(columns = list(IMAGE_COLUMNS.values()))
+    images = [(url, kind) for kind, column in IMAGE_COLUMNS.items() for url in df[column].dropna().unique() if url]
+    todo = [(url, kind) for url, kind in images if not os.path.exists(thumbnail_path(url, kind))]
+    counts = {'cached': len(images) - len(todo), 'fetched': 0, 'failed': 0}
+    print(f'Prefetching {len(todo)} images, {counts["cached"]} already cached')
+
+    cancel_event = cancel_event or threading.Event()
+    executor = ThreadPoolExecutor(max_workers = workers or config.IMAGE_PREFETCH_WORKERS, thread_name_prefix = 'image')
+    try:
+        pending = {executor.submit(get_thumbnail, url, kind) for url, kind in todo}
+        # a slow image host can take FETCH_TIMEOUT_SEC per download, check for cancel in between
+        while pending and not cancel_event.is_set():
+            done, pending = wait(pending, timeout = 0.5, return_when = FIRST_COMPLETED)
+            for future in done:
+                try:
+                    future.result()
+                    counts['fetched'] += 1
+                except (ValueError, ImageFetchError) as e:
+                    counts['failed'] += 1
+                    print(f'Error prefetching image: {e}')
+
+                if progress_callback is not None:
+                    progress_callback(counts['fetched'] + counts['failed'], len(todo), f'{counts["fetched"]} images fetched')
+    finally:
+        executor.shutdown(wait = False, cancel_futures = True)
+
+    print(f'Prefetched images: {counts}')
+    return counts
+
+#------------------------------------
+# Helper functions
+#------------------------------------
+
+def _check_url(url, kind):
+    if kind not in config.IMAGE_THUMBNAIL_SIZES:
+        raise ValueError(f'Unknown image kind {kind}, must be one of {list(config.IMAGE_THUMBNAIL_SIZES)}')
+
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or parsed.hostname not in config.IMAGE_PROXY_ALLOWED_HOSTS:
+        raise ValueError(f'Only images from {config.IMAGE_PROXY_ALLOWED_HOSTS} can be proxied')
+
+def _touch(path):
+    ''' Mark a cached thumbnail as recently used. Returns False if it isn't cached. '''
+    try:
+        if time.time() - os.path.getmtime(path) > TOUCH_INTERVAL_SEC:
+            os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _fetch(url):
+    global _client
+
+    with _lock:
+        if _client is None:
+            _client = httpx.Client(timeout = FETCH_TIMEOUT_SEC)
+
+    try:
+        response = _client.get(url)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        raise ImageFetchError(f'Could not fetch {url}: {e}') from e
+
+    if len(response.content) > MAX_IMAGE_BYTES:
+        raise ImageFetchError(f'Image at {url} is over {MAX_IMAGE_BYTES} bytes')
+    return response.content
+
+def _save_thumbnail(data, kind, path):
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail(config.IMAGE_THUMBNAIL_SIZES[kind])
+        if image.mode in ('RGBA', 'LA', 'P'): # JPEG has no transparency, put it on a white background
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask = image.getchannel('A'))
+            image = background
+        image = image.convert('RGB')
+    except (OSError, ValueError) as e: # not an image / truncated
+        raise ImageFetchError(f'Could not read image: {e}') from e
+
+    # write to a temporary file first, so a thumbnail is never served half written
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    image.save(temp_path, 'JPEG', quality = THUMBNAIL_QUALITY, optimize = True)
+    os.replace(temp_path, path)
+
+    _add_to_cache_size(os.path.getsize(path))
+
+def _add_to_cache_size(num_bytes):
+    global _cache_size
+
+    with _lock:
+        if _cache_size is None:
+            _cache_size = sum(size for _, _, size in _cached_files())
+        else:
+            _cache_size += num_bytes
+
+        if _cache_size > config.IMAGE_CACHE_MAX_MB * 1024 * 1024:
+            _cache_size = _evict(int(0.9 * config.IMAGE_CACHE_MAX_MB * 1024 * 1024))
+
+def _evict(max_bytes):
+    ''' Delete least recently used thumbnails until the cache is under max_bytes. Returns the new cache size. '''
+    files = sorted(_cached_files(), key = lambda f: f[1])
+    total = sum(size for _, _, size in files)
+
+    evicted = 0
+    for path, _, size in files:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+
+    print(f'Image cache: evicted {evicted} thumbnails, {total / 1024 / 1024:.1f} MB left')
+    return total
+
+def _cached_files():
+    ''' (path, last used time, size in bytes) of every cached thumbnail '''
+    if not os.path.isdir(IMAGE_CACHE_DIR):
+        return []
+
+    files = []
+    for subdir in os.scandir(IMAGE_CACHE_DIR):
+        if subdir.is_dir():
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.jpg'):
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_mtime, stat.st_size))
+    return files
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Download + cache the thumbnails of every user in the database')
+    parser.add_argument('-w', '--workers', type=int, default=config.IMAGE_PREFETCH_WORKERS, help='Number of downloads at the same time')
+    args = parser.parse_args()
+
+    prefetch_thumbnails(workers = args.workers)
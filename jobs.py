@@ -0,0 +1,226 @@
+''' Background jobs for the long running scrape / flag tasks, so they don't tie up a web server request.
+
+Jobs run in a bounded thread pool and are saved in the database jobs table, so their status, progress and
+results can be checked from the web UI. Jobs that were queued or running when the server stopped are
+started again on the next startup - the scrapers resume from their checkpoints.
+
+Register a job type with the @job_type decorator. The function gets the Job as its first argument and should call
+job.progress() regularly, which also raises JobCancelled when the job was cancelled. Anything that waits (rate limits,
+the scrape scheduler) should be passed job.cancel_event so it returns right away on cancel or shutdown.
+'''
+import datetime
+import json
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from build_database import db_connection
+import config
+import metrics
+
+JOBS_TABLE = 'jobs'
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+
+JOB_TYPES = {}
+_executor = None
+_active_jobs = {}
+_futures = set()
+_shutting_down = threading.Event()
+_lock = threading.Lock()
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self, job_id, kind, params):
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.cancel_event = threading.Event()
+        self._last_progress_save = 0
+
+    def progress(self, done, total = None, message = None):
+        ''' Report progress. Raises JobCancelled if the job was cancelled, so long loops stop right away. '''
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+        # don't write to the database more than once a second
+        now = time.monotonic()
+        if now - self._last_progress_save >= 1 or (total is not None and done >= total):
+            self._last_progress_save = now
+            _update_job(self.id, progress_done = done, progress_total = total, message = message)
+
+    def update_params(self, **params):
+        ''' Change the saved params the job is restarted with after a server restart, ie. once a step that
+        shouldn't be repeated is done '''
+        self.params.update(params)
+        _update_job(self.id, params = json.dumps(self.params))
+
+    def __call__(self, done, total = None, message = None):
+        ''' So a job can be passed as progress_callback '''
+        self.progress(done, total, message)
+
+def job_type(kind):
+    ''' Decorator registering a function as a job type '''
+    def register(func):
+        JOB_TYPES[kind] = func
+        return func
+    return register
+
+#-----------------------
+# Job management
+#-----------------------
+def start(max_workers = None):
+    ''' Start the worker pool and restart jobs interrupted by the last shutdown '''
+    global _executor
+
+    _shutting_down.clear()
+    _executor = ThreadPoolExecutor(max_workers = max_workers or config.JOB_WORKERS, thread_name_prefix = 'job')
+
+    with db_connection() as con:
+        _create_jobs_table(con)
+        interrupted = con.execute(
+            f"SELECT id, kind, params FROM {JOBS_TABLE} WHERE status IN ('queued', 'running') ORDER BY created_at").fetchall()
+
+    for job_id, kind, params in interrupted:
+        print(f'Restarting interrupted job {job_id}: {kind}')
+        _update_job(job_id, status = 'queued', message = 'Restarted after server restart')
+        _submit(Job(job_id, kind, json.loads(params)))
+
+def shutdown(timeout = None):
+    ''' Stop the worker pool. Running jobs are told to stop and left as running in the database,
+    so they're restarted by start(). Waits up to timeout seconds (default config.JOB_SHUTDOWN_TIMEOUT_SEC) for them. '''
+    if _executor is None:
+        return
+
+    _shutting_down.set()
+    with _lock:
+        for job in _active_jobs.values():
+            job.cancel_event.set()
+        futures = set(_futures)
+    _executor.shutdown(wait = False, cancel_futures = True)
+    # jobs that were still queued never started, wait() wouldn't count their cancelled futures as done
+    futures = [future for future in futures if not future.cancelled()]
+
+    _, still_running = wait(futures, timeout = timeout if timeout is not None else config.JOB_SHUTDOWN_TIMEOUT_SEC)
+    if still_running:
+        print(f'{len(still_running)} jobs did not stop within the shutdown timeout')
+
+def submit(kind, **params):
+    ''' Queue a job, returns the job id '''
+    if kind not in JOB_TYPES:
+        raise ValueError(f'Unknown job type {kind}, must be one of {list(JOB_TYPES)}')
+
+    job = Job(uuid.uuid4().hex[:12], kind, params)
+    with db_connection() as con:
+        _create_jobs_table(con)
+        con.execute(f'''INSERT INTO {JOBS_TABLE} (id, kind, params, status, created_at)
+            VALUES (?, ?, ?, 'queued', ?)''', (job.id, kind, json.dumps(params), _now()))
+
+    _submit(job)
+    return job.id
+
+def cancel(job_id):
+    ''' Cancel a queued or running job. Returns False if the job doesn't exist or already finished. '''
+    job = get_job(job_id)
+    if job is None or job['status'] in FINISHED_STATUSES:
+        return False
+
+    with _lock:
+        active_job = _active_jobs.get(job_id)
+    if active_job is not None:
+        active_job.cancel_event.set()
+
+    if job['status'] == 'queued':
+        _update_job(job_id, status = 'cancelled', finished_at = _now())
+    return True
+
+def get_job(job_id):
+    ''' Job status, progress and result as a dict, None if it doesn't exist '''
+    jobs = list_jobs(job_id = job_id)
+    return jobs[0] if jobs else None
+
+def list_jobs(limit = 50, job_id = None):
+    ''' Most recent jobs first '''
+    with db_connection() as con:
+        _create_jobs_table(con)
+        where, params = ('WHERE id = ?', (job_id,)) if job_id else ('', ())
+        cursor = con.execute(f'SELECT * FROM {JOBS_TABLE} {where} ORDER BY created_at DESC LIMIT {int(limit)}', params)
+        columns = [c[0] for c in cursor.description]
+        jobs = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    for job in jobs:
+        job['params'] = json.loads(job['params']) if job['params'] else {}
+        job['result'] = json.loads(job['result']) if job['result'] else None
+    return jobs
+
+#-----------------------
+# Helpers
+#-----------------------
+def _submit(job):
+    if _executor is None:
+        raise RuntimeError('jobs.start() has to be called before submitting jobs')
+
+    with _lock:
+        _active_jobs[job.id] = job
+        future = _executor.submit(_run, job)
+        _futures.add(future)
+    future.add_done_callback(_forget_future)
+
+def _forget_future(future):
+    with _lock:
+        _futures.discard(future)
+
+def _run(job):
+    start, status = time.perf_counter(), 'failed'
+    try:
+        if get_job(job.id)['status'] == 'cancelled': # cancelled while it was queued
+            status = 'cancelled'
+            return
+
+        _update_job(job.id, status = 'running', started_at = _now())
+        with metrics.profiled(f'job_{job.kind}', enabled = config.PROFILING_ENABLED):
+            result = JOB_TYPES[job.kind](job, **job.params)
+        # job functions that pass job.cancel_event on return early when it's set, they didn't finish
+        if job.cancel_event.is_set():
+            raise JobCancelled()
+        _update_job(job.id, status = 'done', result = json.dumps(result), finished_at = _now())
+        status = 'done'
+
+    except JobCancelled:
+        if _shutting_down.is_set():
+            # left as running in the database, so start() restarts it
+            print(f'Job {job.id} ({job.kind}) stopped for shutdown')
+            status = 'interrupted'
+        else:
+            _update_job(job.id, status = 'cancelled', finished_at = _now())
+            print(f'Job {job.id} ({job.kind}) cancelled')
+            status = 'cancelled'
+
+    except Exception as e:
+        traceback.print_exc()
+        _update_job(job.id, status = 'failed', error = f'{type(e).__name__}: {e}', finished_at = _now())
+
+    finally:
+        with _lock:
+            _active_jobs.pop(job.id, None)
+        metrics.observe('job_seconds', time.perf_counter() - start, kind = job.kind, status = status)
+
+def _update_job(job_id, **values):
+    values = {k: v for k, v in values.items() if v is not None}
+    if not values:
+        return
+    assignments = ', '.join(f'{k} = ?' for k in values)
+    with db_connection() as con:
+        con.execute(f'UPDATE {JOBS_TABLE} SET {assignments} WHERE id = ?', list(values.values()) + [job_id])
+
+def _create_jobs_table(con):
+    con.execute(f'''CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (
+        id TEXT PRIMARY KEY, kind TEXT, params TEXT, status TEXT,
+        progress_done REAL, progress_total REAL, message TEXT, result TEXT, error TEXT,
+        created_at TEXT, started_at TEXT, finished_at TEXT)''')
+
+def _now():
+    return f'{datetime.datetime.now()}'
@@ -0,0 +1,169 @@
+''' Counters + timers for the scrape, flag, graph and database hot paths, served in Prometheus text format at /metrics.
+
+Record with
+    metrics.inc('scrape_requests_total', 2, session = 'session_0')
+    with metrics.timer('graph_stage_seconds', stage = 'layout'):
+        ...
+
+Timers are Prometheus summaries: <name>_count and <name>_sum (total seconds), so average time = sum / count.
+Metrics live in the process that recorded them. Work done in a worker process is sent back with
+call_with_metrics() + merge().
+
+profiled() dumps a cProfile of a block of code to PROFILE_DIR. It's used for requests with ?profile=1 and
+for background jobs when config.PROFILING_ENABLED is set. Open the .prof files with snakeviz or pstats,
+or read the .txt summary next to them.
+'''
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'profiles')
+
+METRIC_HELP = {
+    'scrape_requests_total': ('counter', 'Twitter requests made, per scraping session'),
+    'scrape_errors_total': ('counter', 'Failed Twitter requests per scraping session, by error kind'),
+    'scrape_rate_limit_wait_seconds_total': ('counter', 'Seconds spent waiting for the rate limit, per scraping session'),
+    'scrape_fetch_seconds': ('summary', 'Time per successful fetch (one user / action), per scraping session'),
+    'scrape_pages_total': ('counter', 'Pages of followers fetched by create_database()'),
+    'flag_rule_seconds': ('summary', 'Time per flag function run'),
+    'flag_rule_evaluated_total': ('counter', 'Users a flag function was run on'),
+    'flag_rule_flagged_total': ('counter', 'Users flagged by a flag function'),
+    'flag_run_seconds': ('summary', 'Time per get_all_flagged_users() call'),
+    'graph_requests_total': ('counter', 'Graph generations by result: cached or generated'),
+    'graph_stage_seconds': ('summary', 'Time per graph generation stage'),
+    'graph_pairs_evaluated_total': ('counter', 'User pairs whose similarity was computed'),
+    'graph_edges_kept_total': ('counter', 'User pairs above the similarity threshold'),
+    'graph_minhash_fallbacks_total': ('counter', 'MinHash graphs computed exactly because the similarity threshold was too low for LSH'),
+    'graph_minhash_large_buckets_total': ('counter', 'LSH buckets too big to pair up, compared with exact Jaccard instead'),
+    'db_load_seconds': ('summary', 'Time per load of the users table, by source: cache, full read or query'),
+    'db_write_seconds': ('summary', 'Time per write to the users table'),
+    'db_rows_written_total': ('counter', 'Rows written to the users table'),
+    'session_logins_total': ('counter', 'Twitter logins by the session pool, by account role and result'),
+    'http_request_seconds': ('summary', 'Time per web request, by route'),
+    'job_seconds': ('summary', 'Time per background job, by job type and final status'),
+}
+
+_counters = {}
+_timers = {} # (name, labels): [count, sum]
+_lock = threading.Lock()
+
+def inc(name, value = 1, **labels):
+    ''' Add value to a counter '''
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    ''' Record one timing in a summary '''
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        count_sum = _timers.setdefault(key, [0, 0.0])
+        count_sum[0] += 1
+        count_sum[1] += seconds
+
+@contextmanager
+def timer(name, **labels):
+    ''' Time the with block into a summary, even if it raises '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def snapshot():
+    ''' Copy of every metric, for sending back from worker processes '''
+    with _lock:
+        return {'counters': dict(_counters), 'timers': {key: list(value) for key, value in _timers.items()}}
+
+def merge(metrics_snapshot):
+    ''' Add the metrics from snapshot() of another process to this one '''
+    with _lock:
+        for key, value in metrics_snapshot['counters'].items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, (count, total) in metrics_snapshot['timers'].items():
+            count_sum = _timers.setdefault(key, [0, 0.0])
+            count_sum[0] += count
+            count_sum[1] += total
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+def call_with_metrics(func, *args, profile_name = None):
+    ''' Run func(*args) in a worker process, returns (result, metrics recorded during the call) for merge().
+    profile_name {str} -- cProfile the call, see profiled() '''
+    reset()
+    with profiled(profile_name, enabled = profile_name is not None):
+        result = func(*args)
+    return result, snapshot()
+
+def render():
+    ''' Every metric in Prometheus text exposition format '''
+    values = snapshot()
+    series = {}
+    for (name, labels), value in values['counters'].items():
+        series.setdefault(name, []).append((name, labels, value))
+    for (name, labels), (count, total) in values['timers'].items():
+        series.setdefault(name, []).extend([(f'{name}_count', labels, count), (f'{name}_sum', labels, total)])
+
+    lines = []
+    for name in sorted(series):
+        kind, description = METRIC_HELP.get(name, ('untyped', ''))
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+        for sample_name, labels, value in sorted(series[name], key = lambda s: (s[1], s[0])):
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+            lines.append(f'{sample_name}{{{label_text}}} {_format_value(value)}' if label_text else f'{sample_name} {_format_value(value)}')
+
+    return '\n'.join(lines) + '\n'
+
+#------------------------------------
+# Profiling
+#------------------------------------
+
+@contextmanager
+def profiled(name, enabled = True):
+    ''' cProfile the with block (in this thread only) and save it to PROFILE_DIR/<time>_<name>.prof + a .txt summary.
+    Yields a dict whose 'path' is set to the .prof file once the block is done. '''
+    dump = {'path': None}
+    if not enabled:
+        yield dump
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError: # another profiler is already running in this thread (python >= 3.12)
+        yield dump
+        return
+
+    try:
+        yield dump
+    finally:
+        profiler.disable()
+
+        os.makedirs(PROFILE_DIR, exist_ok = True)
+        filename = f'{datetime.datetime.now():%Y%m%d_%H%M%S_%f}_{re.sub(r"[^A-Za-z0-9_]+", "_", name).strip("_")}'
+        dump['path'] = os.path.join(PROFILE_DIR, f'{filename}.prof')
+        profiler.dump_stats(dump['path'])
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream = summary).sort_stats('cumulative').print_stats(40)
+        with open(os.path.join(PROFILE_DIR, f'{filename}.txt'), 'w') as file:
+            file.write(summary.getvalue())
+
+#------------------------------------
+# Helper functions
+#------------------------------------
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,179 @@
+''' Rate limit aware scheduler that spreads scraping work across a pool of Tweety sessions.
+
+Every scraping account gets its own token bucket sized to Twitter's rate limits
+(50 requests per 15 minutes per the tweety docs: https://github.com/mahrtayyab/tweety/wiki/FAQs#twitter-new-limits)
+plus exponential backoff on errors, so throughput scales with the number of accounts
+instead of being fixed by a global sleep.
+'''
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import metrics
+
+class TokenBucket:
+    ''' Thread safe token bucket. Holds up to capacity tokens, refilled continuously at capacity / period_sec. '''
+
+    def __init__(self, capacity = None, period_sec = None, clock = time.monotonic):
+        self.capacity = capacity if capacity is not None else config.SCRAPING_RATE_LIMIT_REQUESTS
+        self.period_sec = period_sec if period_sec is not None else config.SCRAPING_RATE_LIMIT_PERIOD_SEC
+        self.clock = clock
+
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens = 1, cancel_event = None, timeout = None):
+        ''' Block until tokens are available and take them. Returns seconds spent waiting,
+        or None if cancel_event got set, or more than timeout seconds would be needed, while waiting. '''
+        tokens = min(tokens, self.capacity)
+        cancel_event = cancel_event or threading.Event()
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                now = self._refill()
+                if now >= self.paused_until and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                wait = max(self.paused_until - now, (tokens - self.tokens) * self.period_sec / self.capacity)
+
+            if timeout is not None and waited + wait > timeout:
+                return None
+            if cancel_event.wait(wait):
+                return None
+            waited += wait
+
+    def pause(self, seconds, drain = False):
+        ''' Don't hand out tokens for the next seconds. drain empties the bucket too (ie. after hitting a rate limit) '''
+        with self._lock:
+            now = self._refill()
+            self.paused_until = max(self.paused_until, now + seconds)
+            if drain:
+                self.tokens = 0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.period_sec)
+        self.updated = now
+        return now
+
+class ScrapingSession:
+    ''' An authenticated Tweety app + its rate limit budget and error stats '''
+
+    def __init__(self, app, name = 'session', bucket = None):
+        self.app = app
+        self.name = name
+        self.bucket = bucket if bucket is not None else TokenBucket()
+
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.rate_limit_wait_sec = 0.0
+        self.retired = False
+
+    def __repr__(self):
+        return (f'ScrapingSession({self.name}: {self.requests} requests, {self.errors} errors, '
+                f'{self.rate_limit_wait_sec:.0f}s rate limit waits{", retired" if self.retired else ""})')
+
+def is_rate_limit_error(e):
+    ''' Works for tweety.exceptions.RateLimitReached across tweety versions and fake_twitter.RateLimitReached '''
+    return type(e).__name__ == 'RateLimitReached'
+
+def run_scrape_jobs(sessions, items, fetch, requests_per_item = 1, max_retries = 2,
+                    max_consecutive_errors = 5, backoff_base_sec = 30, backoff_max_sec = 15 * 60, cancel_event = None):
+    ''' Run fetch(app, item) for every item, spread across sessions. One worker thread per session.
+    Generator yielding (item, result, error) in completion order - error is None on success.
+    Consume results in the calling thread, so saving to the database doesn't need any locking.
+
+    requests_per_item {int} -- Rate limit tokens each fetch uses, ie. number of pages requested
+    max_retries {int} -- Times a failed item is put back in the queue before yielding its error
+    max_consecutive_errors {int} -- Retire a session after this many errors in a row (ie. account locked)
+    backoff_base_sec, backoff_max_sec {float} -- Exponential backoff for a session after a non rate limit error.
+                                                 Rate limit errors pause the session until retry_after instead.
+    cancel_event {threading.Event} -- Stop early when it's set, ie. the job was cancelled. Rate limit waits return right away,
+                                      items that were already being fetched are still yielded.
+    '''
+    items = list(items)
+    work = queue.Queue()
+    for item in items:
+        work.put((item, 0))
+
+    results = queue.Queue()
+    stop = threading.Event()
+    cancel_event = cancel_event or threading.Event()
+
+    def worker(session):
+        while not stop.is_set() and not cancel_event.is_set():
+            try:
+                item, attempt = work.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+
+            waited = session.bucket.acquire(requests_per_item, cancel_event = stop)
+            if waited is None:
+                return
+            session.rate_limit_wait_sec += waited
+            session.requests += requests_per_item
+            metrics.inc('scrape_rate_limit_wait_seconds_total', waited, session = session.name)
+            metrics.inc('scrape_requests_total', requests_per_item, session = session.name)
+
+            start = time.perf_counter()
+            try:
+                result = fetch(session.app, item)
+            except Exception as e:
+                session.errors += 1
+                session.consecutive_errors += 1
+                metrics.inc('scrape_errors_total', session = session.name, kind = 'rate_limit' if is_rate_limit_error(e) else 'error')
+
+                if is_rate_limit_error(e):
+                    session.bucket.pause(getattr(e, 'retry_after', None) or session.bucket.period_sec, drain = True)
+                else:
+                    backoff = min(backoff_base_sec * 2 ** (session.consecutive_errors - 1), backoff_max_sec)
+                    session.bucket.pause(backoff)
+
+                if attempt < max_retries:
+                    work.put((item, attempt + 1))
+                else:
+                    results.put((item, None, e))
+
+                if session.consecutive_errors >= max_consecutive_errors:
+                    print(f'{session.name}: {session.consecutive_errors} errors in a row, no longer using this session. Error: {e}')
+                    session.retired = True
+                    return
+                continue
+
+            session.consecutive_errors = 0
+            metrics.observe('scrape_fetch_seconds', time.perf_counter() - start, session = session.name)
+            results.put((item, result, None))
+
+    executor = ThreadPoolExecutor(max_workers = len(sessions), thread_name_prefix = 'scraper')
+    for session in sessions:
+        executor.submit(worker, session)
+
+    try:
+        finished = 0
+        while finished < len(items) and not cancel_event.is_set():
+            try:
+                item, result, error = results.get(timeout = 0.5)
+            except queue.Empty:
+                if all(session.retired for session in sessions):
+                    print('All scraping sessions failed, stopping.')
+                    break
+                continue
+
+            finished += 1
+            yield item, result, error
+
+        if cancel_event.is_set():
+            # fetches still running when it was cancelled already did their requests, ie. blocked a user, so hand them over too
+            stop.set()
+            executor.shutdown(wait = True, cancel_futures = True)
+            while not results.empty():
+                yield results.get()
+    finally:
+        stop.set()
+        executor.shutdown(wait = False, cancel_futures = True)
@@ -1,58 +1,156 @@
 
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, Form, HTTPException
+from fastapi.responses import HTMLResponse, Response, FileResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from typing_extensions import Annotated
+from typing import Optional
 from fastapi.templating import Jinja2Templates
 import build_database
 import flag_users
 import graph_analysis
-
+import jobs
+import bulk_actions
+import snapshots
+import image_cache
+import metrics
+import session_pool
+
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import asynccontextmanager
 
-from tweety import Twitter
 import config
 import time
+import json
 
 #-----------------------------------
 # Initialize fastapi + twitter login
 #-----------------------------------
 
-authenticated_app = None
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global authenticated_app
-
     # The code before the "yield" statement gets run on startup
-    if config.MAIN_ACCOUNT_USERNAME and config.MAIN_ACCOUNT_PASSWORD:
-        try:
-            authenticated_app = Twitter("session")
-            authenticated_app.sign_in(config.MAIN_ACCOUNT_USERNAME, config.MAIN_ACCOUNT_PASSWORD)
-            print('Twitter app authenticated')
-        except:
-            authenticated_app = None
-            print('Twitter authentication failed. Blocking / force unfollow features disabled')
-
-    else:
-        print('No main account login credentials entered. Blocking / force unfollow features disabled')
+    # main + scraping accounts are logged in once here and lent out to the jobs, see session_pool.py
+    session_pool.start()
+
+    # scrape / flag jobs run in the background, interrupted jobs get restarted
+    jobs.start()
+    start_heavy_request_pools()
 
     yield
     # code after the "yield" statement gets run on shutdown after app finishes handling requests
+    jobs.shutdown()
+    shutdown_heavy_request_pools()
+    session_pool.shutdown()
+
+
+#-----------------------------------
+# Offloading slow requests
+#-----------------------------------
+
+# Async routes run on the event loop, so anything slow in them freezes every other request. CPU heavy work
+# (graph generation) goes to a process pool, slow database work to a thread pool. See HEAVY_REQUEST_* in config.py
+_process_pool = None
+_thread_pool = None
+_heavy_requests = None
+_in_progress = {}
+_profile_request = contextvars.ContextVar('profile_request', default = False)
+
+def start_heavy_request_pools():
+    global _process_pool, _thread_pool, _heavy_requests
+
+    config_values = {name: getattr(config, name) for name in dir(config) if name.isupper()}
+    # spawn, not fork: forking copies locks held by the job / session pool threads, which can hang the workers
+    _process_pool = ProcessPoolExecutor(max_workers = config.HEAVY_REQUEST_PROCESSES, mp_context = multiprocessing.get_context('spawn'),
+                                        initializer = _init_heavy_request_worker, initargs = (config_values,))
+    _thread_pool = ThreadPoolExecutor(max_workers = config.HEAVY_REQUEST_CONCURRENCY, thread_name_prefix = 'heavy_request')
+    _heavy_requests = asyncio.Semaphore(config.HEAVY_REQUEST_CONCURRENCY)
+
+def shutdown_heavy_request_pools():
+    for pool in (_process_pool, _thread_pool):
+        if pool is not None:
+            pool.shutdown(wait = False, cancel_futures = True)
+
+async def run_heavy(func, *args, processes = True):
+    ''' Run func(*args) in the process pool (processes = False: thread pool) without blocking the event loop.
+    Identical calls already running are shared instead of started again. Raises HTTPException 503 after
+    config.HEAVY_REQUEST_TIMEOUT_SEC - the call itself keeps running, so cached results are ready on a retry. '''
+    if _heavy_requests is None: # app used without its lifespan, ie. TestClient outside a with block
+        start_heavy_request_pools()
+
+    key = (func.__module__, func.__name__, args)
+    future = _in_progress.get(key)
+    if future is None:
+        profile_name = func.__name__ if _profile_request.get() else None
+        future = asyncio.ensure_future(_run_limited(func, args, processes, profile_name))
+        _in_progress[key] = future
+        future.add_done_callback(lambda _: _in_progress.pop(key, None))
+
+    try:
+        # shield so a request that times out doesn't cancel the call for other requests waiting on it
+        return await asyncio.wait_for(asyncio.shield(future), timeout = config.HEAVY_REQUEST_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code = 503, detail = f'{func.__name__} is taking a while, try again in a minute',
+                            headers = {'Retry-After': '60'})
+
+async def _run_limited(func, args, processes, profile_name):
+    loop = asyncio.get_running_loop()
+    async with _heavy_requests:
+        if not processes:
+            return await loop.run_in_executor(_thread_pool, functools.partial(_call_profiled, func, args, profile_name))
+
+        # metrics recorded in the worker process are sent back with the result
+        result, worker_metrics = await loop.run_in_executor(
+            _process_pool, functools.partial(metrics.call_with_metrics, func, *args, profile_name = profile_name))
+        metrics.merge(worker_metrics)
+        return result
+
+def _call_profiled(func, args, profile_name):
+    with metrics.profiled(profile_name, enabled = profile_name is not None):
+        return func(*args)
+
+def _init_heavy_request_worker(config_values):
+    ''' Runs once in each worker process: copy over the parent's config '''
+    for name, value in config_values.items():
+        setattr(config, name, value)
 
 
 app = FastAPI(lifespan = lifespan)
+app.add_middleware(GZipMiddleware, minimum_size = 1000) # graph payloads + user pages compress well
 templates = Jinja2Templates(directory="templates")
 
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    ''' Time every request for /metrics. With config.PROFILING_ENABLED, ?profile=1 saves a cProfile of the request.
+    cProfile only sees the event loop thread, so plain def routes (run in FastAPI's threadpool) show up as waiting -
+    work sent to run_heavy() is profiled in its worker and saved as a separate file. '''
+    profile = config.PROFILING_ENABLED and request.query_params.get('profile') == '1'
+    _profile_request.set(profile)
+
+    start = time.perf_counter()
+    with metrics.profiled(f'request_{request.url.path}', enabled = profile) as dump:
+        response = await call_next(request)
+
+    route = request.scope.get('route')
+    metrics.observe('http_request_seconds', time.perf_counter() - start, route = getattr(route, 'path', 'unmatched'), method = request.method)
+    if dump['path']:
+        response.headers['X-Profile'] = os.path.basename(dump['path'])
+    return response
+
 #-----------------------------------
 # GET request routes
 #-----------------------------------
 
 @app.get("/", response_class = HTMLResponse)
 async def root(request: Request):
-    df = build_database.load_database()
+    # rows are fetched page by page from /api/users by the browser
     return templates.TemplateResponse(
         request=request, name="database_render.html", 
-        context={"df": df, 'is_auth': authenticated_app is not None}
+        context={'is_auth': session_pool.main_account() is not None, 'sort_columns': USER_SORT_COLUMNS, 'image_proxy': config.IMAGE_PROXY_ENABLED}
     )
 
 @app.get("/scrape_data", response_class = HTMLResponse)
@@ -63,15 +161,21 @@ async def scrape_data(request: Request):
     )
 
 @app.get("/graph_analysis", response_class = HTMLResponse)
-async def scrape_data(request: Request):
+async def graph_analysis_page(request: Request):
 
-    html = graph_analysis.generate_graph_html()
+    # WebGL mode: the page fetches the graph from /api/graph
+    html = await run_heavy(graph_analysis.generate_graph_html) if config.GRAPH_RENDER_MODE == 'svg' else None
 
     return templates.TemplateResponse(
         request=request, name="graph_analysis.html", 
         context={"html": html}
     )
 
+@app.get("/snapshots", response_class = HTMLResponse)
+async def snapshot_history(request: Request):
+    # snapshot list + diffs are fetched from /api/snapshots by the browser
+    return templates.TemplateResponse(request=request, name="snapshots.html", context={})
+
 @app.get("/about", response_class = HTMLResponse)
 async def about(request: Request):
     html_content = """
@@ -86,50 +190,269 @@ async def about(request: Request):
     """
     return HTMLResponse(content = html_content, status_code = 200)
 
+#-----------------------------------
+# JSON API routes
+#-----------------------------------
+
+USER_SORT_COLUMNS = ['rowid', 'username', 'followers_count', 'friends_count', 'statuses_count', 'created_at']
+USER_PAGE_COLUMNS = [
+    'username', 'name', 'id', 'created_at', 'description', 'location', 'statuses_count', 'followers_count',
+    'friends_count', 'profile_banner_url', 'profile_image_url_https', 'protected', 'verified', 'flags']
+
+@app.get("/api/users")
+def api_users(
+        cursor: Optional[str] = None, limit: int = 100, sort: str = 'rowid', descending: bool = False,
+        flagged_only: bool = False, flag_reason: Optional[str] = None, created_after: Optional[str] = None,
+        min_followers: Optional[int] = None, max_followers: Optional[int] = None):
+    ''' One page of users for the review table. Filters + sorting are done in the database.
+    Pass next_cursor from the response as cursor to get the next page. '''
+    if sort not in USER_SORT_COLUMNS:
+        raise HTTPException(status_code = 400, detail = f'sort must be one of {USER_SORT_COLUMNS}')
+    limit = max(1, min(limit, 500))
+
+    conditions, params = [], []
+    if flagged_only:
+        conditions.append("flags IS NOT NULL AND flags NOT IN ('', 'no_flag')")
+    if flag_reason:
+        conditions.append("flags LIKE '%' || ? || '%'")
+        params.append(flag_reason)
+    if created_after:
+        conditions.append('created_at >= ?')
+        params.append(created_after)
+    if min_followers is not None:
+        conditions.append('followers_count >= ?')
+        params.append(min_followers)
+    if max_followers is not None:
+        conditions.append('followers_count <= ?')
+        params.append(max_followers)
+    where = ' AND '.join(conditions) or None
+
+    try:
+        df, next_cursor = build_database.load_database_page(
+            where, params, sort = sort, descending = descending, cursor = cursor, limit = limit, columns = USER_PAGE_COLUMNS)
+        total = build_database.count_database(where, params) if cursor is None else None
+    except FileNotFoundError:
+        return {"users": [], "next_cursor": None, "total": 0}
+
+    return {"users": json.loads(df.to_json(orient = 'records')), "next_cursor": next_cursor, "total": total}
+
+@app.get("/api/graph")
+async def api_graph():
+    ''' Network graph nodes + edges for the WebGL renderer, see graph_analysis.get_graph_payload() '''
+    return Response(content = await run_heavy(graph_analysis.generate_graph_data), media_type = 'application/json')
+
+@app.get("/api/clusters")
+async def api_clusters():
+    ''' Bot clusters (groups of users following nearly the same accounts), biggest first. See graph_analysis.find_clusters() '''
+    return {"clusters": await run_heavy(graph_analysis.get_cluster_summary)}
+
+@app.get("/metrics")
+def get_metrics():
+    ''' Scrape / flag / graph / database timings + counters in Prometheus text format, see metrics.py '''
+    return Response(content = metrics.render(), media_type = 'text/plain; version=0.0.4; charset=utf-8')
+
+@app.get("/api/sessions")
+def api_sessions():
+    ''' Login state of the pooled Twitter sessions, see session_pool.py '''
+    return {"sessions": session_pool.status()}
+
+@app.get("/image")
+def image(request: Request, url: str, kind: str = 'avatar'):
+    ''' Thumbnail of a profile / banner image, downloaded once and served from the local image cache '''
+    try:
+        path = image_cache.get_thumbnail(url, kind)
+    except ValueError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    except image_cache.ImageFetchError as e:
+        raise HTTPException(status_code = 502, detail = str(e))
+
+    # thumbnails never change, browsers can keep them for good
+    etag = image_cache.thumbnail_etag(path)
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=31536000, immutable'}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code = 304, headers = headers)
+    return FileResponse(path, media_type = image_cache.THUMBNAIL_MEDIA_TYPE, headers = headers)
+
+@app.get("/api/snapshots")
+def api_snapshots(username: Optional[str] = None):
+    ''' Snapshots of the followers database, one per finished scrape, newest first '''
+    return {"snapshots": snapshots.list_snapshots(username)}
+
+@app.get("/api/snapshots/diff")
+async def api_snapshots_diff(old: Optional[int] = None, new: Optional[int] = None):
+    ''' Followers added / removed / with changed profiles between 2 snapshots. Default: the latest snapshot vs the one before it '''
+    return await run_heavy(_snapshots_diff, old, new, processes = False)
+
+def _snapshots_diff(old, new):
+    if new is None or old is None:
+        history = snapshots.list_snapshots()
+        if not history:
+            raise HTTPException(status_code = 404, detail = 'No snapshots yet, they are saved when a follower scrape finishes')
+        new = history[0]['snapshot_id'] if new is None else new
+        username = next((s['username'] for s in history if s['snapshot_id'] == new), None)
+        older = [s['snapshot_id'] for s in history if s['snapshot_id'] < new and s['username'] == username]
+        old = old if old is not None else (older[0] if older else new)
+
+    try:
+        diff = snapshots.diff_snapshots(old, new)
+    except KeyError as e:
+        raise HTTPException(status_code = 404, detail = str(e.args[0]))
+    except ValueError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+
+    return {"old": old, "new": new, **diff}
+
 #-------------------------------------------------
-# POST request routes - Data Scraping / Processing
+# Background jobs - Data Scraping / Processing
 #-------------------------------------------------
 
-@app.post("/scrape_follower_profiles/")
-def scrape_follower_profiles(username: Annotated[str, Form()],  pages: Annotated[int, Form()] = False):
-    
-    build_database.create_database(username, pages = pages)
+@jobs.job_type('scrape_follower_profiles')
+def scrape_follower_profiles_job(job, username, pages, fresh = False):
+    with session_pool.borrow_scraping_sessions(count = 1, while_waiting = job) as sessions:
+        build_database.create_database(username, pages = pages, authenticated_app = sessions[0].app, fresh = fresh,
+                                       progress_callback = job, cancel_event = job.cancel_event,
+                                       # restarting the job after the drop resumes from the checkpoint
+                                       dropped_callback = lambda: job.update_params(fresh = False))
+    if job.cancel_event.is_set():
+        raise jobs.JobCancelled()
+
+    # get the new followers' images ready before they're reviewed
+    if config.IMAGE_PROXY_ENABLED and config.IMAGE_PREFETCH_AFTER_SCRAPE:
+        return {"msg": 'Done', "prefetch_job_id": jobs.submit('prefetch_images')}
     return {"msg": 'Done'}
 
-@app.post("/run_flags/")
-def run_flags():
+@jobs.job_type('run_flags')
+def run_flags_job(job, workers):
+    job.progress(0, 3, 'Loading database')
     df = build_database.load_database()
-    flag_ids, reasons = flag_users.get_all_flagged_users(df)
+
+    job.progress(1, 3, f'Flagging {len(df)} users')
+    flag_ids, reasons = flag_users.get_all_flagged_users(df, workers = workers)
+
+    job.progress(2, 3, 'Saving flags')
     flag_users.update_database_with_flags(df, flag_ids, reasons)
 
     result = f'Flagged {len(flag_ids)} users'
     print(result)
-    return {"msg": result}
+    return {"msg": result, "nonsense_cache": flag_users.get_nonsense_cache_stats(), "flag_functions": flag_users.get_flag_run_stats()}
+
+@jobs.job_type('prefetch_images')
+def prefetch_images_job(job):
+    return image_cache.prefetch_thumbnails(progress_callback = job, cancel_event = job.cancel_event)
+
+@jobs.job_type('scrape_follower_followings')
+def scrape_follower_followings_job(job, pages):
+    with session_pool.borrow_scraping_sessions(while_waiting = job) as sessions:
+        build_database.scrape_all_db_followers(sessions, pages = pages, progress_callback = job, cancel_event = job.cancel_event)
+    return {"msg": 'Done'}
+
+#-------------------------------------------------
+# POST request routes - Data Scraping / Processing
+#-------------------------------------------------
+
+@app.post("/scrape_follower_profiles/")
+def scrape_follower_profiles(username: Annotated[str, Form()], pages: Annotated[int, Form(alias = 'profile_pages')] = 1,
+                             fresh: Annotated[bool, Form()] = False):
+    job_id = jobs.submit('scrape_follower_profiles', username = username, pages = pages, fresh = fresh)
+    return {"msg": 'Started', "job_id": job_id}
+
+@app.post("/run_flags/")
+def run_flags(workers: Annotated[int, Form()] = 1):
+    job_id = jobs.submit('run_flags', workers = workers)
+    return {"msg": 'Started', "job_id": job_id}
 
 @app.post("/scrape_follower_followings/")
 def scrape_follower_followings(pages: Annotated[int, Form()]):
-    build_database.scrape_all_db_followers(pages = pages)
+    job_id = jobs.submit('scrape_follower_followings', pages = pages)
+    return {"msg": 'Started', "job_id": job_id}
 
-    return {"msg": 'Done'}
+#-------------------------------------------------
+# Job status routes
+#-------------------------------------------------
+
+@app.get("/jobs")
+def list_jobs(limit: int = 50):
+    return {"jobs": jobs.list_jobs(limit = max(1, min(limit, 500)))}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code = 404, detail = f'No job {job_id}')
+    return job
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code = 404, detail = f'No job {job_id}')
+    if job['status'] != 'done':
+        raise HTTPException(status_code = 409, detail = f'Job {job_id} is {job["status"]}')
+    return job['result']
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    if not jobs.cancel(job_id):
+        raise HTTPException(status_code = 409, detail = f'Job {job_id} does not exist or already finished')
+    return {"msg": 'Cancelling'}
 
 #---------------------------------------
 # POST request routes - Manage Followers
 #---------------------------------------
 
+# max seconds a block / force unfollow button waits for the main account's rate limit budget
+SINGLE_ACTION_TIMEOUT_SEC = 10
+
 @app.post("/block/")
 def block_user(username: Annotated[str, Form()]):
     print('blocking:', username)
-    authenticated_app.block_user(username)
+    _perform_single_action('block', username)
     return {"msg": 'Done'}
 
 @app.post("/force_unfollow/")
 def force_unfollow(username: Annotated[str, Form()]):
     print('force_unfollowing:', username)
-    authenticated_app.block_user(username)
-    time.sleep(0.2)
-    authenticated_app.unblock_user(username)
+    if username in bulk_actions.get_actioned_usernames('block'):
+        raise HTTPException(status_code = 409, detail = f'@{username} is blocked, force unfollow would unblock them')
+    _perform_single_action('force_unfollow', username)
     return {"msg": 'Done'}
 
+@app.post("/bulk_action/")
+def bulk_action(action: Annotated[str, Form()], usernames: Annotated[str, Form()] = '', all_flagged: Annotated[bool, Form()] = False):
+    ''' Block / force unfollow every flagged user (all_flagged) or a list of usernames separated by spaces, commas or new lines '''
+    _main_account()
+    if action not in bulk_actions.ACTIONS:
+        raise HTTPException(status_code = 400, detail = f'action must be one of {bulk_actions.ACTIONS}')
+
+    usernames = usernames.replace(',', ' ').split()
+    if all_flagged:
+        usernames += bulk_actions.get_flagged_usernames()
+    usernames = [username.lstrip('@') for username in usernames]
+
+    job_id = jobs.submit('bulk_action', action = action, usernames = usernames)
+    return {"msg": 'Started', "job_id": job_id, "users": len(usernames)}
+
+@jobs.job_type('bulk_action')
+def bulk_action_job(job, action, usernames):
+    session = session_pool.main_session()
+    if session is None:
+        raise RuntimeError('Main account is not logged in')
+    return bulk_actions.run_bulk_action(session, action, usernames, progress_callback = job, cancel_event = job.cancel_event)
+
+def _main_account():
+    authenticated_app = session_pool.main_account()
+    if authenticated_app is None:
+        raise HTTPException(status_code = 400, detail = 'Main account is not logged in')
+    return authenticated_app
+
+def _perform_single_action(action, username):
+    # same rate limit bucket as the bulk action jobs, don't hold the request open for a whole rate limit period
+    session = session_pool.main_session()
+    if session is None:
+        raise HTTPException(status_code = 400, detail = 'Main account is not logged in')
+    if not bulk_actions.perform_single_action(session, action, username, timeout = SINGLE_ACTION_TIMEOUT_SEC):
+        raise HTTPException(status_code = 429, detail = 'Main account rate limit reached, try again in a few minutes')
+
 @app.post("/set_safe/")
 def set_safe(username: Annotated[str, Form()]):
     print('[NOT YET IMPLEMENTED] Setting user as safe:', username)
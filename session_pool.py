@@ -0,0 +1,231 @@
+''' Pool of logged in Tweety sessions, kept warm by the web server and lent out to the scrape / bulk action jobs.
+
+Logging in on every scrape is slow, and lots of logins is what gets Twitter to lock an account. Instead start() logs in
+the main account + up to config.SESSION_POOL_SIZE scraping accounts once, and a background thread keeps them healthy:
+every config.SESSION_HEALTH_CHECK_INTERVAL_SEC idle sessions make 1 cheap request, and sessions that fail it (or that
+got retired by the scrape scheduler for erroring) are signed in again with their username / password.
+
+    with session_pool.borrow_scraping_sessions(while_waiting = job.progress) as sessions:
+        scrape_all_db_followers(sessions, ...)
+
+Scraping sessions are lent to one job at a time, with their rate limit bucket, so 2 jobs never use the same account
+at once and a new job doesn't start with a full rate limit budget the account doesn't have. The main account is shared,
+with 1 rate limit bucket for all its actions (main_session()).
+'''
+import datetime
+import threading
+import time
+from contextlib import contextmanager
+
+from build_database import login_scraping_account
+from scrape_scheduler import ScrapingSession, TokenBucket, is_rate_limit_error
+import config
+import metrics
+
+SCRAPING = 'scraping'
+MAIN = 'main'
+
+_sessions = []
+_client_factory = None
+_condition = threading.Condition()
+_wake = threading.Event()
+_stop = threading.Event()
+_thread = None
+
+class NoSessionsAvailable(Exception):
+    pass
+
+class PooledSession:
+    ''' A logged in account + its rate limit bucket, which outlives the jobs it's lent to '''
+    def __init__(self, role, username, password, name, bucket = None):
+        self.role = role
+        self.username = username
+        self.password = password
+        self.name = name
+        self.bucket = bucket if bucket is not None else TokenBucket()
+
+        self.app = None
+        self.state = 'logging_in' # logging_in -> ready <-> lent / checking, or failed
+        self.needs_check = False
+        self.logged_in_at = None
+        self.last_checked = 0
+        self.error = None
+
+def start(client_factory = None):
+    ''' Log in the main account and start the background thread that logs in + health checks the scraping accounts
+
+    client_factory {class} -- Called as client_factory(session_name) to make each client.
+                              Default tweety.Twitter, or fake_twitter.FakeTwitter if config.USE_FAKE_TWITTER
+    '''
+    global _client_factory, _thread
+
+    if client_factory is None and config.USE_FAKE_TWITTER:
+        from fake_twitter import FakeTwitter
+        client_factory = FakeTwitter
+    _client_factory = client_factory
+
+    accounts = [(config.SCRAPING_ACCOUNT_USERNAME, config.SCRAPING_ACCOUNT_PASSWORD)] + list(config.EXTRA_SCRAPING_ACCOUNTS)
+    sessions = [PooledSession(SCRAPING, username, password, 'session' if i == 0 else f'session_{username}')
+                for i, (username, password) in enumerate(accounts[:config.SESSION_POOL_SIZE])]
+
+    # the main account is logged in right away, so the review page knows if blocking is available
+    if config.MAIN_ACCOUNT_USERNAME and config.MAIN_ACCOUNT_PASSWORD:
+        main = PooledSession(MAIN, config.MAIN_ACCOUNT_USERNAME, config.MAIN_ACCOUNT_PASSWORD, 'session_main',
+                             TokenBucket(config.ACTION_RATE_LIMIT_REQUESTS, config.ACTION_RATE_LIMIT_PERIOD_SEC))
+        _login(main)
+        sessions.append(main)
+        print('Twitter app authenticated' if main.state == 'ready' else 'Twitter authentication failed. Blocking / force unfollow features disabled')
+    else:
+        print('No main account login credentials entered. Blocking / force unfollow features disabled')
+
+    with _condition:
+        _sessions[:] = sessions
+
+    _stop.clear()
+    _wake.set()
+    _thread = threading.Thread(target = _maintain_sessions, name = 'session_pool', daemon = True)
+    _thread.start()
+
+def shutdown():
+    ''' Stop the health check thread. Sessions that are lent out stay usable until they're returned. '''
+    _stop.set()
+    _wake.set()
+    with _condition:
+        _condition.notify_all()
+    if _thread is not None:
+        _thread.join(timeout = 5)
+
+def main_account():
+    ''' The logged in main account app, None if it isn't logged in '''
+    session = main_session()
+    return session.app if session is not None else None
+
+def main_session():
+    ''' The logged in main account as a scrape_scheduler.ScrapingSession sharing the pooled rate limit bucket,
+    so blocks / force unfollows from every job and route count against 1 budget. None if it isn't logged in '''
+    with _condition:
+        for session in _sessions:
+            if session.role == MAIN and session.app is not None and session.state != 'failed':
+                return ScrapingSession(session.app, session.name, session.bucket)
+    return None
+
+@contextmanager
+def borrow_scraping_sessions(count = None, timeout = None, while_waiting = None):
+    ''' Lend out up to count healthy scraping sessions (default every free one), waiting until at least 1 is free.
+    Yields a list of scrape_scheduler.ScrapingSession, which share the pooled sessions' rate limit buckets.
+
+    timeout {float} -- Max seconds to wait for a free session. Default wait forever
+    while_waiting {function} -- Called about once a second while waiting, ie. job.progress to stop when a job is cancelled
+
+    Raises NoSessionsAvailable if every scraping account failed to log in, or after timeout
+    '''
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    with _condition:
+        while True:
+            scraping = [session for session in _sessions if session.role == SCRAPING]
+            free = [session for session in scraping if session.state == 'ready' and not session.needs_check]
+            if free:
+                break
+            if _stop.is_set() or all(session.state == 'failed' for session in scraping):
+                errors = '; '.join(f'{session.name}: {session.error}' for session in scraping) or 'no scraping accounts'
+                raise NoSessionsAvailable(f'No scraping account is logged in ({errors})')
+            if deadline is not None and time.monotonic() > deadline:
+                raise NoSessionsAvailable(f'No free scraping session after {timeout} seconds')
+
+            _condition.wait(1)
+            if while_waiting is not None:
+                _condition.release()
+                try:
+                    while_waiting(0, None, 'Waiting for a free scraping account')
+                finally:
+                    _condition.acquire()
+
+        lent = free[:count] if count is not None else free
+        for session in lent:
+            session.state = 'lent'
+
+    scraping_sessions = [ScrapingSession(session.app, session.name, session.bucket) for session in lent]
+    try:
+        yield scraping_sessions
+    finally:
+        with _condition:
+            for session, scraping_session in zip(lent, scraping_sessions):
+                session.state = 'ready'
+                # the scheduler retires sessions that keep erroring, ie. because the login expired
+                if scraping_session.retired:
+                    session.needs_check = True
+                    _wake.set()
+            _condition.notify_all()
+
+def status():
+    ''' State of every pooled session, for the web UI '''
+    with _condition:
+        return [{'name': session.name, 'role': session.role, 'username': session.username, 'state': session.state,
+                 'logged_in_at': session.logged_in_at, 'error': session.error} for session in _sessions]
+
+#------------------------------------
+# Helper functions
+#------------------------------------
+
+def _maintain_sessions():
+    ''' Background thread: log in new sessions, retry failed logins and health check idle sessions '''
+    while not _stop.is_set():
+        _wake.wait(timeout = config.SESSION_HEALTH_CHECK_INTERVAL_SEC)
+        _wake.clear()
+
+        for session in list(_sessions):
+            if _stop.is_set():
+                return
+
+            with _condition:
+                due = session.needs_check or time.monotonic() - session.last_checked >= config.SESSION_HEALTH_CHECK_INTERVAL_SEC
+                if session.state not in ('logging_in', 'failed') and not (session.state == 'ready' and due):
+                    continue
+                if session.role == SCRAPING:
+                    session.state = 'checking' if session.state == 'ready' else session.state
+
+            if session.app is None or session.state == 'failed':
+                _login(session, fresh = session.app is not None)
+            elif not _is_healthy(session):
+                print(f'{session.name}: session expired, logging in again')
+                _login(session, fresh = True)
+            else:
+                with _condition:
+                    session.state = 'ready'
+                    session.needs_check = False
+                    session.last_checked = time.monotonic()
+                    _condition.notify_all()
+
+def _login(session, fresh = False):
+    try:
+        kwargs = {'client_factory': _client_factory} if _client_factory is not None else {}
+        app = login_scraping_account(session.username, session.password, session.name, fresh = fresh, **kwargs)
+        state, error = 'ready', None
+        metrics.inc('session_logins_total', role = session.role, result = 'ok')
+    except Exception as e:
+        app, state, error = None, 'failed', f'{type(e).__name__}: {e}'
+        metrics.inc('session_logins_total', role = session.role, result = 'failed')
+        print(f'Failed to log in {session.role} account @{session.username}, retrying in {config.SESSION_HEALTH_CHECK_INTERVAL_SEC}s. Error: {e}')
+
+    with _condition:
+        if app is not None:
+            session.app = app
+            session.logged_in_at = f'{datetime.datetime.now()}'
+        session.state, session.error = state, error
+        session.needs_check = False
+        session.last_checked = time.monotonic()
+        _condition.notify_all()
+
+def _is_healthy(session):
+    ''' 1 request with the session. A rate limit error still means the login works. '''
+    if session.bucket.acquire(1, cancel_event = _stop) is None:
+        return True
+    try:
+        session.app.get_user_info(session.username)
+        return True
+    except Exception as e:
+        if is_rate_limit_error(e):
+            session.bucket.pause(getattr(e, 'retry_after', None) or session.bucket.period_sec, drain = True)
+            return True
+        session.error = f'{type(e).__name__}: {e}'
+        return False
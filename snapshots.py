@@ -0,0 +1,141 @@
+''' History of the followers database, one snapshot per finished follower scrape.
+
+Snapshots are stored as deltas keyed by user id: a snapshot only saves the users that were added, removed or whose
+profile changed since the previous snapshot of the same account. The state at any snapshot is the latest change
+of each user up to it, so a diff between 2 snapshots only looks at the users changed in between.
+
+Twitter returns newest followers first, so a normal scrape only fetches new followers. To find lost followers and
+changed profiles, scrape with fresh = True (`python build_database.py --fresh`, or the fresh scrape checkbox in the web UI)
+so every follower is fetched again. A fresh scrape keeps the scraped followings and snapshots.
+'''
+import datetime
+import json
+
+import pandas as pd
+
+from build_database import db_connection, load_database
+
+SNAPSHOTS_TABLE = 'snapshots'
+SNAPSHOT_CHANGES_TABLE = 'snapshot_changes'
+
+# Profile fields compared between snapshots. Counts (followers, posts...) change all the time so they're left out
+SNAPSHOT_COLUMNS = ['username', 'name', 'description', 'location', 'profile_image_url_https', 'protected', 'verified']
+
+def take_snapshot(username, mode = None):
+    ''' Save the changes in the users table since the last snapshot of username's followers. Returns the snapshot id. '''
+    df = load_database(columns = ['id'] + SNAPSHOT_COLUMNS)
+    current = _profiles(df)
+
+    with db_connection() as con:
+        _create_snapshot_tables(con)
+        previous_id = con.execute(
+            f'SELECT MAX(snapshot_id) FROM {SNAPSHOTS_TABLE} WHERE username = ?', (username,)).fetchone()[0]
+        previous = _state_at(con, previous_id) if previous_id is not None else pd.DataFrame(columns = ['user_id', 'profile'])
+
+        merged = current.merge(previous, on = 'user_id', how = 'outer', suffixes = ('', '_old'), indicator = True)
+        added = merged[merged['_merge'] == 'left_only']
+        removed = merged[merged['_merge'] == 'right_only']
+        changed = merged[(merged['_merge'] == 'both') & (merged['profile'] != merged['profile_old'])]
+
+        cursor = con.execute(f'INSERT INTO {SNAPSHOTS_TABLE} (username, created_at, mode, num_followers) VALUES (?, ?, ?, ?)',
+            (username, f'{datetime.datetime.now()}', mode, len(current)))
+        snapshot_id = cursor.lastrowid
+
+        rows = [(snapshot_id, user_id, change, profile)
+                for change, changes in [('added', added), ('changed', changed), ('removed', removed)]
+                for user_id, profile in zip(changes['user_id'], changes['profile'] if change != 'removed' else changes['profile_old'])]
+        con.executemany(f'INSERT INTO {SNAPSHOT_CHANGES_TABLE} VALUES (?, ?, ?, ?)', rows)
+
+    print(f'Snapshot {snapshot_id} of @{username} followers: {len(added)} added, {len(removed)} removed, {len(changed)} changed')
+    return snapshot_id
+
+def list_snapshots(username = None):
+    ''' Snapshots as a list of dicts, newest first, with the number of changes in each '''
+    with db_connection() as con:
+        _create_snapshot_tables(con)
+        where, params = ('WHERE s.username = ?', (username,)) if username else ('', ())
+        cursor = con.execute(f'''
+            SELECT s.snapshot_id, s.username, s.created_at, s.mode, s.num_followers,
+                SUM(c.change = 'added') AS added, SUM(c.change = 'removed') AS removed, SUM(c.change = 'changed') AS changed
+            FROM {SNAPSHOTS_TABLE} s LEFT JOIN {SNAPSHOT_CHANGES_TABLE} c ON c.snapshot_id = s.snapshot_id
+            {where} GROUP BY s.snapshot_id ORDER BY s.snapshot_id DESC''', params)
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def diff_snapshots(old_id, new_id):
+    ''' Followers added, removed and with changed profiles between 2 snapshots of the same account.
+
+    Returns dict with
+        added, removed {list of dict} -- Profiles of the users (as of the new / old snapshot)
+        changed {list of dict} -- user_id, username and {field: [old value, new value]} of the changed fields
+    '''
+    with db_connection() as con:
+        _create_snapshot_tables(con)
+        snapshot_users = dict(con.execute(
+            f'SELECT snapshot_id, username FROM {SNAPSHOTS_TABLE} WHERE snapshot_id IN (?, ?)', (old_id, new_id)).fetchall())
+        for snapshot_id in (old_id, new_id):
+            if snapshot_id not in snapshot_users:
+                raise KeyError(f'No snapshot {snapshot_id}')
+        if snapshot_users[old_id] != snapshot_users[new_id]:
+            raise ValueError(f'Snapshots {old_id} and {new_id} are of different accounts')
+
+        # only users with a change between the 2 snapshots can differ
+        low, high = sorted((old_id, new_id))
+        touched = [user_id for user_id, in con.execute(f'''SELECT DISTINCT user_id FROM {SNAPSHOT_CHANGES_TABLE}
+            WHERE snapshot_id > ? AND snapshot_id <= ? AND snapshot_id IN (SELECT snapshot_id FROM {SNAPSHOTS_TABLE} WHERE username = ?)''',
+            (low, high, snapshot_users[old_id]))]
+
+        old = _state_at(con, old_id, touched)
+        new = _state_at(con, new_id, touched)
+
+    merged = new.merge(old, on = 'user_id', how = 'outer', suffixes = ('', '_old'), indicator = True)
+    added = [json.loads(p) for p in merged.loc[merged['_merge'] == 'left_only', 'profile']]
+    removed = [json.loads(p) for p in merged.loc[merged['_merge'] == 'right_only', 'profile_old']]
+
+    changed = []
+    both = merged[(merged['_merge'] == 'both') & (merged['profile'] != merged['profile_old'])]
+    for user_id, profile, profile_old in zip(both['user_id'], both['profile'], both['profile_old']):
+        profile, profile_old = json.loads(profile), json.loads(profile_old)
+        fields = {k: [profile_old.get(k), profile.get(k)] for k in SNAPSHOT_COLUMNS if profile_old.get(k) != profile.get(k)}
+        changed.append({'user_id': user_id, 'username': profile.get('username'), 'fields': fields})
+
+    return {'added': added, 'removed': removed, 'changed': changed}
+
+#------------------------------------
+# Helper functions
+#------------------------------------
+
+def _profiles(df):
+    ''' DataFrame of user_id + profile JSON of the SNAPSHOT_COLUMNS '''
+    records = json.loads(df[SNAPSHOT_COLUMNS].to_json(orient = 'records', date_format = 'iso'))
+    return pd.DataFrame({
+        'user_id': df['id'].astype(str).to_numpy(),
+        'profile': [json.dumps({'user_id': user_id, **r}, sort_keys = True) for user_id, r in zip(df['id'].astype(str), records)],
+    }).drop_duplicates('user_id')
+
+def _state_at(con, snapshot_id, user_ids = None):
+    ''' user_id + profile of every follower at snapshot_id (removed users left out), optionally only for user_ids '''
+    username = con.execute(f'SELECT username FROM {SNAPSHOTS_TABLE} WHERE snapshot_id = ?', (snapshot_id,)).fetchone()[0]
+    user_filter = ''
+    if user_ids is not None:
+        # look the users up through the user_id index instead of reading every change
+        con.execute('CREATE TEMP TABLE IF NOT EXISTS snapshot_user_ids (user_id TEXT PRIMARY KEY)')
+        con.execute('DELETE FROM snapshot_user_ids')
+        con.executemany('INSERT OR IGNORE INTO snapshot_user_ids VALUES (?)', ((user_id,) for user_id in user_ids))
+        user_filter = 'AND c.user_id IN (SELECT user_id FROM snapshot_user_ids)'
+
+    query = f'''SELECT c.user_id, c.change, c.profile FROM {SNAPSHOT_CHANGES_TABLE} c
+        JOIN {SNAPSHOTS_TABLE} s ON s.snapshot_id = c.snapshot_id
+        WHERE s.username = ? AND c.snapshot_id <= ? {user_filter} ORDER BY c.snapshot_id'''
+    df = pd.read_sql(query, con, params = (username, snapshot_id))
+
+    # the last change of each user is their state at snapshot_id
+    latest = df.drop_duplicates('user_id', keep = 'last')
+    return latest.loc[latest['change'] != 'removed', ['user_id', 'profile']].reset_index(drop = True)
+
+def _create_snapshot_tables(con):
+    con.execute(f'''CREATE TABLE IF NOT EXISTS {SNAPSHOTS_TABLE} (
+        snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, created_at TEXT, mode TEXT, num_followers INTEGER)''')
+    con.execute(f'''CREATE TABLE IF NOT EXISTS {SNAPSHOT_CHANGES_TABLE} (
+        snapshot_id INTEGER, user_id TEXT, change TEXT, profile TEXT, PRIMARY KEY (snapshot_id, user_id))''')
+    con.execute(f'CREATE INDEX IF NOT EXISTS idx_{SNAPSHOT_CHANGES_TABLE}_user_id ON {SNAPSHOT_CHANGES_TABLE} (user_id, snapshot_id)')
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+import build_database
+import graph_analysis
+
+# build_database / graph_analysis paths that get pointed at the test's data directory, like benchmark.DATA_PATHS
+DATA_PATHS = {
+    build_database: ['DB_PATH', 'DB_TIMESTAMP_FILE', 'EDGES_DIR', 'DB_CSV_PATH', 'DB_FOLLOWINGS_PATH'],
+    graph_analysis: ['GRAPH_CACHE_DIR'],
+}
+
+def _clear_caches():
+    for cache in [build_database._database_cache, build_database._count_cache,
+                  graph_analysis._graph_html_cache, graph_analysis._graph_versions, graph_analysis._clusters_cache]:
+        cache.clear()
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    ''' Empty database + graph cache in a temporary directory, the real data directory is never touched '''
+    for module, names in DATA_PATHS.items():
+        for name in names:
+            path = os.path.join(tmp_path, os.path.relpath(getattr(module, name), build_database.DATA_DIR))
+            monkeypatch.setattr(module, name, path)
+    monkeypatch.setattr(build_database, '_legacy_csv_checked', False)
+    _clear_caches()
+    yield tmp_path
+    _clear_caches()
+
+@pytest.fixture
+def fake_server(data_dir, monkeypatch):
+    ''' The server module with its Twitter accounts logged in as fake_twitter.FakeTwitter. Use with TestClient(server.app) '''
+    pytest.importorskip('nostril') # flag_users needs it
+    import config
+    import image_cache
+    import server
+
+    monkeypatch.setattr(config, 'USE_FAKE_TWITTER', True)
+    monkeypatch.setattr(config, 'SCRAPING_ACCOUNT_USERNAME', 'scraper')
+    monkeypatch.setattr(config, 'SCRAPING_ACCOUNT_PASSWORD', 'password')
+    monkeypatch.setattr(config, 'EXTRA_SCRAPING_ACCOUNTS', [])
+    monkeypatch.setattr(image_cache, 'IMAGE_CACHE_DIR', os.path.join(data_dir, 'image_cache'))
+    return server
@@ -0,0 +1,192 @@
+import os
+import random
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import build_database
+from fake_twitter import FakeTwitter
+
+class NewestFirstTwitter(FakeTwitter):
+    ''' Lists followers newest first like Twitter, so a bigger num_followers means new followers on page 1 '''
+    def iter_user_followers(self, username, pages = 1, wait_time = 2, cursor = None):
+        return self._iter_pages(range(self.num_followers - 1, -1, -1), pages, cursor)
+
+def make_users(n, seed = 0):
+    ''' Users with some missing follower counts and a lot of ties '''
+    rnd = random.Random(seed)
+    return pd.DataFrame({
+        'username': [f'user{i}' for i in range(n)],
+        'id': list(range(n)),
+        'followers_count': [None if rnd.random() < 0.2 else rnd.randint(0, 5) for _ in range(n)],
+        'flags': [rnd.choice(['no_flag', 'flagged_text --- crypto']) for _ in range(n)],
+    })
+
+def read_all_pages(**kwargs):
+    pages, cursor = [], None
+    while True:
+        df, cursor = build_database.load_database_page(cursor = cursor, limit = 7, **kwargs)
+        pages.append(df)
+        if cursor is None:
+            return pd.concat(pages, ignore_index = True)
+
+@pytest.mark.parametrize('descending', [False, True])
+@pytest.mark.parametrize('where', [None, "flags != 'no_flag'"])
+def test_pages_match_sorted_table(data_dir, descending, where):
+    users = make_users(100)
+    build_database.save_database(users)
+
+    expected = users.query("flags != 'no_flag'") if where else users
+    #SQLite sorts NULLs first, ties in insertion order
+    expected = expected.assign(_null = expected['followers_count'].notna(), _rowid = expected.index)
+    expected = expected.sort_values(['_null', 'followers_count', '_rowid'], ascending = not descending)
+
+    result = read_all_pages(sort = 'followers_count', descending = descending, where = where)
+    assert result['username'].tolist() == expected['username'].tolist()
+
+def test_rowid_pages(data_dir):
+    build_database.save_database(make_users(30))
+    assert read_all_pages()['username'].tolist() == [f'user{i}' for i in range(30)]
+    assert read_all_pages(descending = True)['username'].tolist() == [f'user{i}' for i in reversed(range(30))]
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_deep_pages_seek_the_sort_index(data_dir, monkeypatch, descending):
+    build_database.save_database(make_users(100))
+    _, cursor = build_database.load_database_page(sort = 'followers_count', descending = descending, limit = 50)
+
+    queries = []
+    read_sql_query = pd.read_sql_query
+    def record_query(sql, con, params = ()):
+        queries.append([row[-1] for row in con.execute(f'EXPLAIN QUERY PLAN {sql}', params)])
+        return read_sql_query(sql, con, params = params)
+    monkeypatch.setattr(pd, 'read_sql_query', record_query)
+    build_database.load_database_page(sort = 'followers_count', descending = descending, cursor = cursor, limit = 5)
+
+    for plan in queries:
+        assert any(step.startswith('SEARCH') and 'idx_users_followers_count' in step for step in plan), plan
+
+def test_count_cached_until_database_changes(data_dir):
+    build_database.save_database(make_users(10))
+    assert build_database.count_database() == 10
+
+    #not through append_database(), so the database version stays the same
+    with build_database.db_connection() as con:
+        con.execute("INSERT INTO users (username) VALUES ('sneaky')")
+    assert build_database.count_database() == 10
+
+    build_database.append_database(make_users(5))
+    assert build_database.count_database() == 16
+
+#------------------------------------
+# SQLite storage
+#------------------------------------
+
+def test_legacy_csv_imported_once(data_dir):
+    users = make_users(20).assign(protected = [i % 2 == 0 for i in range(20)])
+    users.to_csv(build_database.DB_CSV_PATH, sep = build_database.CSV_DELIMITER, index = False)
+
+    df = build_database.load_database()
+    assert df['username'].tolist() == users['username'].tolist()
+    assert df['protected'].tolist() == users['protected'].tolist()
+    assert os.path.exists(build_database.DB_PATH)
+
+    # the csv is only read while there's no users table
+    users.head(3).to_csv(build_database.DB_CSV_PATH, sep = build_database.CSV_DELIMITER, index = False)
+    build_database._legacy_csv_checked = False
+    assert len(build_database.load_database()) == 20
+
+def test_filters_pushed_down(data_dir):
+    build_database.save_database(make_users(50))
+
+    df = build_database.load_database(columns = ['username'], where = 'followers_count >= ?', params = (3,), limit = 5)
+    assert list(df.columns) == ['username']
+    assert len(df) == 5
+    assert build_database.get_existing_user_ids([1, 2, 999]) == {1, 2}
+
+def test_cached_load_sees_writes(data_dir):
+    users = make_users(10)
+    build_database.save_database(users)
+
+    df = build_database.load_database()
+    df.loc[0, 'flags'] = 'changed by the caller'
+    assert build_database.load_database().loc[0, 'flags'] == users.loc[0, 'flags']
+
+    build_database.update_database(pd.DataFrame({'id': [3], 'flags': ['flagged_text --- whatsapp']}), ['flags'])
+    assert build_database.load_database().loc[3, 'flags'] == 'flagged_text --- whatsapp'
+
+#------------------------------------
+# Resumable + incremental scraping
+#------------------------------------
+
+def test_scrape_resumes_from_checkpoint(data_dir):
+    build_database.create_database('me', pages = 2, authenticated_app = NewestFirstTwitter(num_followers = 230))
+    state = build_database.load_scrape_state()
+    assert (state['pages_done'], state['complete']) == (2, 0)
+    assert len(build_database.load_database()) == 100
+
+    app = NewestFirstTwitter(num_followers = 230)
+    build_database.create_database('me', pages = 10, authenticated_app = app)
+    assert app.request_count == 3 # pages 3-5, not the first 2 again
+    assert build_database.load_scrape_state()['complete'] == 1
+
+    df = build_database.load_database()
+    assert len(df) == 230
+    assert df['id'].is_unique
+
+def test_finished_scrape_only_fetches_new_followers(data_dir):
+    build_database.create_database('me', pages = 10, authenticated_app = NewestFirstTwitter(num_followers = 120))
+
+    app = NewestFirstTwitter(num_followers = 150)
+    build_database.create_database('me', pages = 10, authenticated_app = app)
+    assert app.request_count == 1 # page 1 has 30 new followers and 20 known ones
+    assert build_database.load_scrape_state()['mode'] == 'delta'
+    assert len(build_database.load_database()) == 150
+
+def test_fresh_scrape_keeps_followings(data_dir):
+    build_database.create_database('me', pages = 10, authenticated_app = NewestFirstTwitter(num_followers = 60))
+    build_database.save_followings('bob1', ['alice2'])
+
+    app = NewestFirstTwitter(num_followers = 60)
+    build_database.create_database('me', pages = 10, authenticated_app = app, fresh = True)
+    assert app.request_count == 2
+    assert len(build_database.load_database()) == 60
+    follower_ids, _, _ = build_database.load_followings_edges()
+    assert len(follower_ids) == 1
+
+#------------------------------------
+# Followings edge store
+#------------------------------------
+
+def read_edges():
+    follower_ids, followee_ids, account_names = build_database.load_followings_edges()
+    return sorted((str(account_names[f]), str(account_names[t])) for f, t in zip(follower_ids, followee_ids))
+
+def test_edges_exported_to_npy(data_dir):
+    build_database.save_followings('bob', ['alice', 'jim'])
+    build_database.save_followings('alice', ['jim'])
+    assert read_edges() == [('alice', 'jim'), ('bob', 'alice'), ('bob', 'jim')]
+
+    follower_ids, _, _ = build_database.load_followings_edges()
+    assert isinstance(follower_ids, np.memmap)
+    assert (np.diff(follower_ids) >= 0).all() # sorted by follower, see graph_analysis.load_followings_data()
+    assert not [f for f in os.listdir(build_database.EDGES_DIR) if '.tmp' in f]
+
+    # only exported again when the followings change
+    mtime = os.path.getmtime(os.path.join(build_database.EDGES_DIR, 'follower_ids.npy'))
+    build_database.load_followings_edges()
+    assert os.path.getmtime(os.path.join(build_database.EDGES_DIR, 'follower_ids.npy')) == mtime
+
+    build_database.save_followings('bob', ['news'])
+    assert read_edges() == [('alice', 'jim'), ('bob', 'news')]
+
+def test_followings_column_migrated(data_dir):
+    # a database from before the edges table existed
+    with sqlite3.connect(build_database.DB_PATH) as con:
+        pd.DataFrame({'id': [1, 2, 3], 'username': ['bob', 'alice', 'jim'],
+            'followings': ["['alice', 'jim']", None, 'not a list']}).to_sql(build_database.USERS_TABLE, con, index = False)
+    con.close()
+
+    assert read_edges() == [('bob', 'alice'), ('bob', 'jim')]
+    assert 'followings' not in build_database.load_database().columns
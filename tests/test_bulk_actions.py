@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+import bulk_actions
+from fake_twitter import FakeTwitter
+from scrape_scheduler import ScrapingSession, TokenBucket
+
+@pytest.fixture
+def session(data_dir):
+    return ScrapingSession(FakeTwitter(), 'main', TokenBucket(capacity = 1000, period_sec = 900))
+
+def test_users_already_done_are_skipped(session):
+    counts = bulk_actions.run_bulk_action(session, 'block', ['bob1', 'alice2', 'bob1'])
+    assert counts == {'done': 2, 'skipped': 0, 'failed': 0, 'blocked': 0}
+
+    counts = bulk_actions.run_bulk_action(session, 'block', ['bob1', 'alice2', 'jim3'])
+    assert counts == {'done': 1, 'skipped': 2, 'failed': 0, 'blocked': 0}
+    assert session.app.blocked == {'bob1', 'alice2', 'jim3'}
+    assert session.app.request_count == 3
+    assert bulk_actions.get_actioned_usernames('block') == {'bob1', 'alice2', 'jim3'}
+
+def test_force_unfollow_skips_blocked_users(session):
+    bulk_actions.run_bulk_action(session, 'block', ['bob1'])
+
+    counts = bulk_actions.run_bulk_action(session, 'force_unfollow', ['bob1', 'alice2'])
+    assert counts == {'done': 1, 'skipped': 0, 'failed': 0, 'blocked': 1}
+    assert session.app.blocked == {'bob1'} # still blocked, alice2 blocked + unblocked
+    assert bulk_actions.get_actioned_usernames('force_unfollow') == {'alice2'}
+
+def test_cancelled_run_continues_where_it_stopped(session):
+    session.app.latency_sec = 0.01
+    usernames = [f'bob{i}' for i in range(10)]
+    cancel_event = threading.Event()
+    def cancel_after_3(done, total, message):
+        if done == 3:
+            cancel_event.set()
+
+    first = bulk_actions.run_bulk_action(session, 'block', usernames, cancel_after_3, cancel_event)
+    assert 3 <= first['done'] < 10
+
+    second = bulk_actions.run_bulk_action(session, 'block', usernames)
+    assert second == {'done': 10 - first['done'], 'skipped': first['done'], 'failed': 0, 'blocked': 0}
+    assert session.app.request_count == 10 # nobody blocked twice
@@ -0,0 +1,127 @@
+import datetime
+import re
+
+import emoji
+import pytest
+
+pytest.importorskip('nostril')
+
+import build_database
+import config
+import flag_users
+import metrics
+from fake_twitter import FakeTwitter
+
+#------------------------------------
+# Row by row flag rules from before the column flag functions, see get_flag_reasons()
+#------------------------------------
+
+def reference_too_few_followers(row):
+    if row.friends_count < config.LOW_FOLLOWER_THRESH:
+        return True, 'low_follower_count'
+    return False, ''
+
+def reference_text_or_emoji(row):
+    flagged, reasons = False, []
+    total_text = str(row.name) + str(row.description)
+
+    for text in config.TEXT_TO_FLAG:
+        if text in total_text.lower():
+            flagged = True
+            reasons.append(f'flagged_text --- {text}')
+
+    total_text_demojized = emoji.demojize(total_text)
+    for emo in config.EMOJI_TO_FLAG:
+        if emo in total_text_demojized:
+            flagged = True
+            reasons.append(f'flagged_emoji --- {emo}')
+
+    return flagged, reasons
+
+def reference_randomly_generated_username(row):
+    if config.ALPHANUMERIC_CHECK_ENABLED:
+        all_numbers = re.findall(r'\d+', row.username)
+        num_digits = sum(len(x) for x in all_numbers)
+        if len(all_numbers) >= 3 or num_digits > 6 or (num_digits >= 0.6 * len(row.username) and num_digits > 4):
+            return True, 'randomly_generated_@username_detected - alphanumeric method'
+
+    if config.NGRAM_CHECK_ENABLED and flag_users._is_nonsense(row.username):
+        return True, 'randomly_generated_@username_detected - ngram method'
+    return False, ''
+
+def reference_got_followers_too_fast(row):
+    created_datetime = datetime.datetime.strptime(str(row.created_at)[:19], '%Y-%m-%d %H:%M:%S')
+    delta_days = (flag_users.DB_TIMESTAMP - created_datetime).days + 1E-3
+
+    if row.followers_count / delta_days >= config.FOLLOWERS_PER_DAY_THRESH and 10 <= row.followers_count < 5000:
+        return True, f'gained_followers_too_fast: {row.followers_count} followers in {int(delta_days)} days'
+    if delta_days < 3:
+        return True, f'recently_created: Created {int(delta_days)} days ago.'
+    return False, ''
+
+REFERENCE_FLAGS = [reference_too_few_followers, reference_text_or_emoji,
+                   reference_randomly_generated_username, reference_got_followers_too_fast]
+
+def reference_flagged_users(df):
+    flag_ids, flag_reasons = [], []
+    for row in df.itertuples():
+        if row.verified == True:
+            continue
+
+        reasons = []
+        for flag_func in REFERENCE_FLAGS:
+            flagged, reason = flag_func(row)
+            if flagged:
+                reasons.extend(reason if isinstance(reason, list) else [reason])
+
+        if reasons:
+            flag_ids.append(row.Index)
+            flag_reasons.append(', '.join(reasons))
+    return flag_ids, flag_reasons
+
+@pytest.fixture
+def followers(data_dir, monkeypatch):
+    ''' Database of 300 fake followers, a third of them bots '''
+    monkeypatch.setattr(config, 'CLUSTER_FLAG_MIN_SIZE', None)
+    monkeypatch.setattr(flag_users, 'DB_TIMESTAMP', datetime.datetime(2024, 1, 1, 12))
+    build_database.create_database('me', pages = 10, authenticated_app = FakeTwitter(num_followers = 300, bot_fraction = 0.3))
+    return build_database.load_database()
+
+def test_same_reasons_as_row_rules(followers):
+    expected = reference_flagged_users(followers)
+    assert any('ngram' in reason for reason in expected[1]) and any('recently_created' in reason for reason in expected[1])
+
+    assert flag_users.get_all_flagged_users(followers, incremental = False) == expected
+    assert flag_users.get_all_flagged_users(followers, incremental = True) == expected
+
+def test_incremental_run_reuses_unchanged_users(followers):
+    first = flag_users.get_all_flagged_users(followers)
+
+    followers = followers.copy()
+    changed = followers.index[~followers['verified'] & (followers['description'] != 'dm me on whatsapp')][:5]
+    followers.loc[changed, 'description'] = 'dm me on whatsapp'
+    flagged = flag_users.get_all_flagged_users(followers)
+
+    stats = flag_users.get_flag_run_stats()
+    assert stats['flag_text_or_emoji']['evaluated'] == 5
+    assert stats['flag_too_few_followers']['evaluated'] == 0
+    assert flagged == reference_flagged_users(followers)
+    assert flagged != first
+
+def test_parallel_same_as_serial(followers):
+    metrics.reset()
+    flag_users.nonsense_cache_stats.update(hits = 0, misses = 0)
+    serial = flag_users.get_flag_reasons(followers)
+    serial_metrics = metrics.snapshot()['counters']
+    serial_nonsense = dict(flag_users.nonsense_cache_stats)
+
+    metrics.reset()
+    with build_database.db_connection() as con: # so the workers miss the nonsense() cache too
+        con.execute(f'DELETE FROM {flag_users.NONSENSE_CACHE_TABLE}')
+    flag_users.nonsense_cache_stats.update(hits = 0, misses = 0)
+    parallel = flag_users.get_flag_reasons_parallel(followers, workers = 2)
+
+    assert parallel.equals(serial)
+    # metrics + nonsense() cache stats of the worker processes are added to this process' ones
+    assert metrics.snapshot()['counters'] == serial_metrics
+    assert flag_users.nonsense_cache_stats == serial_nonsense
@@ -0,0 +1,60 @@
+import json
+import os
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import build_database
+import graph_analysis
+
+def save_followings_graph(num_users = 12):
+    ''' 2 groups of users following the same accounts '''
+    build_database.save_database(pd.DataFrame({'username': [f'user{i}' for i in range(num_users)], 'protected': False}))
+    for i in range(num_users):
+        build_database.save_followings(f'user{i}', [f'account{i % 2}_{j}' for j in range(5)] + [f'own{i}'])
+
+def test_unchanged_database_skips_loading(data_dir, monkeypatch):
+    save_followings_graph()
+    first = graph_analysis.generate_graph_data()
+
+    graph_analysis._graph_html_cache.clear()
+    graph_analysis._graph_versions.clear() # like a fresh process, the version is read from disk
+    load_followings_data = graph_analysis.load_followings_data
+    def fail():
+        raise AssertionError('followings loaded for an unchanged database')
+    monkeypatch.setattr(graph_analysis, 'load_followings_data', fail)
+    assert graph_analysis.generate_graph_data() == first
+
+    monkeypatch.setattr(graph_analysis, 'load_followings_data', load_followings_data)
+    build_database.save_followings('user0', ['account1_0'])
+    assert json.loads(graph_analysis.generate_graph_data())['num_edges_total'] != json.loads(first)['num_edges_total']
+
+def test_layout_written_atomically(data_dir):
+    save_followings_graph()
+    graph_analysis.generate_graph_data()
+
+    files = os.listdir(graph_analysis.GRAPH_CACHE_DIR)
+    assert not [f for f in files if f.endswith('.tmp')]
+    layout_file, = [f for f in files if f.endswith('_layout.json')]
+    with open(os.path.join(graph_analysis.GRAPH_CACHE_DIR, layout_file)) as file:
+        assert sorted(json.load(file)['pos']) == sorted(f'user{i}' for i in range(12))
+
+@pytest.mark.parametrize('weight_thresh', [0.0, 0.1, 0.3])
+def test_jaccard_edges_same_as_pairwise(weight_thresh):
+    rnd = random.Random(0)
+    users = [f'user{i}' for i in range(60)]
+    # small pool of accounts so most pairs overlap, a few users with no followings
+    followings = {user: np.array(sorted(rnd.sample(range(40), rnd.choice([0, 1, 5, 15])))) for user in users}
+
+    expected = {}
+    for i in range(len(users)):
+        for j in range(i + 1, len(users)):
+            weight = graph_analysis.jaccard(set(followings[users[i]]), set(followings[users[j]]))
+            if weight > weight_thresh:
+                expected[(i, j)] = weight
+
+    rows, cols, weights = graph_analysis.jaccard_edges(followings, users, weight_thresh, block_size = 7)
+    assert len(rows) == len(expected)
+    assert dict(zip(zip(rows.tolist(), cols.tolist()), weights.tolist())) == pytest.approx(expected)
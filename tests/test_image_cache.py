@@ -0,0 +1,120 @@
+import io
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pandas as pd
+import pytest
+from PIL import Image
+
+import build_database
+import config
+import image_cache
+
+def image_bytes(mode = 'RGB', size = (800, 800), fmt = 'JPEG'):
+    buffer = io.BytesIO()
+    Image.new(mode, size, (200, 30, 30, 128) if mode == 'RGBA' else (200, 30, 30)).save(buffer, fmt)
+    return buffer.getvalue()
+
+class ImageHost(BaseHTTPRequestHandler):
+    ''' Serves a jpeg for every path, a transparent png for /png/..., and 404 / not an image for /missing/... / /text/... '''
+    requests = []
+
+    def do_GET(self):
+        ImageHost.requests.append(self.path)
+        if self.path.startswith('/missing'):
+            self.send_error(404)
+            return
+        if self.path.startswith('/text'):
+            body = b'not an image'
+        elif self.path.startswith('/png'):
+            body = image_bytes('RGBA', fmt = 'PNG')
+        else:
+            body = image_bytes()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def image_host(data_dir, monkeypatch):
+    ''' Base url of a local image host, allowed to be proxied, with an empty image cache '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHost)
+    threading.Thread(target = server.serve_forever, kwargs = {'poll_interval': 0.05}, daemon = True).start()
+    ImageHost.requests = []
+
+    monkeypatch.setattr(config, 'IMAGE_PROXY_ALLOWED_HOSTS', ['127.0.0.1'])
+    monkeypatch.setattr(image_cache, 'IMAGE_CACHE_DIR', os.path.join(data_dir, 'image_cache'))
+    monkeypatch.setattr(image_cache, '_cache_size', None)
+    client = httpx.Client(trust_env = False) # no proxy from the environment for localhost
+    monkeypatch.setattr(image_cache, '_client', client)
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+def test_thumbnail_downloaded_once(image_host):
+    url = f'{image_host}/profile_images/1/img_normal.jpg'
+    path = image_cache.get_thumbnail(url)
+
+    assert ImageHost.requests == ['/profile_images/1/img_400x400.jpg']
+    with Image.open(path) as image:
+        assert (image.format, image.size) == ('JPEG', config.IMAGE_THUMBNAIL_SIZES['avatar'])
+
+    assert image_cache.get_thumbnail(url) == path
+    assert len(ImageHost.requests) == 1
+
+def test_banner_and_transparent_image(image_host):
+    path = image_cache.get_thumbnail(f'{image_host}/png/banner', 'banner')
+
+    assert ImageHost.requests == ['/png/banner/600x200']
+    with Image.open(path) as image:
+        assert image.mode == 'RGB'
+        assert max(image.size) <= max(config.IMAGE_THUMBNAIL_SIZES['banner'])
+
+@pytest.mark.parametrize('path', ['/missing/img_normal.jpg', '/text/img_normal.jpg'])
+def test_fetch_errors(image_host, path):
+    with pytest.raises(image_cache.ImageFetchError):
+        image_cache.get_thumbnail(image_host + path)
+    assert image_cache._cached_files() == []
+
+def test_only_allowed_hosts(image_host):
+    with pytest.raises(ValueError):
+        image_cache.get_thumbnail(image_host.replace('127.0.0.1', 'localhost') + '/img_normal.jpg')
+    with pytest.raises(ValueError):
+        image_cache.get_thumbnail(image_host + '/img_normal.jpg', 'huge')
+    assert ImageHost.requests == []
+
+def test_least_recently_used_evicted(image_host, monkeypatch):
+    first, second, third = [f'{image_host}/profile_images/{i}/img_normal.jpg' for i in range(3)]
+    first_path, second_path = image_cache.get_thumbnail(first), image_cache.get_thumbnail(second)
+    # room for 2.5 thumbnails
+    monkeypatch.setattr(config, 'IMAGE_CACHE_MAX_MB', 2.5 * os.path.getsize(first_path) / 1024 / 1024)
+
+    now = time.time()
+    os.utime(first_path, (now - 7200, now - 7200))
+    os.utime(second_path, (now - 5000, now - 5000))
+    image_cache.get_thumbnail(first) # used again, so second is now the least recently used
+    third_path = image_cache.get_thumbnail(third)
+
+    assert os.path.exists(first_path) and os.path.exists(third_path)
+    assert not os.path.exists(second_path)
+
+def test_prefetch(image_host):
+    build_database.save_database(pd.DataFrame({
+        'username': ['a', 'b', 'c', 'd'],
+        'profile_image_url_https': [f'{image_host}/profile_images/{i}/img_normal.jpg' for i in range(3)] + [f'{image_host}/missing/img_normal.jpg'],
+        'profile_banner_url': [f'{image_host}/banner/0', None, None, None]}))
+
+    progress = []
+    counts = image_cache.prefetch_thumbnails(lambda done, total, message: progress.append((done, total)), workers = 2)
+    assert counts == {'cached': 0, 'fetched': 4, 'failed': 1}
+    assert progress[-1] == (5, 5)
+
+    assert image_cache.prefetch_thumbnails() == {'cached': 4, 'fetched': 0, 'failed': 1}
+    assert len(ImageHost.requests) == 6 # only the missing image again
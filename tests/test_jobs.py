@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import build_database
+import config
+import image_cache
+import jobs
+import metrics
+
+def wait_for(condition, timeout = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.05)
+
+@pytest.fixture
+def job_pool(data_dir, monkeypatch):
+    ''' jobs with a blocking and an instant job type '''
+    release = threading.Event()
+    monkeypatch.setitem(jobs.JOB_TYPES, 'blocking', lambda job: release.wait(10) and 'released')
+    monkeypatch.setitem(jobs.JOB_TYPES, 'instant', lambda job: 'done')
+    jobs.start(max_workers = 1)
+    yield release
+    release.set()
+    jobs.shutdown()
+
+def test_cancelled_while_queued(job_pool):
+    metrics.reset()
+    blocking_id = jobs.submit('blocking')
+    queued_id = jobs.submit('instant')
+    wait_for(lambda: jobs.get_job(blocking_id)['status'] == 'running')
+
+    assert jobs.cancel(queued_id)
+    job_pool.set()
+    wait_for(lambda: jobs.get_job(blocking_id)['status'] == 'done')
+
+    assert jobs.get_job(queued_id)['status'] == 'cancelled'
+    wait_for(lambda: ('job_seconds', (('kind', 'instant'), ('status', 'cancelled'))) in metrics.snapshot()['timers'])
+    assert not [key for key in metrics.snapshot()['timers'] if ('status', 'failed') in key[1]]
+
+def wait_until_cancelled(job):
+    while True:
+        job.progress(0) # raises JobCancelled
+        time.sleep(0.01)
+
+def test_cancel_running_job(job_pool, monkeypatch):
+    monkeypatch.setitem(jobs.JOB_TYPES, 'until_cancelled', wait_until_cancelled)
+    job_id = jobs.submit('until_cancelled')
+    wait_for(lambda: jobs.get_job(job_id)['status'] == 'running')
+
+    assert jobs.cancel(job_id)
+    wait_for(lambda: jobs.get_job(job_id)['status'] == 'cancelled')
+    assert jobs.get_job(job_id)['finished_at'] is not None
+    assert not jobs.cancel(job_id) # already finished
+
+def test_failed_job_keeps_error(job_pool, monkeypatch):
+    def fail(job):
+        raise ValueError('bad input')
+    monkeypatch.setitem(jobs.JOB_TYPES, 'fail', fail)
+    job_id = jobs.submit('fail')
+
+    wait_for(lambda: jobs.get_job(job_id)['status'] == 'failed')
+    assert jobs.get_job(job_id)['error'] == 'ValueError: bad input'
+
+def test_interrupted_job_restarted(job_pool, monkeypatch):
+    def two_steps(job, step = 1):
+        if step == 1:
+            job.update_params(step = 2) # step 1 done, don't repeat it after a restart
+            wait_until_cancelled(job)
+        return f'finished step {step}'
+    monkeypatch.setitem(jobs.JOB_TYPES, 'two_steps', two_steps)
+
+    job_id = jobs.submit('two_steps')
+    queued_id = jobs.submit('instant') # never got to run
+    wait_for(lambda: jobs.get_job(job_id)['params'] == {'step': 2})
+    start = time.monotonic()
+    jobs.shutdown()
+    assert time.monotonic() - start < 2
+    assert jobs.get_job(job_id)['status'] == 'running'
+    assert jobs.get_job(queued_id)['status'] == 'queued'
+
+    jobs.start(max_workers = 1)
+    wait_for(lambda: jobs.get_job(queued_id)['status'] == 'done')
+    assert jobs.get_job(job_id)['status'] == 'done'
+    assert jobs.get_job(job_id)['result'] == 'finished step 2'
+
+def test_running_scrape_stops_on_shutdown(fake_server, monkeypatch, capsys):
+    # the followings of 5 users use up the rate limit, the 6th waits 3 minutes for it
+    monkeypatch.setattr(config, 'SCRAPING_RATE_LIMIT_REQUESTS', 5)
+    build_database.save_database(pd.DataFrame({'username': [f'user{i}' for i in range(20)], 'protected': False}))
+
+    def users_scraped():
+        with build_database.db_connection() as con:
+            if not build_database._table_exists(con, build_database.EDGES_TABLE):
+                return 0
+            return con.execute(f'SELECT COUNT(DISTINCT follower_id) FROM {build_database.EDGES_TABLE}').fetchone()[0]
+
+    with TestClient(fake_server.app) as client:
+        job_id = client.post('/scrape_follower_followings/', data = {'pages': 1}).json()['job_id']
+        wait_for(lambda: users_scraped() == 5)
+        start = time.monotonic()
+
+    assert time.monotonic() - start < 2
+    assert 'did not stop' not in capsys.readouterr().out
+    assert jobs.get_job(job_id)['status'] == 'running' # left as running, so the next start() restarts it
+    assert users_scraped() == 5
+
+def test_prefetch_stops_on_shutdown_while_downloading(fake_server, monkeypatch, capsys):
+    release = threading.Event()
+    monkeypatch.setattr(image_cache, 'get_thumbnail', lambda url, kind: release.wait(30)) # an image host that hangs
+    build_database.save_database(pd.DataFrame({
+        'username': ['a', 'b'], 'profile_image_url_https': ['https://pbs.twimg.com/a.jpg', 'https://pbs.twimg.com/b.jpg'],
+        'profile_banner_url': [None, None]}))
+
+    try:
+        with TestClient(fake_server.app):
+            job_id = jobs.submit('prefetch_images')
+            wait_for(lambda: jobs.get_job(job_id)['status'] == 'running')
+            start = time.monotonic()
+
+        assert time.monotonic() - start < 2
+        assert 'did not stop' not in capsys.readouterr().out
+    finally:
+        release.set()
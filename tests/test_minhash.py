@@ -0,0 +1,34 @@
+import numpy as np
+
+import graph_analysis
+import minhash
+
+def clustered_followings(num_bots = 60, num_humans = 200, seed = 0):
+    ''' Bots following nearly the same accounts, humans following random ones '''
+    rnd = np.random.RandomState(seed)
+    followings = {}
+    for i in range(num_bots):
+        followings[f'bot{i}'] = set(range(40)) | set(rnd.choice(np.arange(1000, 2000), size = 3).tolist())
+    for i in range(num_humans):
+        followings[f'human{i}'] = set(rnd.choice(np.arange(2000, 10000), size = 50, replace = False).tolist())
+    return followings
+
+def test_large_buckets_compared_exactly(monkeypatch):
+    monkeypatch.setattr(minhash, 'MAX_BUCKET_SIZE', 10) # every bot shares most bands, their buckets are too big
+    followings = clustered_followings()
+    users = list(followings)
+    signatures = minhash.compute_signatures([followings[user] for user in users], 128)
+
+    _, _, large_buckets = minhash.lsh_candidate_pairs(signatures, 0.3)
+    assert large_buckets
+
+    rows, cols, weights = minhash.signature_edges(followings, users, signatures, 0.3)
+    exact_rows, exact_cols, exact_weights = graph_analysis.jaccard_edges(followings, users, 0.3)
+    exact = dict(zip(zip(exact_rows.tolist(), exact_cols.tolist()), exact_weights.tolist()))
+    found = dict(zip(zip(rows.tolist(), cols.tolist()), weights.tolist()))
+
+    # no bot pair is lost in the big buckets, they get their exact weight, and each pair is returned once
+    assert set(exact) <= set(found)
+    assert len(found) == len(rows)
+    assert all(np.isclose(found[pair], weight) for pair, weight in exact.items())
+    assert (rows < cols).all()
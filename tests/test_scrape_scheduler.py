@@ -0,0 +1,135 @@
+import threading
+import time
+
+from fake_twitter import FakeTwitter, RateLimitReached
+from scrape_scheduler import ScrapingSession, TokenBucket, run_scrape_jobs
+
+class FakeClock:
+    ''' Injected clock for TokenBucket. Also works as its cancel_event: wait() fast forwards instead of sleeping. '''
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def wait(self, seconds):
+        self.now += seconds
+        return False
+
+def make_session(app, name = 'session'):
+    return ScrapingSession(app, name, TokenBucket(100, 60, clock = FakeClock()))
+
+#-----------------------
+# TokenBucket
+#-----------------------
+def test_acquire_waits_for_refill():
+    clock = FakeClock()
+    bucket = TokenBucket(2, 10, clock = clock)
+
+    assert bucket.acquire(2) == 0
+    # 1 token every 5 seconds
+    assert bucket.acquire(1, cancel_event = clock) == 5
+    assert clock.now == 5
+
+def test_acquire_timeout():
+    clock = FakeClock()
+    bucket = TokenBucket(2, 10, clock = clock)
+    bucket.acquire(2)
+
+    assert bucket.acquire(1, timeout = 4, cancel_event = clock) is None
+    assert clock.now == 0 # gave up right away instead of waiting
+    assert bucket.acquire(1, timeout = 5, cancel_event = clock) == 5
+
+def test_acquire_cancelled():
+    bucket = TokenBucket(1, 3600)
+    bucket.acquire()
+
+    cancel_event = threading.Event()
+    cancel_event.set()
+    assert bucket.acquire(cancel_event = cancel_event) is None
+
+    # cancelled while waiting
+    cancel_event = threading.Event()
+    threading.Timer(0.1, cancel_event.set).start()
+    start = time.monotonic()
+    assert bucket.acquire(cancel_event = cancel_event) is None
+    assert time.monotonic() - start < 5
+
+def test_pause_drain():
+    clock = FakeClock()
+    bucket = TokenBucket(2, 10, clock = clock)
+
+    bucket.pause(30, drain = True)
+    assert bucket.tokens == 0
+    assert bucket.acquire(1, timeout = 29, cancel_event = clock) is None
+    # refilled during the pause, so no extra wait after it
+    assert bucket.acquire(2, cancel_event = clock) == 30
+
+#-----------------------
+# run_scrape_jobs
+#-----------------------
+def test_all_items_scraped():
+    sessions = [make_session(FakeTwitter(f'session_{i}'), f'session_{i}') for i in range(3)]
+    usernames = [f'user{i}' for i in range(20)]
+
+    def fetch(app, username):
+        return app.get_user_info(username)
+
+    results = list(run_scrape_jobs(sessions, usernames, fetch))
+    assert sorted(item for item, _, _ in results) == sorted(usernames)
+    assert all(error is None for _, _, error in results)
+    assert sum(session.requests for session in sessions) == len(usernames)
+
+def test_rate_limit_pauses_until_retry_after():
+    session = make_session(FakeTwitter())
+
+    def fetch(app, username):
+        raise RateLimitReached(retry_after = 120)
+
+    [(item, result, error)] = list(run_scrape_jobs([session], ['user0'], fetch, max_retries = 0))
+    assert isinstance(error, RateLimitReached)
+    assert session.bucket.tokens == 0
+    assert session.bucket.paused_until == 120 # the clock didn't move
+    assert not session.retired
+
+def test_failing_session_retired():
+    bad, good = make_session(FakeTwitter('bad'), 'bad'), make_session(FakeTwitter('good'), 'good')
+    usernames = [f'user{i}' for i in range(10)]
+
+    def fetch(app, username):
+        if app.session_name == 'bad':
+            raise ConnectionError('account locked')
+        return app.get_user_info(username)
+
+    results = list(run_scrape_jobs([bad, good], usernames, fetch, max_retries = 5, max_consecutive_errors = 2, backoff_base_sec = 0))
+    assert sorted(item for item, _, _ in results) == sorted(usernames)
+    assert all(error is None for _, _, error in results)
+    assert bad.retired and not good.retired
+    assert bad.errors == 2
+
+def test_stops_when_all_sessions_retired():
+    sessions = [make_session(FakeTwitter(f'session_{i}'), f'session_{i}') for i in range(2)]
+
+    def fetch(app, username):
+        raise ConnectionError('account locked')
+
+    results = list(run_scrape_jobs(sessions, [f'user{i}' for i in range(10)], fetch,
+                                   max_retries = 0, max_consecutive_errors = 2, backoff_base_sec = 0))
+    assert all(session.retired for session in sessions)
+    assert len(results) == 4 # 2 failed items per session, the rest is never tried
+    assert all(isinstance(error, ConnectionError) for _, _, error in results)
+
+def test_cancel_event_stops_waiting():
+    session = ScrapingSession(FakeTwitter(), 'session', TokenBucket(1, 3600))
+    cancel_event = threading.Event()
+
+    def fetch(app, username):
+        return app.get_user_info(username)
+
+    start = time.monotonic()
+    results = []
+    for result in run_scrape_jobs([session], ['user0', 'user1', 'user2'], fetch, cancel_event = cancel_event):
+        results.append(result)
+        cancel_event.set() # 2nd item waits a whole rate limit period for a token
+    assert len(results) == 1
+    assert time.monotonic() - start < 5
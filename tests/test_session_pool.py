@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+import config
+import session_pool
+from fake_twitter import FakeTwitter
+
+def wait_for(condition, timeout = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.02)
+
+class FlakyLoginTwitter(FakeTwitter):
+    ''' No saved session, and signing in fails the number of times in failed_sign_ins for the session name '''
+    failed_sign_ins = {}
+
+    def connect(self):
+        raise RuntimeError('No saved session')
+
+    def sign_in(self, username, password):
+        if FlakyLoginTwitter.failed_sign_ins.get(self.session_name, 0) > 0:
+            FlakyLoginTwitter.failed_sign_ins[self.session_name] -= 1
+            raise RuntimeError('Wrong password')
+        return super().sign_in(username, password)
+
+@pytest.fixture
+def pool(monkeypatch):
+    ''' start(client_factory, health_check_interval) starts the pool with 2 scraping accounts + the main account,
+    and returns the clients it made by session name '''
+    monkeypatch.setattr(config, 'SCRAPING_ACCOUNT_USERNAME', 'scraper')
+    monkeypatch.setattr(config, 'SCRAPING_ACCOUNT_PASSWORD', 'password')
+    monkeypatch.setattr(config, 'EXTRA_SCRAPING_ACCOUNTS', [('extra', 'password')])
+    monkeypatch.setattr(config, 'MAIN_ACCOUNT_USERNAME', 'me')
+    monkeypatch.setattr(config, 'MAIN_ACCOUNT_PASSWORD', 'password')
+
+    clients = {}
+    def start(client_factory = FakeTwitter, health_check_interval = 60):
+        monkeypatch.setattr(config, 'SESSION_HEALTH_CHECK_INTERVAL_SEC', health_check_interval)
+        def make_client(session_name):
+            clients[session_name] = client_factory(session_name)
+            return clients[session_name]
+        session_pool.start(client_factory = make_client)
+        return clients
+
+    yield start
+    session_pool.shutdown()
+
+def states():
+    return {session['name']: session['state'] for session in session_pool.status()}
+
+def test_sessions_lent_to_one_job_at_a_time(pool):
+    pool()
+    wait_for(lambda: set(states().values()) == {'ready'})
+    assert session_pool.main_session().name == 'session_main'
+
+    with session_pool.borrow_scraping_sessions(count = 1) as first:
+        with session_pool.borrow_scraping_sessions() as second:
+            assert {first[0].name, second[0].name} == {'session', 'session_extra'}
+            assert states() == {'session': 'lent', 'session_extra': 'lent', 'session_main': 'ready'}
+
+            with pytest.raises(session_pool.NoSessionsAvailable):
+                with session_pool.borrow_scraping_sessions(timeout = 0.1):
+                    pass
+    assert set(states().values()) == {'ready'}
+
+def test_retired_session_logged_in_again(pool):
+    clients = pool()
+    wait_for(lambda: set(states().values()) == {'ready'})
+    expired = clients['session']
+    expired.expire_session()
+
+    with session_pool.borrow_scraping_sessions() as sessions:
+        session, = [s for s in sessions if s.name == 'session']
+        session.retired = True # what the scheduler does after the session keeps erroring
+
+    wait_for(lambda: clients['session'] is not expired and states()['session'] == 'ready')
+    with session_pool.borrow_scraping_sessions() as sessions:
+        session, = [s for s in sessions if s.name == 'session']
+        assert session.app is clients['session']
+        session.app.get_user_info('bob')
+
+def test_health_check_finds_expired_session(pool):
+    clients = pool(health_check_interval = 0.1)
+    wait_for(lambda: set(states().values()) == {'ready'})
+    expired = clients['session_extra']
+    expired.expire_session()
+
+    wait_for(lambda: clients['session_extra'] is not expired)
+    wait_for(lambda: states()['session_extra'] == 'ready')
+    assert not clients['session_extra'].session_expired
+    assert clients['session'].request_count >= 1 # healthy sessions are checked with 1 request
+
+def test_failed_login_retried(pool, monkeypatch):
+    monkeypatch.setattr(FlakyLoginTwitter, 'failed_sign_ins', {'session_extra': 2})
+    pool(FlakyLoginTwitter, health_check_interval = 0.1)
+
+    wait_for(lambda: FlakyLoginTwitter.failed_sign_ins['session_extra'] == 0)
+    wait_for(lambda: states()['session_extra'] == 'ready')
+    assert {s['name']: s['error'] for s in session_pool.status()}['session_extra'] is None
+
+def test_no_scraping_account_logged_in(pool, monkeypatch):
+    monkeypatch.setattr(config, 'EXTRA_SCRAPING_ACCOUNTS', [])
+    monkeypatch.setattr(FlakyLoginTwitter, 'failed_sign_ins', {'session': 100})
+    pool(FlakyLoginTwitter)
+
+    wait_for(lambda: states()['session'] == 'failed')
+    with pytest.raises(session_pool.NoSessionsAvailable, match = 'Wrong password'):
+        with session_pool.borrow_scraping_sessions():
+            pass
+    assert session_pool.main_session() is not None # blocking still works
@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+
+import build_database
+import snapshots
+from fake_twitter import FakeTwitter
+
+def save_followers(descriptions):
+    ''' Users table of the user ids in descriptions, with their description '''
+    build_database.save_database(pd.DataFrame({
+        'id': list(descriptions), 'username': [f'user{i}' for i in descriptions], 'name': 'Name',
+        'description': list(descriptions.values()), 'location': '', 'profile_image_url_https': '',
+        'protected': False, 'verified': False, 'followers_count': [i * 100 for i in descriptions]}))
+
+def test_snapshot_saves_only_changes(data_dir):
+    save_followers({1: 'a', 2: 'b', 3: 'c'})
+    first = snapshots.take_snapshot('me')
+
+    save_followers({1: 'a', 2: 'changed', 4: 'd'})
+    build_database.update_database(pd.DataFrame({'id': [1], 'followers_count': [12345]}), ['followers_count'])
+    second = snapshots.take_snapshot('me')
+
+    listed = {s['snapshot_id']: s for s in snapshots.list_snapshots('me')}
+    assert (listed[first]['added'], listed[first]['num_followers']) == (3, 3)
+    assert (listed[second]['added'], listed[second]['removed'], listed[second]['changed']) == (1, 1, 1) # counts aren't compared
+    with build_database.db_connection() as con:
+        assert con.execute(f'SELECT COUNT(*) FROM {snapshots.SNAPSHOT_CHANGES_TABLE} WHERE snapshot_id = ?', (second,)).fetchone()[0] == 3
+
+def test_diff_snapshots(data_dir):
+    save_followers({1: 'a', 2: 'b', 3: 'c'})
+    first = snapshots.take_snapshot('me')
+    save_followers({1: 'a', 2: 'changed', 3: 'changed'})
+    snapshots.take_snapshot('me')
+    save_followers({1: 'a', 2: 'b', 3: 'changed again', 4: 'd'})
+    third = snapshots.take_snapshot('me')
+
+    diff = snapshots.diff_snapshots(first, third)
+    assert [p['username'] for p in diff['added']] == ['user4']
+    assert diff['removed'] == []
+    assert diff['changed'] == [{'user_id': '3', 'username': 'user3', 'fields': {'description': ['c', 'changed again']}}]
+
+    reverse = snapshots.diff_snapshots(third, first)
+    assert [p['username'] for p in reverse['removed']] == ['user4']
+    assert reverse['changed'][0]['fields'] == {'description': ['changed again', 'c']}
+
+def test_diff_checks_snapshot_ids(data_dir):
+    save_followers({1: 'a'})
+    mine = snapshots.take_snapshot('me')
+    theirs = snapshots.take_snapshot('someone_else')
+
+    with pytest.raises(ValueError):
+        snapshots.diff_snapshots(mine, theirs)
+    with pytest.raises(KeyError):
+        snapshots.diff_snapshots(mine, 999)
+
+def test_fresh_scrape_snapshot_has_lost_followers(data_dir):
+    build_database.create_database('me', pages = 10, authenticated_app = FakeTwitter(num_followers = 60))
+    build_database.create_database('me', pages = 10, authenticated_app = FakeTwitter(num_followers = 50), fresh = True)
+
+    latest, first = snapshots.list_snapshots('me')
+    assert (first['added'], latest['added'], latest['removed'], latest['num_followers']) == (60, 0, 10, 50)
+    assert latest['mode'] == 'full'
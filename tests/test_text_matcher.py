@@ -0,0 +1,45 @@
+import random
+
+import emoji
+import pytest
+
+from text_matcher import TextMatcher
+
+def reference_reasons(text, text_to_flag, emoji_to_flag):
+    ''' Reasons from checking each pattern against the text / demojized text, like flag_text_or_emoji used to '''
+    reasons = [f'flagged_text --- {t}' for t in dict.fromkeys(text_to_flag) if t in text.lower()]
+    demojized = emoji.demojize(text)
+    reasons += [f'flagged_emoji --- {e}' for e in dict.fromkeys(emoji_to_flag) if e in demojized]
+    return reasons
+
+TEXT_TO_FLAG = ['whatsapp', 'he/him', 'crypto']
+EMOJI_TO_FLAG = [':Ukraine:', ':rainbow:', ':rainbow_flag:', ':transgender_', ':red_heart:']
+
+@pytest.mark.parametrize('text, expected', [
+    ('Jim 🇺🇦', ['flagged_emoji --- :Ukraine:']),
+    ('WhatsApp me 🌈', ['flagged_text --- whatsapp', 'flagged_emoji --- :rainbow:']),
+    ('she/her 🏳️‍🌈', ['flagged_emoji --- :rainbow_flag:']),
+    ('typed out :Ukraine:', ['flagged_emoji --- :Ukraine:']),
+    ('🏳️‍⚧️', ['flagged_emoji --- :transgender_']),
+    ('', []),
+    # adjacent flags whose regional indicators contain 🇺🇦 in the middle
+    ('🇦🇺🇦🇺', []),
+    ('🇬🇺🇦🇲', []),
+    ('🇱🇺🇦🇨', []),
+    ('🇦🇺🇺🇦', ['flagged_emoji --- :Ukraine:']),
+])
+def test_find_reasons(text, expected):
+    assert TextMatcher(TEXT_TO_FLAG, EMOJI_TO_FLAG).find_reasons(text) == expected
+
+def test_same_reasons_as_demojize():
+    matcher = TextMatcher(TEXT_TO_FLAG, EMOJI_TO_FLAG)
+    rnd = random.Random(0)
+    emojis = list(emoji.EMOJI_DATA)
+    words = ['a', ' ', 'he/him', 'WhatsApp', ':Ukraine:', 'x', 'Crypto']
+
+    for _ in range(3000):
+        text = ''.join(rnd.choice(emojis) if rnd.random() < 0.4 else rnd.choice(words) for _ in range(rnd.randint(0, 12)))
+        assert matcher.find_reasons(text) == reference_reasons(text, TEXT_TO_FLAG, EMOJI_TO_FLAG), text
+
+def test_not_text():
+    assert TextMatcher(TEXT_TO_FLAG, EMOJI_TO_FLAG).find_reasons(None) == []
@@ -0,0 +1,112 @@
+''' Single pass matcher for config.TEXT_TO_FLAG and config.EMOJI_TO_FLAG
+
+All patterns are compiled into one regex, built once per config. Emoji short-text patterns
+(ie. ':rainbow:' or partial ones like ':transgender_') are mapped back to the unicode emoji
+whose name contains them, so the raw text is scanned directly instead of calling emoji.demojize()
+on every user. Gives the same reasons as checking each pattern against the text / demojized text,
+except partial emoji patterns that would only match across 2 neighboring emoji names.
+'''
+import re
+from functools import lru_cache
+
+import emoji
+
+class TextMatcher:
+
+    def __init__(self, text_to_flag, emoji_to_flag):
+        '''
+        text_to_flag {list} -- Lowercase text, matched case insensitively
+        emoji_to_flag {list} -- Emoji short-text from the emoji library, matched case sensitively
+        '''
+        text_to_flag = list(dict.fromkeys(text_to_flag))
+        emoji_to_flag = list(dict.fromkeys(emoji_to_flag))
+
+        # reasons are reported in config order: all text, then all emoji
+        self.reasons = [f'flagged_text --- {t}' for t in text_to_flag] + [f'flagged_emoji --- {e}' for e in emoji_to_flag]
+
+        # literal patterns: (pattern, case_sensitive, reason). Emoji short-text can be typed as plain text too
+        literals = [(t, False, f'flagged_text --- {t}') for t in text_to_flag if t]
+        literals += [(e, True, f'flagged_emoji --- {e}') for e in emoji_to_flag if e]
+
+        # emoji whose name contains a pattern --> reasons
+        self.emoji_reasons = {}
+        for emo, data in emoji.EMOJI_DATA.items():
+            reasons = [f'flagged_emoji --- {e}' for e in emoji_to_flag if e and e in data['en']]
+            if reasons:
+                self.emoji_reasons[emo] = reasons
+
+        # emoji that overlap a matched emoji have to be matched as a whole, same as demojize does, otherwise we'd flag
+        # the rainbow inside the rainbow flag, or the Ukrainian flag across the 2 Australian flags in 🇦🇺🇦🇺.
+        # Any emoji containing the first character of a matched emoji is matched too, until no more are added.
+        # Not every emoji is matched: python's re tries each first character in turn, which is ~20x slower
+        self.matched_emoji = set(self.emoji_reasons)
+        while True:
+            first_chars = {emo[0] for emo in self.matched_emoji}
+            overlapping = {emo for emo in emoji.EMOJI_DATA if emo not in self.matched_emoji and not first_chars.isdisjoint(emo)}
+            if not overlapping:
+                break
+            self.matched_emoji |= overlapping
+
+        # the regex finds the longest literal at each position, every other literal matching at that position
+        # is a prefix of it, so keep a list of prefixes to check
+        self.literal_prefixes = {}
+        for pattern, _, _ in literals:
+            self.literal_prefixes[pattern.lower()] = [
+                (p, case_sensitive, reason) for p, case_sensitive, reason in literals if pattern.lower().startswith(p.lower())]
+
+        branches = []
+        if literals:
+            alternatives = [
+                re.escape(p) if case_sensitive else f'(?i:{re.escape(p)})'
+                for p, case_sensitive, _ in sorted(literals, key = lambda x: -len(x[0]))]
+            # zero width lookahead so overlapping literals are all found
+            branches.append(f'(?=(?P<literal>{"|".join(alternatives)}))')
+        if self.emoji_reasons:
+            branches.append(f'(?P<emoji>{_trie_regex(self.matched_emoji)})')
+
+        self.regex = re.compile('|'.join(branches)) if branches else None
+
+    def find_reasons(self, text):
+        ''' Return a list of flag reasons for text, in config order '''
+        if self.regex is None or not isinstance(text, str):
+            return []
+
+        hits = set()
+        for match in self.regex.finditer(text):
+            if match.lastgroup == 'emoji':
+                hits.update(self.emoji_reasons.get(match.group('emoji'), ()))
+                continue
+
+            start, literal = match.start(), match.group('literal')
+            for pattern, case_sensitive, reason in self.literal_prefixes[literal.lower()]:
+                candidate = text[start:start + len(pattern)]
+                if candidate == pattern if case_sensitive else candidate.lower() == pattern.lower():
+                    hits.add(reason)
+
+        return [reason for reason in self.reasons if reason in hits]
+
+def _trie_regex(strings):
+    ''' Regex matching the longest of strings at a position. Alternatives are factored into a trie,
+    much faster than a flat alternation of thousands of emoji with python's re. '''
+    trie = {}
+    for string in strings:
+        node = trie
+        for char in string:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def to_regex(node):
+        branches = [re.escape(char) + to_regex(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        regex = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node: # a string ends here, longer matches are tried first
+            regex = '(?:' + regex + ')?'
+        return regex
+
+    return to_regex(trie)
+
+@lru_cache(maxsize = 8)
+def get_text_matcher(text_to_flag, emoji_to_flag):
+    ''' Compiled matcher for a config, built once and reused. Pass tuples so they can be cached. '''
+    return TextMatcher(text_to_flag, emoji_to_flag)
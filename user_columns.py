@@ -0,0 +1,121 @@
+''' Typed column buffers for converting pages of Tweety users into DataFrames.
+
+Values are written straight into numpy arrays per column (int64 counts, bool flags, datetime64 created_at),
+so a big scrape never holds lists of python objects per attribute. Repeated strings like location are interned
+and come out as categoricals. Buffers are reused between batches: fill, to_dataframe(), clear().
+'''
+import datetime
+import sys
+
+import emoji
+import numpy as np
+import pandas as pd
+
+# dtype of each user attribute, attributes not listed here are kept as strings
+USER_COLUMN_TYPES = {
+    'username': 'str', 'name': 'str', 'id': 'str', 'created_at': 'datetime',
+    'description': 'str', 'location': 'category',
+    'followed_by': 'bool', 'following': 'bool',
+    'statuses_count': 'int', 'followers_count': 'int', 'friends_count': 'int', 'subscriptions_count': 'int',
+    'profile_banner_url': 'str', 'profile_image_url_https': 'str',
+    'favourites_count': 'int', 'protected': 'bool', 'verified': 'bool',
+}
+
+_NUMPY_TYPES = {'int': np.int64, 'bool': np.bool_, 'datetime': 'datetime64[ns]', 'str': object, 'category': object}
+
+class UserColumnBuffer:
+
+    def __init__(self, user_attributes, capacity = 1000, replace_emojis = False):
+        '''
+        user_attributes {list} -- Tweety user attributes to keep, one column each
+        capacity {int} -- Initial number of rows, grows if more users are added before clear()
+        replace_emojis {bool} -- Convert emoji in text to emoji short-text (ie. :rainbow:)
+        '''
+        self.user_attributes = list(user_attributes)
+        self.types = [USER_COLUMN_TYPES.get(attribute, 'str') for attribute in self.user_attributes]
+        self.replace_emojis = replace_emojis
+        self.size = 0
+        self.has_timezone = False
+        self._allocate(capacity)
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, users):
+        ''' Append users to the buffer. Users with attributes that can't be read or converted are skipped. '''
+        for user in users:
+            try:
+                row = [self._convert(getattr(user, attribute), kind, attribute)
+                       for attribute, kind in zip(self.user_attributes, self.types)]
+            except Exception as e:
+                print(str(e))
+                continue
+
+            if self.size == len(self.valid[0]):
+                self._grow()
+
+            for data, valid, value in zip(self.data, self.valid, row):
+                valid[self.size] = value is not None
+                if value is not None:
+                    data[self.size] = value
+            self.size += 1
+
+    def to_dataframe(self):
+        ''' Typed DataFrame of the buffered users. Copies the data, so the buffer can be cleared and reused. '''
+        columns = {}
+        for attribute, kind, data, valid in zip(self.user_attributes, self.types, self.data, self.valid):
+            data, valid = data[:self.size].copy(), valid[:self.size]
+
+            if kind == 'int':
+                columns[attribute] = pd.arrays.IntegerArray(data, ~valid)
+            elif kind == 'bool':
+                columns[attribute] = pd.arrays.BooleanArray(data, ~valid)
+            elif kind == 'datetime':
+                data[~valid] = np.datetime64('NaT')
+                column = pd.Series(data)
+                columns[attribute] = column.dt.tz_localize('UTC') if self.has_timezone else column
+            else:
+                data[~valid] = None # slots of a reused buffer can still hold the previous batch's values
+                columns[attribute] = pd.Categorical(data) if kind == 'category' else data
+
+        return pd.DataFrame(columns)
+
+    def clear(self):
+        self.size = 0
+
+    def _allocate(self, capacity):
+        self.data = [np.empty(capacity, dtype = _NUMPY_TYPES[kind]) for kind in self.types]
+        self.valid = [np.zeros(capacity, dtype = bool) for _ in self.types]
+
+    def _grow(self):
+        old_data, old_valid = self.data, self.valid
+        self._allocate(max(2 * len(old_valid[0]), 1))
+        for data, valid, old_d, old_v in zip(self.data, self.valid, old_data, old_valid):
+            data[:self.size] = old_d[:self.size]
+            valid[:self.size] = old_v[:self.size]
+
+    def _convert(self, value, kind, attribute):
+        if value is None:
+            return None
+
+        if kind == 'int':
+            return int(value)
+        if kind == 'bool':
+            return bool(value)
+        if kind == 'datetime':
+            if not isinstance(value, datetime.datetime):
+                value = pd.Timestamp(value).to_pydatetime()
+            if value.tzinfo is not None: # tweety dates are UTC
+                self.has_timezone = True
+                value = value.astimezone(datetime.timezone.utc).replace(tzinfo = None)
+            return np.datetime64(value, 'ns')
+
+        if not isinstance(value, str):
+            value = str(value)
+        if self.replace_emojis: # emoji ---> emoji short-text
+            value = emoji.demojize(value)
+        if attribute == 'description':
+            value = value.replace('\n', ' ').replace('\r', ' ')
+        if kind == 'category':
+            value = sys.intern(value)
+        return value